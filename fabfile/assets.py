@@ -0,0 +1,33 @@
+"""
+--------------------------------------------------------------------------------------
+assets.py
+--------------------------------------------------------------------------------------
+Precompresses the collected static files, so nginx serves a ready made .gz (and .br)
+copy with gzip_static instead of compressing the same file on every request.
+
+Only files with compressible extensions are compressed, in parallel across the CPUs,
+and a file is skipped when its compressed copy already has its modification time, so
+after a deploy only the new and changed files are compressed. The copies get the
+original's modification time, so nginx sends the same Last-Modified for all of them.
+"""
+from batch import quote
+
+
+def precompress_command(root, extensions, brotli=False):
+    """
+    Returns a shell command that writes a gzip copy, and with brotli a brotli copy, next to each file under root
+    with one of extensions that does not have an up to date one
+    """
+    names = ' -o '.join("-name %s" % quote('*.' + extension) for extension in extensions)
+    compressors = [('gz', 'gzip -9 -n -c')]
+    if brotli:
+        compressors.append(('br', 'brotli -q 11 -c'))
+
+    # Run by sh -c for each chunk of files, so the files arrive as "$@". It exits non-zero if any file fails
+    script = 'for f; do %s; done' % '; '.join(
+        'if ! test -f "$f.%(ext)s" || test "$f.%(ext)s" -ot "$f"; then '
+        '{ %(compress)s "$f" > "$f.%(ext)s.tmp" && touch -r "$f" "$f.%(ext)s.tmp" && '
+        'mv -f "$f.%(ext)s.tmp" "$f.%(ext)s"; } || { rm -f "$f.%(ext)s.tmp"; exit 1; }; fi'
+        % {'ext': ext, 'compress': compress} for ext, compress in compressors)
+    return ('if test -d %s; then find %s -type f \\( %s \\) -print0 | '
+            'xargs -0 -r -n 100 -P $(nproc) sh -c %s sh; fi' % (quote(root), quote(root), names, quote(script)))
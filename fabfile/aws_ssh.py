@@ -3,11 +3,17 @@
 import subprocess
 
 from project_conf import fabconf
+from connections import ssh_command, shell_command
+from django_fabric_aws import _all_hosts
 
-if len(fabconf['EC2_INSTANCES']) == 0:
-    print "Error: you need to add the instance domain name to project_conf.py"
+# The servers tagged with fabconf['INSTANCE_NAME_TAG'], or the ones in project_conf.py and the inventory
+hosts = _all_hosts()
+if len(hosts) == 0:
+    print "Error: there are no servers, run fab spawn instance or add the instance domain name to project_conf.py"
 else:
-    cmd = 'ssh -i ~/.ssh/%s %s@%s' % (fabconf['EC2_KEY_NAME'], fabconf['SERVER_USERNAME'], fabconf['EC2_INSTANCES'][0])
+    # Shares the session the fabfile's ssh processes keep open to the host, or starts one they can reuse
+    cmd = shell_command(ssh_command(fabconf['SERVER_USERNAME'], '~/.ssh/%s' % fabconf['EC2_KEY_NAME'],
+                                    fabconf['SSH_CONTROL_DIR'], fabconf['SSH_CONTROL_PERSIST']) +
+                        [hosts[0]])
     print cmd
     subprocess.call(cmd,shell=True)
-
@@ -0,0 +1,210 @@
+"""
+--------------------------------------------------------------------------------------
+batch.py
+--------------------------------------------------------------------------------------
+Gathers consecutive shell commands into a single remote script so that a run of
+commands costs one SSH round trip instead of one each.
+
+The script runs under set -e, which also holds inside each step, so a step stops at
+its first failing command rather than only checking its last. It echoes a marker line
+before and after every step. The markers are used to time each step and to report
+exactly which step failed. A step can be given a shell condition; when it is false the
+step is skipped and reported as such.
+
+Steps added with Batch.sudo() are wrapped in "sudo -n", so the login user needs
+password-less sudo. This is the default for the ubuntu user on EC2 Ubuntu images.
+"""
+import os
+import time
+import base64
+import binascii
+from StringIO import StringIO
+
+from fabric.api import run, env, settings
+from fabric.colors import yellow as _yellow
+
+from tracing import record, put
+
+MARKER = '@@batch'
+
+# The command is a single argument to the server's login shell, which Linux caps at 128 KiB (MAX_ARG_STRLEN).
+# Bigger scripts are uploaded, and base64 grows them by a third, so this leaves plenty of room
+INLINE_LIMIT = 64 * 1024
+
+
+def quote(string):
+    """
+    Quotes a string for use as a single shell word
+    """
+    return "'" + string.replace("'", "'\\''") + "'"
+
+
+def fabric_executor(command):
+    """
+    Runs the batch command on env.host_string and returns (output, exit code)
+    """
+    with settings(warn_only=True):
+        result = run(command)
+    return result, result.return_code
+
+
+class Batch(object):
+    """
+    Collects run and sudo steps and sends them to the server as one script when flushed.
+    Used as a context manager it flushes on the way out, unless the block raised.
+    """
+    def __init__(self, executor=fabric_executor, uploader=put):
+        self.executor = executor
+        self.uploader = uploader
+        self.steps = []
+        self.timings = []
+        self.skipped = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.flush()
+
+    def run(self, command, label=None, when=None):
+        """
+        Adds a step run as the login user, in the script's own shell so "source" and "cd" carry over.
+        With when, a shell condition, the step only runs if the condition holds
+        """
+        self._add(label or command, self._in_cwd(command), when)
+
+    def sudo(self, command, label=None, user=None, when=None):
+        """
+        Adds a step run through sudo, as root or as user
+        """
+        as_user = '-H -u %s ' % user if user else ''
+        self._add(label or command, 'sudo -n %sbash -l -c %s' % (as_user, quote(self._in_cwd(command))), when)
+
+    def _add(self, label, command, when):
+        if when:
+            # The condition is tested in the script's shell, so it can use variables set by earlier steps
+            command = 'if %s; then\n%s\nelse echo "%s %d skipped -"; fi' % (when, command, MARKER, len(self.steps))
+        self.steps.append((label, command))
+
+    def script(self):
+        """
+        Returns the pending steps as a bash script
+        """
+        # Steps run in the script's own shell so they share its state, and not on the left of || where bash
+        # ignores set -e. The ERR trap reports the failing step before set -e exits
+        lines = ['rm -f "$0"',
+                 'set -e',
+                 '__batch_fail() { echo "%s $1 failed $2"; exit $2; }' % MARKER,
+                 'trap \'__batch_fail $__batch_step $?\' ERR']
+        for number, (label, command) in enumerate(self.steps):
+            lines.append('__batch_step=%d' % number)
+            lines.append('echo "%s %d begin $(date +%%s.%%N)" %s' % (MARKER, number, quote(label)))
+            lines.append('{\n%s\n}' % command)
+            lines.append('echo "%s %d end $(date +%%s.%%N)"' % (MARKER, number))
+        return '\n'.join(lines) + '\n'
+
+    def command(self):
+        """
+        Returns a one line command that runs the pending steps, uploading them first if they are too big to
+        send inline
+        """
+        script = self.script()
+        if len(script) > INLINE_LIMIT:
+            return uploaded_command(script, self.uploader)
+        return script_command(script)
+
+    def flush(self):
+        """
+        Runs the pending steps, records how long each took and which were skipped, and raises naming the
+        step that failed
+        """
+        if not self.steps:
+            return
+        command = self.command()
+        steps, self.steps = self.steps, []
+
+        start = time.time()
+        output, exit_code = self.executor(command)
+        record('batch', 'Batch of %d steps' % len(steps), start, time.time() - start, exit_code=exit_code,
+               transferred=len(command) + len(output))
+        begun, ended, failed, skipped = _parse(output)
+
+        # The markers carry the server's clock, so steps are traced at their offset from the batch's start
+        offset = start - min(begun.values()) if begun else start
+        for number, (label, _) in enumerate(steps):
+            if number in skipped:
+                self.skipped.append(label)
+            elif number in begun and number in ended:
+                self.timings.append((label, ended[number] - begun[number]))
+                record('step', label, offset + begun[number], ended[number] - begun[number], exit_code=0)
+            elif number in begun and number in failed:
+                record('step', label, offset + begun[number], time.time() - offset - begun[number],
+                       exit_code=exit_code)
+
+        if exit_code != 0:
+            number = failed[0] if failed else (max(begun) if begun else None)
+            if number is None:
+                raise Exception("Batch of %d steps failed to start (exit code %s) after %.2fs" %
+                                (len(steps), exit_code, time.time() - start))
+            raise Exception("Batch step %d of %d failed (exit code %s): %s" %
+                            (number + 1, len(steps), exit_code, steps[number][0]))
+
+    def _in_cwd(self, command):
+        # Fabric's cd() only applies to commands it runs itself, so bake it into the step
+        if env.get('cwd'):
+            return 'cd %s && %s' % (env.cwd, command)
+        return command
+
+
+def script_command(script):
+    """
+    Returns a one line command that writes script to a private temp file and runs it. The script
+    travels base64 encoded so it needs no further quoting, and it should delete itself with rm -f "$0"
+    """
+    return 'f=$(mktemp) && echo %s | base64 -d > $f && exec bash -l $f' % base64.b64encode(script)
+
+
+def uploaded_command(script, uploader=put):
+    """
+    Uploads script to a private temp file and returns a command that runs it. As with script_command(), the
+    script should delete itself
+    """
+    path = '/tmp/batch-%s.sh' % binascii.hexlify(os.urandom(8))
+    uploader(StringIO(script), path, mode=0600)
+    return 'exec bash -l %s' % path
+
+
+def print_timings(timings, limit=10):
+    """
+    Prints the slowest steps from one or more batches
+    """
+    if not timings:
+        return
+    print(_yellow("Slowest steps:"))
+    for label, seconds in sorted(timings, key=lambda t: t[1], reverse=True)[:limit]:
+        print(_yellow("  %8.2fs  %s" % (seconds, label)))
+
+
+def _parse(output):
+    """
+    Picks the step markers out of the script output
+    """
+    begun, ended, failed, skipped = {}, {}, [], []
+    for line in output.splitlines():
+        words = line.strip().split()
+        if len(words) < 4 or words[0] != MARKER:
+            continue
+        try:
+            number = int(words[1])
+            if words[2] == 'begin':
+                begun[number] = float(words[3])
+            elif words[2] == 'end':
+                ended[number] = float(words[3])
+            elif words[2] == 'failed':
+                failed.append(number)
+            elif words[2] == 'skipped':
+                skipped.append(number)
+        except ValueError:
+            continue
+    return begun, ended, failed, skipped
@@ -0,0 +1,218 @@
+"""
+--------------------------------------------------------------------------------------
+benchmark.py
+--------------------------------------------------------------------------------------
+A small HTTP load generator for checking whether a gunicorn or nginx change helped.
+
+A pool of threads sends GET requests over keep-alive connections, for a number of
+requests or for a duration, and every request's latency and status is recorded.
+The summary gives throughput, error rate and latency percentiles, and runs are kept
+as JSON files so a run can be compared with the one before it.
+
+serve_stub runs stub_app.py locally under the project's rendered gunicorn config, so
+the gunicorn settings can be measured without a server. The connection factory and
+clock are passed in, so the load loop can be driven without a network.
+"""
+import os
+import json
+import errno
+import math
+import time
+import socket
+import httplib
+import threading
+import subprocess
+from contextlib import contextmanager
+
+from fabric.colors import green as _green, yellow as _yellow, red as _red
+
+from readiness import poll
+
+
+def run_load(host, port, path, requests=None, duration=None, concurrency=10, timeout=10,
+             connection_factory=httplib.HTTPConnection, clock=time.time):
+    """
+    Sends GET path to host:port from concurrency threads until requests have been sent or duration seconds
+    have passed. Returns the (latency in seconds, status) of every request, and the elapsed time. status is the
+    HTTP status code, or the errno or exception name for requests that failed outright
+    """
+    if not requests and not duration:
+        raise Exception("Give benchmark a number of requests or a duration")
+    samples = []
+    lock = threading.Lock()
+    sent = [0]
+    start = clock()
+    deadline = start + float(duration) if duration else None
+
+    def more():
+        with lock:
+            if requests and sent[0] >= int(requests):
+                return False
+            if deadline and clock() >= deadline:
+                return False
+            sent[0] += 1
+            return True
+
+    def worker():
+        conn = None
+        while more():
+            begun = clock()
+            try:
+                if conn is None:
+                    conn = connection_factory(host, port, timeout=timeout)
+                conn.request('GET', path)
+                response = conn.getresponse()
+                response.read()
+                status = response.status
+                # Servers that do not keep connections alive, like sync gunicorn workers, close after each response
+                if response.getheader('connection', '').lower() == 'close':
+                    conn.close()
+                    conn = None
+            except (socket.error, httplib.HTTPException) as e:
+                status = errno.errorcode.get(getattr(e, 'errno', None), e.__class__.__name__)
+                if conn is not None:
+                    conn.close()
+                conn = None
+            with lock:
+                samples.append((clock() - begun, status))
+        if conn is not None:
+            conn.close()
+
+    threads = [threading.Thread(target=worker) for i in range(int(concurrency))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return samples, clock() - start
+
+
+def percentile(ordered, p):
+    """
+    The nearest-rank p-th percentile of a sorted list
+    """
+    if not ordered:
+        return None
+    rank = int(math.ceil(p / 100.0 * len(ordered)))
+    return ordered[min(max(rank, 1), len(ordered)) - 1]
+
+
+def summarize(samples, elapsed):
+    """
+    Returns throughput, error rate, latency percentiles in milliseconds and a count per status for samples
+    """
+    latencies = sorted(latency * 1000 for latency, status in samples)
+    statuses = {}
+    errors = 0
+    for latency, status in samples:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        if not isinstance(status, int) or status >= 400:
+            errors += 1
+
+    def ms(value):
+        return round(value, 2) if value is not None else None
+
+    count = len(samples)
+    return {
+        'requests': count,
+        'errors': errors,
+        'error_rate': round(float(errors) / count, 4) if count else 0.0,
+        'elapsed': round(elapsed, 3),
+        'throughput': round(count / elapsed, 2) if elapsed else 0.0,
+        'latency_ms': {
+            'mean': ms(sum(latencies) / count if count else None),
+            'p50': ms(percentile(latencies, 50)),
+            'p95': ms(percentile(latencies, 95)),
+            'p99': ms(percentile(latencies, 99)),
+            'max': ms(latencies[-1] if latencies else None),
+        },
+        'statuses': statuses,
+    }
+
+
+def save_run(results_dir, run):
+    """
+    Writes run to results_dir as <time>-<target>.json and returns the path
+    """
+    if not os.path.isdir(results_dir):
+        os.makedirs(results_dir)
+    name = '%s-%s.json' % (run['started'].replace(':', ''), _safe(run['target']))
+    path = os.path.join(results_dir, name)
+    f = open(path, 'wb')
+    try:
+        json.dump(run, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+    return path
+
+
+def previous_run(results_dir, target):
+    """
+    Returns the most recent saved run against target, or None
+    """
+    if not os.path.isdir(results_dir):
+        return None
+    names = sorted(name for name in os.listdir(results_dir) if name.endswith('-%s.json' % _safe(target)))
+    if not names:
+        return None
+    f = open(os.path.join(results_dir, names[-1]), 'rb')
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+
+def print_run(run, previous=None):
+    """
+    Prints a run's summary, next to the previous run's figures when there is one
+    """
+    summary = run['summary']
+    before = previous['summary'] if previous else None
+    print(_yellow("%s: %d requests, %d concurrent, %.2fs" % (run['target'], summary['requests'],
+                                                            run['concurrency'], summary['elapsed'])))
+
+    def line(name, value, old, unit):
+        text = "  %-12s %10s %s" % (name, value if value is not None else '-', unit)
+        if old is not None and value is not None:
+            text += "   (was %s)" % old
+        print(text)
+
+    line("throughput", summary['throughput'], before and before['throughput'], "req/s")
+    for key in ['p50', 'p95', 'p99', 'max']:
+        line(key, summary['latency_ms'][key], before and before['latency_ms'][key], "ms")
+    colour = _red if summary['errors'] else _green
+    print(colour("  %-12s %10s %%   %s" % ("errors", round(summary['error_rate'] * 100, 2),
+                                         ", ".join("%s: %d" % item for item in sorted(summary['statuses'].items())))))
+
+
+@contextmanager
+def serve_stub(config_path, port, app_dir, gunicorn='gunicorn', timeout=30):
+    """
+    Runs stub_app under gunicorn locally with the gunicorn config at config_path, bound to 127.0.0.1:port
+    instead of the config's unix socket, until the with block ends. Needs gunicorn installed locally
+    """
+    try:
+        process = subprocess.Popen([gunicorn, '--config', config_path, '--bind', '127.0.0.1:%d' % port,
+                                    '--chdir', app_dir, 'stub_app:application'])
+    except OSError as e:
+        raise Exception("Could not start %s, is gunicorn installed locally? %s" % (gunicorn, e))
+    try:
+        def listening():
+            if process.poll() is not None:
+                raise Exception("gunicorn exited with %d" % process.returncode)
+            try:
+                socket.create_connection(('127.0.0.1', port), 1).close()
+                return True
+            except socket.error:
+                return False
+
+        poll(listening, timeout, "gunicorn on port %d" % port, initial=0.1, maximum=1.0)
+        yield
+    finally:
+        if process.poll() is None:
+            process.terminate()
+            process.wait()
+
+
+def _safe(target):
+    return ''.join(c if c.isalnum() or c in '.-' else '_' for c in target)
@@ -0,0 +1,121 @@
+"""
+--------------------------------------------------------------------------------------
+cache.py
+--------------------------------------------------------------------------------------
+Sizes memcached for an instance, builds Django's CACHES setting for it or for an
+ElastiCache cluster, and reads the hit and miss counts back from memcached's stats.
+
+Stats are read over bash's /dev/tcp on the servers, so nothing has to be installed to
+ask for them. For an ElastiCache cluster the nodes are found from its configuration
+endpoint with "config get cluster", the same way django-elasticache finds them.
+"""
+from fabric.colors import green as _green, yellow as _yellow, red as _red
+
+from batch import quote
+
+# Bytes each memcached connection costs in buffers, roughly
+CONNECTION_BYTES = 10 * 1024
+
+
+def memcached_settings(cpus, memory_mb, percent, memory_override=None, connections_override=None):
+    """
+    Returns the memcached memory in MiB, connection limit and threads for a host with cpus and memory_mb.
+    memcached gets percent of the memory, at least 64 MiB, and enough connections to use a tenth of that on
+    connection buffers, at least 1024, and a thread per CPU
+    """
+    memory = int(memory_override or max(64, memory_mb * percent // 100))
+    connections = int(connections_override or max(1024, memory * 1024 * 1024 // 10 // CONNECTION_BYTES))
+    return {
+        'MEMCACHED_MEMORY_MB': memory,
+        'MEMCACHED_CONNECTIONS': connections,
+        'MEMCACHED_THREADS': max(1, cpus),
+    }
+
+
+def caches_setting(endpoint, listen, port, key_prefix, timeout):
+    """
+    Returns Django's CACHES setting for the ElastiCache configuration endpoint, host:port, or for the memcached
+    on each server when there is none
+    """
+    if endpoint:
+        default = {'BACKEND': 'django_elasticache.memcached.ElastiCache', 'LOCATION': endpoint}
+    else:
+        default = {'BACKEND': 'django.core.cache.backends.memcached.PyLibMCCache',
+                   'LOCATION': '%s:%d' % (listen, port)}
+    default.update(KEY_PREFIX=key_prefix, TIMEOUT=timeout)
+    return {'default': default}
+
+
+def query_command(host, port, query):
+    """
+    Returns a shell command that sends query to the memcached at host:port and prints the reply
+    """
+    script = 'exec 3<>/dev/tcp/%s/%d && printf %s >&3 && cat <&3' % (host, int(port), quote(query + '\\r\\nquit\\r\\n'))
+    return 'timeout 10 bash -c %s' % quote(script)
+
+
+def parse_stats(output):
+    """
+    Returns the STAT lines of a stats reply as {name: value}, with numbers as ints or floats
+    """
+    stats = {}
+    for line in output.splitlines():
+        words = line.strip().split()
+        if len(words) == 3 and words[0] == 'STAT':
+            stats[words[1]] = _number(words[2])
+    return stats
+
+
+def cluster_nodes(output):
+    """
+    Returns the (host, port) of each node in a "config get cluster" reply
+    """
+    nodes = []
+    for line in output.splitlines():
+        for word in line.split():
+            parts = word.split('|')
+            if len(parts) == 3:
+                nodes.append((parts[0] or parts[1], int(parts[2])))
+    return nodes
+
+
+def hit_ratio(stats):
+    """
+    The share of gets that found their key, or None before any gets
+    """
+    gets = stats.get('get_hits', 0) + stats.get('get_misses', 0)
+    return float(stats.get('get_hits', 0)) / gets if gets else None
+
+
+def print_stats(rows):
+    """
+    Prints the hits, misses, hit ratio, evictions, fill and connections of each (name, stats) row, and the
+    hit ratio over all of them
+    """
+    print(_yellow("  %-40s %12s %12s %7s %10s %6s %12s" % ("memcached", "hits", "misses", "ratio", "evictions",
+                                                          "full", "connections")))
+    hits = misses = 0
+    for name, stats in rows:
+        if not stats:
+            print(_red("  %-40s no stats" % name[:40]))
+            continue
+        ratio = hit_ratio(stats)
+        hits += stats.get('get_hits', 0)
+        misses += stats.get('get_misses', 0)
+        full = 100.0 * stats.get('bytes', 0) / stats['limit_maxbytes'] if stats.get('limit_maxbytes') else 0
+        colour = _green if ratio is None or ratio >= 0.8 else _yellow
+        print(colour("  %-40s %12d %12d %7s %10d %5.1f%% %12s" % (
+            name[:40], stats.get('get_hits', 0), stats.get('get_misses', 0),
+            '-' if ratio is None else '%.1f%%' % (ratio * 100), stats.get('evictions', 0), full,
+            '%d/%s' % (stats.get('curr_connections', 0), stats.get('max_connections', '-')))))
+    if hits + misses:
+        print(_yellow("  Overall hit ratio %.1f%% over %d gets" % (100.0 * hits / (hits + misses), hits + misses)))
+
+
+def _number(value):
+    for kind in (int, float):
+        try:
+            return kind(value)
+        except ValueError:
+            pass
+    return value
@@ -0,0 +1,74 @@
+"""
+--------------------------------------------------------------------------------------
+connections.py
+--------------------------------------------------------------------------------------
+Keeps one SSH session per host open across tasks for the ssh processes the fabfile
+starts itself, such as rsync and aws_ssh.py.
+
+The first ssh to a host becomes an OpenSSH ControlMaster listening on a socket in a
+local control directory, and stays up for ControlPersist after its last user exits.
+Every later ssh to the host, from the same task or the next one, runs as a new channel
+on that session, skipping the TCP and key exchange handshakes.
+"""
+import os
+import re
+import subprocess
+
+from batch import quote
+
+
+def ssh_options(control_dir, persist):
+    """
+    Returns the ssh arguments that share a session per host through sockets in control_dir, kept open for
+    persist (eg "10m") after they were last used. They never prompt, so they are safe in forked workers. The key of
+    a new host is added to known_hosts, and a host whose key has changed is refused
+    """
+    # %C is a hash of the user, host and port, as those spelled out overrun the 108 byte limit on a socket's path
+    # for an EC2 host name
+    return ['-o', 'ControlMaster=auto', '-o', 'ControlPath=%s' % os.path.join(control_dir, '%C'),
+            '-o', 'ControlPersist=%s' % persist, '-o', 'ServerAliveInterval=30', '-o', 'BatchMode=yes',
+            '-o', 'StrictHostKeyChecking=accept-new']
+
+
+def ssh_command(user, key_filename, control_dir, persist):
+    """
+    Returns the ssh command, without a host, that logs in as user with key_filename over the shared sessions.
+    Creates control_dir if needed
+    """
+    control_dir = os.path.expanduser(control_dir)
+    try:
+        os.makedirs(control_dir, 0700)
+    except OSError:
+        # Already there, perhaps made by another worker
+        if not os.path.isdir(control_dir):
+            raise
+    return ['ssh', '-i', os.path.expanduser(key_filename), '-l', user] + ssh_options(control_dir, persist)
+
+
+def shell_command(command):
+    """
+    Joins a command for a shell, eg for rsync -e, quoting the words that need it
+    """
+    return ' '.join(arg if re.match(r'^[\w@%+=:,./-]+$', arg) else quote(arg) for arg in command)
+
+
+def session_open(ssh, host):
+    """
+    Whether a shared session to host is open
+    """
+    return _control(ssh, host, 'check') == 0
+
+
+def close_session(ssh, host):
+    """
+    Closes the shared session to host, if there is one
+    """
+    return _control(ssh, host, 'exit') == 0
+
+
+def _control(ssh, host, action):
+    devnull = open(os.devnull, 'wb')
+    try:
+        return subprocess.call(ssh + ['-O', action, host], stdout=devnull, stderr=devnull)
+    finally:
+        devnull.close()
@@ -22,43 +22,188 @@ Commands include:
         - Spawns a new EC2 instance (as defined in project_conf.py) and returns it's public dns
           This takes around 8 minutes to complete.
 
+    - fab spawn_fleet:count=N
+        - Launches N instances in one reservation and provisions them in parallel. The new hosts are written to
+          the generated inventory file (fabconf['INVENTORY_PATH']), which every other command reads along with
+          fabconf['EC2_INSTANCES']. With fabconf['HOSTS_FROM_TAGS'] every command works on the running instances
+          tagged fabconf['INSTANCE_NAME_TAG'] instead
+
+    - fab create_load_balancer
+        - Creates the load balancer fabconf['ELB_NAME'] with a health check on fabconf['HEALTH_CHECK_PATH'] and
+          registers the servers with it. New servers are registered too, and deploy and rolling_deploy drain each
+          server from it before working on it. fab elb_status prints the health of its instances
+
+    - fab scale:capacity=N
+        - Sets the auto scaling group fabconf['ASG_NAME'] to N instances, creating it and its launch configuration
+          if needed. New instances are provisioned and registered with the load balancer, removed ones drained.
+          Only resize the group with it, as instances the group launches on its own are provisioned by the next run.
+          Needs fabconf['HOSTS_FROM_TAGS']
+
+    - fab bake_image
+        - Provisions a builder instance with the apt and pip packages and the virtualenv, and snapshots it into
+          an AMI keyed by a hash of the package lists. spawn instance boots from the newest matching image and
+          skips the steps baked into it. Use fab bake_image:force=yes to bake a new image anyway
+
+    - fab provision
+        - Re-converges the servers to the state spawn instance sets up. Each step records a fingerprint on the
+          server, so only steps that are missing or whose definition changed are applied. Use
+          fab provision:force="nginx;supervisor" to reapply named steps anyway
+
     - fab update_packages
         - Updates the python packages on the server to match those found in requirements/common.txt and
-          requirements/prod.txt
+          requirements/prod.txt. Skipped when they are unchanged since they were last installed, unless
+          fab update_packages:force=yes
 
     - fab deploy
-        - Pulls the latest commit from the master branch on the server, collects the static files, syncs the db and
-          restarts the server
+        - Builds a new release directory from the latest commit on the master branch, with its own virtualenv,
+          collects the static files, syncs the db, atomically switches the PROJECT_PATH symlink to it and reloads
+          gunicorn. The newest fabconf['KEEP_RELEASES'] releases are kept. collectstatic, syncdb and pip only run
+          when the files they depend on changed since the live commit, unless fab deploy:force=yes. The static
+          files are precompressed after collectstatic, and nginx serves them and the media with cache headers,
+          long ones for static files with hashed names. With fabconf['DEPLOY_PUSH'] the commit is rsynced from
+          the local repo instead of fetched from bitbucket
+
+    - fab rollback
+        - Switches back to the release before the current one and reloads gunicorn
+
+    - fab rolling_deploy:batch_size=N
+        - Deploys N servers at a time. Each batch reloads gunicorn gracefully with HUP and has to pass the health
+          check at fabconf['HEALTH_CHECK_PATH'] before the next batch starts
 
     - fab reload_gunicorn
-        - Pushes the gunicorn startup script to the servers and restarts the gunicorn process, use this if you
-          have made changes to templates/start_gunicorn.bash
+        - Pushes the gunicorn startup script and config to the servers and restarts the gunicorn process, use this
+          if you have made changes to templates/start_gunicorn.bash or templates/gunicorn.conf.py
 
     - fab reload_nginx
-        - Pushes the nginx config files to the servers and restarts the nginx, use this if you
-          have made changes to templates/nginx-app-proxy or templates/nginx.conf
+        - Pushes the nginx config files to the servers, checks them with nginx -t and reloads nginx gracefully
+          without dropping connections, use this if you have made changes to templates/nginx-app-proxy or
+          templates/nginx.conf. If the check fails the old config is put back. nginx keeps connections to gunicorn
+          open and can micro-cache anonymous responses, see fabconf['UPSTREAM_KEEPALIVE'] and fabconf['PROXY_CACHE']
+
+    - fab check_nginx
+        - Renders the nginx config files locally and checks their structure, without touching a server
 
     - fab reload_supervisor
         - Pushes the supervisor config files to the servers and restarts the supervisor, use this if you
           have made changes to templates/supervisord-init or templates/supervisord.conf
 
+        The reload commands only push the templates whose rendered contents changed and do nothing otherwise
+
+    - fab gunicorn_settings:instance_type=m3.large,profile=gthread
+        - Prints the gunicorn settings gunicorn.conf.py works out for an instance type from
+          fabconf['GUNICORN_PROFILE'] and the hardware, without touching a server
+
+    - fab pgbouncer_settings:instance_type=m3.large
+        - Prints the PgBouncer pool sizes for an instance type and the databases it pools, when fabconf['PGBOUNCER']
+          runs PgBouncer on each server in front of the Postgres databases in secrets.json
+
+    - fab system_settings:instance_type=c4.xlarge
+        - Prints the kernel backlog, port range, open file limits, swap and nginx worker settings the "system"
+          provisioning step and templates/nginx.conf use for an instance type, without touching a server
+
+    - fab render_templates:output_dir=/tmp/rendered
+        - Renders all the templates locally into fabconf['RENDERED_DIR'] or output_dir, without touching a server
+
+    - fab benchmark:requests=5000,concurrency=50
+        - Sends concurrent requests to fabconf['BENCHMARK_PATH'] on each host and prints the throughput, the
+          p50/p95/p99 latency and the error rate next to the previous run's. Each run is saved as JSON in
+          fabconf['BENCHMARK_DIR']. Use duration=60 to run for a minute instead, and local=yes to benchmark
+          stub_app.py served locally by the rendered gunicorn config, which needs gunicorn installed locally
+
+    - fab sync_static
+        - With fabconf['S3_STATIC'], runs collectstatic once locally with hashed names, uploads the new and changed
+          files to fabconf['S3_STATIC_BUCKET'] in parallel and gives each server the manifest. deploy does this
+          first and then skips collectstatic on the servers
+
+    - fab analyze_logs
+        - Streams the nginx access logs from the servers in parallel and reports the endpoints that take the most
+          time, with their latency percentiles, and the slowest requests. local_files="logs/*.log" reads local logs
+
+    - fab fleet_stats:interval=10,csv_file=fleet.csv
+        - Shows the CPU, load, memory, the memory of gunicorn, nginx, memcached and PgBouncer and their connections
+          on every server as a table refreshed until Ctrl-C, optionally saving the samples as CSV or JSON
+
+    - fab ssh_sessions:close=yes
+        - Lists, or closes, the SSH sessions to the servers that rsync and aws_ssh.py share and keep open across
+          tasks, see fabconf['SSH_CONTROL_DIR']
+
+    - fab cache_stats
+        - Prints the hit ratio, evictions, fill and connections of the memcached on each server, or of the nodes
+          of the ElastiCache cluster at fabconf['ELASTICACHE_ENDPOINT']
+
     - fab manage:command="management command"
         - Runs a python manage.py command on the server. To run this command we need to specify an argument, eg for
           syncdb type the command -> fab manage:command="syncdb --no-input"
+
+    deploy, update_packages, reload_*, sync_static, analyze_logs, cache_stats and manage accept pool_size and
+    fail_fast arguments, eg fab deploy:pool_size=10,fail_fast=no works on 10 hosts at a time and carries on past
+    failed hosts. Each prints a per-host summary of timings and failures when it finishes.
+
+    Python packages are installed from a wheelhouse of wheels built once for the requirements, see wheelhouse.py
+
+    The tasks that work on servers write a trace of every command, upload, boto call and batch step to
+    fabconf['TRACE_DIR'] and print the slowest steps when they finish, see tracing.py
 """
 import os
+import sys
 import json
 import StringIO
 
-from fabric.api import run, sudo, env, put, settings, cd
-from fabric.colors import green as _green, yellow as _yellow
+from fabric.api import env, settings, cd, runs_once, local
+from fabric.network import normalize
+from fabric.colors import green as _green, yellow as _yellow, red as _red
+from fabric.utils import puts
 from project_conf import fabconf, ec2_region, ec2_keypair, ec2_secgroups, ec2_instancetype, ec2_amis
 import boto
 import boto.ec2
+import boto.ec2.elb
+import boto.ec2.autoscale
 import time
 
 from gen_secret import gen_secret
 from write_secrets import write_secrets
+from batch import Batch as _Batch, print_timings as _print_timings, quote as _quote
+from resources import Resource as _Resource, converge as _converge
+from images import image_key as _image_key, bake as _bake, boot_image as _boot_image
+from readiness import Phases as _Phases, wait_for_running as _wait_for_running, wait_for_ssh as _wait_for_ssh
+from inventory import inventory_hosts as _inventory_hosts, add_to_inventory as _add_to_inventory
+from multihost import run_on_hosts as _run_on_hosts, print_summary as _print_summary, failed as _failed
+from rendering import Template as _Template, render_templates as _render_templates, \
+    sync_templates as _sync_rendered, changed_templates as _changed_templates, install_steps as _install_steps
+from hardware import instance_hardware as _lookup_hardware
+from tuning import system_settings as _system_settings
+from assets import precompress_command as _precompress_command
+from cache import memcached_settings as _memcached_settings, caches_setting as _caches_setting, \
+    query_command as _memcached_query, parse_stats as _parse_memcached_stats, cluster_nodes as _cluster_nodes, \
+    print_stats as _print_memcached_stats
+from pgbouncer import pool_sizes as _pgbouncer_pool_sizes, pooled_databases as _pooled_databases, \
+    userlist as _pgbouncer_userlist
+from static_sync import collectstatic_command as _collectstatic_command, sync as _sync_s3_static, \
+    MANIFEST as _STATIC_MANIFEST
+from connections import ssh_command as _ssh_command, shell_command as _shell_command, \
+    session_open as _session_open, close_session as _close_session
+from push import export_command as _export_command, rsync_command as _rsync_command, rsync_stats as _rsync_stats, \
+    changed_command as _changed_command, REVISION as _REVISION
+from logs import analyze as _analyze_log_lines, merge as _merge_log_summaries, local_lines as _local_log_lines, \
+    remote_lines as _remote_log_lines, print_report as _print_log_report
+from scaling import tagged_instances as _tagged_instances, instance_ids as _instance_ids, \
+    ensure_load_balancer as _ensure_load_balancer, instance_health as _instance_health, register as _register, \
+    drain as _drain, out_of_service as _out_of_service, launch_configuration_name as _launch_configuration_name, \
+    ensure_launch_configuration as _ensure_launch_configuration, ensure_group as _ensure_group, surplus as _surplus, \
+    wait_for_capacity as _wait_for_capacity, provisioned as _provisioned, mark_provisioned as _tag_provisioned, \
+    PROVISIONED_TAG as _PROVISIONED_TAG, UNPROVISIONED as _UNPROVISIONED
+from fleet import sample_host as _sample_fleet_host, print_table as _print_fleet_table, \
+    write_csv as _write_fleet_csv, write_json as _write_fleet_json
+from nginx import lint as _nginx_lint, snapshot_steps as _nginx_snapshot_steps, apply_steps as _nginx_apply_steps
+from tracing import run as _run, sudo as _sudo, put as _upload, get as _download, span as _span, \
+    traced_task as _traced_task, TracedConnection as _TracedConnection
+from benchmark import run_load as _run_load, summarize as _summarize, save_run as _save_run, \
+    previous_run as _previous_run, print_run as _print_run, serve_stub as _serve_stub
+from wheelhouse import requirement_files as _requirement_files, wheelhouse_key as _wheelhouse_key, \
+    key_command as _wheelhouse_key_command, pip_install as _pip_install, sync_wheelhouse as _sync_wheelhouse
+
+# Each run of the tasks decorated with this is traced, see tracing.py
+_traced = _traced_task(fabconf['TRACE_DIR'], fabconf['TRACE_SLOWEST'])
 
 # AWS user credentials
 env.user = fabconf['SERVER_USERNAME']
@@ -76,6 +221,7 @@ def spawn():
     env.hosts = []
 
 
+@_traced
 def instance():
     """
     Creates an EC2 instance from an Ubuntu AMI and configures it as a Django server
@@ -83,138 +229,30 @@ def instance():
     """
     # Record the starting time and print a starting message
     start_time = time.time()
+    phases = _Phases()
     print(_green("Started..."))
 
-    # Use boto to create an EC2 instance
-    env.host_string = _create_ec2_instance()
-    print(_green("Waiting 30 seconds for server to boot..."))
-    time.sleep(30)
-
-    # First command as regular user
-    run('whoami')
+    # The servers already running share a SECRET_KEY, so sessions and signed data work whichever one answers.
+    # It is read before launching, while they are the only servers with the Name tag
+    secret_key = _fleet_secret_key(_all_hosts())
 
-    # Sudo apt-get update
-    print(_yellow("Updating apt-get"))
-    sudo("apt-get update -qq")
-
-    # List of APT packages to install
-    print(_yellow("Installing apt-get packages"))
-    _apt(["libpq-dev", "nginx", "memcached", "git", "python-setuptools", "python-dev", "build-essential",
-          "python-pip", "libmemcached-dev"])
-
-    # List of pypi packages to install
-    print(_yellow("Installing pip packages"))
-    _pip(["virtualenv", "virtualenvwrapper", "supervisor"])
-
-    # Add AWS credentials to the a config file so that boto can access S3
-    _put_template({"template": "%(FAB_CONFIG_PATH)s/templates/boto.cfg",
-                   "destination": "/home/%(SERVER_USERNAME)s/boto.cfg"})
-    sudo(_r("mv /home/%(SERVER_USERNAME)s/boto.cfg /etc/boto.cfg"))
-
-    # virtualenvwrapper
-    print(_yellow("Configuring virtualenvwrapper"))
-    sudo(_r("mkdir %(VIRTUALENV_DIR)s"))
-    sudo(_r("chown -R %(SERVER_USERNAME)s: %(VIRTUALENV_DIR)s"))
-    run(_r("echo 'export WORKON_HOME=%(VIRTUALENV_DIR)s' >> /home/%(SERVER_USERNAME)s/.profile"))
-    run(_r("echo 'source /usr/local/bin/virtualenvwrapper.sh' >> /home/%(SERVER_USERNAME)s/.profile"))
-    run(_r("source /home/%(SERVER_USERNAME)s/.profile"))
+    # Use boto to create an EC2 instance
+    env.host_string = _create_ec2_instance(phases=phases)
 
-    # webapps alias
-    print(_yellow("Creating webapps alias"))
-    run(_r("""echo "alias webapps='cd %(APPS_DIR)s'" >> /home/%(SERVER_USERNAME)s/.profile"""))
-
-    # webapps dir
-    print(_yellow("Creating webapps directory"))
-    sudo(_r("mkdir %(APPS_DIR)s"))
-    sudo(_r("chown -R %(SERVER_USERNAME)s: %(APPS_DIR)s"))
-
-    # git setup
-    print(_yellow("Configuring git"))
-    run(_r("git config --global user.name '%(GIT_USERNAME)s'"))
-    run(_r("git config --global user.email '%(ADMIN_EMAIL)s'"))
-    put(_r("%(BITBUCKET_DEPLOY_KEY_PATH)s"), _r("/home/%(SERVER_USERNAME)s/.ssh/%(BITBUCKET_DEPLOY_KEY_NAME)s"))
-    run(_r("chmod 600 /home/%(SERVER_USERNAME)s/.ssh/%(BITBUCKET_DEPLOY_KEY_NAME)s"))
-    run(_r("echo 'IdentityFile /home/%(SERVER_USERNAME)s/.ssh/%(BITBUCKET_DEPLOY_KEY_NAME)s' >> "
-           "/home/%(SERVER_USERNAME)s/.ssh/config"))
-    run(_r("ssh-keyscan bitbucket.org >> /home/%(SERVER_USERNAME)s/.ssh/known_hosts"))
-
-    # Create virtualenv
-    print(_yellow("Creating virtualenv"))
-    run(_r("mkvirtualenv --no-site-packages %(PROJECT_NAME)s"))
-
-    # Install django in virtualenv
-    print(_yellow("Installing django"))
-    _virtualenv("pip install Django")
-
-    # Install psycopg2 drivers for Postgres
-    print(_yellow("Installing psycopg2"))
-    _virtualenv("pip install psycopg2")
-
-    # Install gunicorn in virtualenv
-    print(_yellow("Installing gunicorn"))
-    _virtualenv("pip install gunicorn")
-
-    # Install django cache
-    _virtualenv("pip install pylibmc")
-    _virtualenv("pip install django-elasticache")
-    _virtualenv("pip install boto")
-    _virtualenv("pip install django-storages")
-
-    # Clone the git repo
-    run(_r("git clone %(BITBUCKET_REPO)s %(PROJECT_PATH)s"))
-    put(_r("%(FAB_CONFIG_PATH)s/templates/gunicorn.conf.py"), _r("%(PROJECT_PATH)s/gunicorn.conf.py"))
-
-    # Create run and log dirs for the gunicorn socket and logs
-    run(_r("mkdir %(PROJECT_PATH)s/logs"))
-
-    # Add gunicorn startup script to project folder
-    _put_template({"template": "%(FAB_CONFIG_PATH)s/templates/start_gunicorn.bash",
-                   "destination": "%(PROJECT_PATH)s/start_gunicorn.bash"})
-    sudo(_r("chmod +x %(PROJECT_PATH)s/start_gunicorn.bash"))
-
-    # Install the requirements from the pip requirements files
-    _virtualenv("pip install -r %(PROJECT_PATH)s/requirements/production.txt --upgrade")
-
-    # nginx
-    print(_yellow("Configuring nginx"))
-    put(_r("%(FAB_CONFIG_PATH)s/templates/nginx.conf"), _r("/home/%(SERVER_USERNAME)s/nginx.conf"))
-    sudo("mv /etc/nginx/nginx.conf /etc/nginx/nginx.conf.old")
-    sudo(_r("mv /home/%(SERVER_USERNAME)s/nginx.conf /etc/nginx/nginx.conf"))
-    sudo("chown root:root /etc/nginx/nginx.conf")
-    _put_template({"template": "%(FAB_CONFIG_PATH)s/templates/nginx-app-proxy",
-                   "destination": "/home/%(SERVER_USERNAME)s/%(PROJECT_NAME)s"})
-    sudo("rm -rf /etc/nginx/sites-enabled/default")
-    sudo(_r("mv /home/%(SERVER_USERNAME)s/%(PROJECT_NAME)s /etc/nginx/sites-available/%(PROJECT_NAME)s"))
-    sudo(_r("ln -s /etc/nginx/sites-available/%(PROJECT_NAME)s /etc/nginx/sites-enabled/%(PROJECT_NAME)s"))
-    sudo(_r("chown root:root /etc/nginx/sites-available/%(PROJECT_NAME)s"))
-
-    # Setup secrets for Django
-    update_secrets(new_secret=True)
-
-    print(_yellow("Restarting nginx"))
-    sudo("/etc/init.d/nginx restart")
-
-    # Run collectstatic and syncdb
-    _virtualenv("python %(MANAGEPY_PATH)s/manage.py collectstatic -v 0 --noinput")
-    _virtualenv("python %(MANAGEPY_PATH)s/manage.py syncdb")
-
-    # Setup supervisor
-    print(_yellow("Configuring supervisor"))
-    run(_r("echo_supervisord_conf > /home/%(SERVER_USERNAME)s/supervisord.conf"))
-    _put_template({"template": "%(FAB_CONFIG_PATH)s/templates/supervisord.conf",
-                   "destination": "/home/%(SERVER_USERNAME)s/my.supervisord.conf"})
-    run(_r("cat /home/%(SERVER_USERNAME)s/my.supervisord.conf >> /home/%(SERVER_USERNAME)s/supervisord.conf"))
-    run(_r("rm /home/%(SERVER_USERNAME)s/my.supervisord.conf"))
-    sudo(_r("mv /home/%(SERVER_USERNAME)s/supervisord.conf /etc/supervisord.conf"))
-    sudo("supervisord")
-    put(_r("%(FAB_CONFIG_PATH)s/templates/supervisord-init"), _r("/home/%(SERVER_USERNAME)s/supervisord-init"))
-    sudo(_r("mv /home/%(SERVER_USERNAME)s/supervisord-init /etc/init.d/supervisord"))
-    sudo("chmod +x /etc/init.d/supervisord")
-    sudo("update-rc.d supervisord defaults")
+    # Wait until we can log in and bring the server to the state described by _resources()
+    with phases.phase("Provisioning"):
+        _provision_new(secret_key)
+    _mark_provisioned([env.host_string])
+    _register_hosts([env.host_string])
 
     # Print out the final runtime and the public dns of the new instance
     end_time = time.time()
+    phases.print_summary()
     print(_green("Runtime: %f minutes" % ((end_time - start_time) / 60)))
+    if fabconf['HOSTS_FROM_TAGS']:
+        # check_hosts() finds it by its Name tag
+        print(_green(env.host_string))
+        return
     print(_green("\nPLEASE ADD ADDRESS THIS TO YOUR ")),
     print(_yellow("project_conf.py")),
     print(_green(" FILE UNDER ")),
@@ -222,127 +260,372 @@ def instance():
     print(_green(env.host_string))
 
 
-def deploy():
+@runs_once
+@_traced
+def spawn_fleet(count=2, pool_size=None, fail_fast=None):
+    """
+    Launches count instances in one reservation, waits for them and provisions them in parallel. The hosts
+    that provision cleanly are tagged as provisioned, which is how check_hosts() finds them with
+    fabconf['HOSTS_FROM_TAGS']. They are also added to the inventory file, which check_hosts() reads along with
+    fabconf['EC2_INSTANCES'] otherwise
+    """
+    start_time = time.time()
+    count = int(count)
+    phases = _Phases()
+
+    # One SECRET_KEY for the whole fleet, the running servers' if there are any, so sessions and signed data work
+    # whichever server answers. It is read before launching, while they are the only servers with the Name tag
+    secret_key = _fleet_secret_key(_all_hosts())
+
+    conn = _ec2_connection()
+    ami = _boot_ami(conn)
+    instances = _launch_ec2_instances(conn, ami, count, phases)
+    instance_ids = dict((i.public_dns_name, i.id) for i in instances)
+
+    with phases.phase("Provisioning"):
+        results = _run_on_hosts(lambda: _provision_new(secret_key), [i.public_dns_name for i in instances],
+                                pool_size=int(pool_size or count),
+                                fail_fast=_as_bool(fabconf['FAIL_FAST'] if fail_fast is None else fail_fast))
+    _print_summary(results, "Provisioning")
+
+    ready = [(result.host, instance_ids[result.host]) for result in results if result.ok]
+    _add_to_inventory(fabconf['INVENTORY_PATH'], ready)
+    print(_green("Added %d host(s) to %s" % (len(ready), fabconf['INVENTORY_PATH'])))
+    _mark_provisioned([host for host, instance_id in ready])
+    _register_hosts([host for host, instance_id in ready])
+
+    phases.print_summary()
+    print(_green("Runtime: %f minutes" % ((time.time() - start_time) / 60)))
+
+    failures = _failed(results)
+    if failures:
+        raise Exception("%d of %d new instances failed to provision and were left running: %s" % (
+            len(failures), len(results), ", ".join(["%s (%s)" % (f.host, instance_ids[f.host]) for f in failures])))
+
+
+def _provision_new(secret_key=None):
+    _wait_for_ssh(env.host_string, fabconf['SSH_TIMEOUT'])
+    _run('whoami')
+    return _provision(secret_key=secret_key)
+
+
+@runs_once
+@_traced
+def provision(force='', pool_size=None, fail_fast=None):
+    """
+    Re-converges existing servers to the state instance() sets up, applying only what is missing or has
+    changed. force is a semicolon separated list of resources to apply regardless, eg force="nginx;supervisor"
+    """
+    start = check_hosts()
+    print(_yellow("Provisioning servers..."))
+    _on_hosts(lambda: _provision([name for name in force.split(';') if name]), pool_size, fail_fast)
+
+    time_diff = time.time() - start
+    print(_yellow("Finished provisioning in %.2fs" % time_diff))
+
+
+def _provision(force=(), secret_key=None):
+    applied, timings = _converge(_resources(secret_key), fabconf['STATE_DIR'], force=force)
+    _print_timings(timings)
+    return applied
+
+
+@runs_once
+@_traced
+def bake_image(force=False):
+    """
+    Provisions a builder instance from the base AMI with the project independent resources and snapshots it
+    into an AMI that instance() then boots from. Does nothing if an image for the current packages exists,
+    unless force is set
+    """
+    start_time = time.time()
+    conn = _ec2_connection()
+    baked = _baked_resources()
+
+    def provision(builder):
+        env.host_string = builder.public_dns_name
+        _wait_for_ssh(env.host_string, fabconf['SSH_TIMEOUT'])
+        _run('whoami')
+        applied, timings = _converge(baked, fabconf['STATE_DIR'])
+        _print_timings(timings)
+
+    # The builder is tagged apart from the servers, so check_hosts() never picks it up
+    image_id = _bake(conn, _image_key(ec2_amis[0], baked),
+                     lambda: _launch_ec2_instance(conn, ec2_amis[0], name="%s-builder" % fabconf['INSTANCE_NAME_TAG']),
+                     provision, fabconf['INSTANCE_NAME_TAG'], force=_as_bool(force))
+    print(_green("Image %s ready in %f minutes" % (image_id, (time.time() - start_time) / 60)))
+    return image_id
+
+
+@runs_once
+@_traced
+def deploy(force=False, pool_size=None, fail_fast=None):
     """
     Pulls the latest commit from bitbucket, rsyncs the database, collects the static files and restarts the
-    server.
+    server. collectstatic, syncdb and pip are skipped when nothing they depend on changed, unless force=yes
     """
     start = check_hosts()
+    force = _as_bool(force)
+    if fabconf['S3_STATIC']:
+        _sync_static()
+    commit = _export_release() if fabconf['DEPLOY_PUSH'] else None
+    balanced = _balanced_instances(pool_size)
     print(_yellow("Updating server to latest commit in the bitbucket repo..."))
+    _on_hosts(lambda: _out_of_rotation(balanced, lambda: _deploy(force, commit)), pool_size, fail_fast)
 
-    # Pull the latest version from the bitbucket repo
-    run(_r("cd %(PROJECT_PATH)s && git pull"))
+    time_diff = time.time() - start
+    print(_yellow("Finished updating the server in %.2fs" % time_diff))
 
-    # Update the database
-    _virtualenv("python %(MANAGEPY_PATH)s/manage.py collectstatic -v 0 --noinput")
-    _virtualenv("python %(MANAGEPY_PATH)s/manage.py syncdb")
 
-    # Restart gunicorn to update the site
-    sudo(_r("supervisorctl restart %(PROJECT_NAME)s"))
+def _deploy(force=False, commit=None):
+    # Build a new release from the latest commit next to the live one, then switch to it and prune old ones.
+    # The whole deploy goes to the server as one script. With a commit exported by _export_release the code is
+    # rsynced from here rather than fetched from bitbucket
+    _push_wheelhouse()
+    if fabconf['S3_STATIC']:
+        _push_static_manifest()
+    changed = _push_release(commit) if commit else None
+    puts(_yellow("Building release from latest commit"))
+    with _Batch() as batch:
+        _migrate_to_releases_steps(batch)
+        gunicorn_changed = _sync_templates(batch, "gunicorn")
+        _release_steps(batch, manage=True, force=force, pushed=bool(commit), changed=changed)
+        _switch_steps(batch, reload=True, restart=bool(gunicorn_changed))
+        _prune_steps(batch)
+    if batch.skipped:
+        puts(_green("Skipped, nothing they depend on changed: %s" % ", ".join(batch.skipped)))
+
+
+@runs_once
+@_traced
+def rollback(pool_size=None, fail_fast=None):
+    """
+    Switches the servers back to the release before the current one and reloads gunicorn
+    """
+    start = check_hosts()
+    print(_yellow("Rolling back to the previous release..."))
+    _on_hosts(_rollback, pool_size, fail_fast)
 
     time_diff = time.time() - start
-    print(_yellow("Finished updating the server in %.2fs" % time_diff))
+    print(_yellow("Finished rolling back in %.2fs" % time_diff))
 
 
-def update_packages():
+def _rollback():
+    with _Batch() as batch:
+        batch.run(_r('cd %(RELEASES_DIR)s && current=$(basename $(readlink %(PROJECT_PATH)s)) && '
+                     'release=$(ls -1 | sort | grep -B1 -xF "$current" | head -n 1) && '
+                     'release_path=%(RELEASES_DIR)s/$release && test "$release" != "$current"'),
+                  label="Finding the release before the current one")
+        _switch_steps(batch, reload=True)
+
+
+@runs_once
+@_traced
+def rolling_deploy(batch_size=None):
+    """
+    Deploys to the servers a batch at a time, eg fab rolling_deploy:batch_size=2. Each batch reloads gunicorn
+    gracefully and must pass the health check before the next batch starts, so at most one batch of servers
+    is ever out of step
+    """
+    start = check_hosts()
+    batch_size = int(batch_size or fabconf['ROLLING_BATCH_SIZE'])
+    if fabconf['S3_STATIC']:
+        _sync_static()
+    commit = _export_release() if fabconf['DEPLOY_PUSH'] else None
+    balanced = _balanced_instances(batch_size)
+    hosts = list(env.hosts)
+    batches = [hosts[i:i + batch_size] for i in range(0, len(hosts), batch_size)]
+
+    for number, batch in enumerate(batches):
+        print(_yellow("Deploying batch %d of %d: %s" % (number + 1, len(batches), ", ".join(batch))))
+        try:
+            _on_hosts(lambda: _out_of_rotation(balanced, lambda: _rolling_deploy(commit)), pool_size=len(batch),
+                      fail_fast=True, hosts=batch)
+        except Exception:
+            print(_red("Stopped at batch %d of %d, these hosts were not deployed: %s" % (
+                number + 1, len(batches), ", ".join(sum(batches[number + 1:], [])) or "none")))
+            raise
+
+    time_diff = time.time() - start
+    print(_yellow("Finished rolling deploy in %.2fs" % time_diff))
+
+
+def _rolling_deploy(commit=None):
+    _deploy(commit=commit)
+    _wait_until_healthy()
+
+
+@runs_once
+@_traced
+def update_packages(force=False, pool_size=None, fail_fast=None):
     """
     Updates the python packages on the server as defined in requirements/common.txt and 
-    requirements/prod.txt
+    requirements/prod.txt. Skipped when the requirements files have not changed since they were last
+    installed, unless force=yes
     """
     start = check_hosts()
+    force = _as_bool(force)
     print(_yellow("Updating server packages with pip..."))
-
-    # Updates the python packages
-    _virtualenv("pip install -r %(PROJECT_PATH)s/requirements/common.txt --upgrade")
-    _virtualenv("pip install -r %(PROJECT_PATH)s/requirements/prod.txt --upgrade")
+    _on_hosts(lambda: _update_packages(force), pool_size, fail_fast)
 
     time_diff = time.time() - start
     print(_yellow("Finished updating python packages in %.2fs" % time_diff))
 
 
-def reload_nginx():
+def _update_packages(force=False):
+    # Updates the python packages, unless the requirements hash the virtualenv was last installed from matches
+    _push_wheelhouse()
+    with _Batch() as batch:
+        batch.run(_r("requirements=$(cat %(PROJECT_PATH)s/requirements/*.txt | sha1sum | cut -c1-12)"))
+        batch.run(_r("wheels=%(WHEELHOUSE_DIR)s/") + _wheelhouse_key_command(
+            VIRTUALENV_PACKAGES, _r("%(PROJECT_PATH)s/requirements"), fabconf['WHEEL_REQUIREMENTS']))
+        when = None if force else _r('test "$requirements" != "$(cat %(PROJECT_PATH)s/venv/.requirements '
+                                     '2>/dev/null)"')
+        batch.run(_r("source %(PROJECT_PATH)s/venv/bin/activate && ") +
+                  _pip_install("pip", _r("-r %(PROJECT_PATH)s/requirements/common.txt --upgrade"), "$wheels") +
+                  " && " +
+                  _pip_install("pip", _r("-r %(PROJECT_PATH)s/requirements/prod.txt --upgrade"), "$wheels") +
+                  _r(" && echo $requirements > %(PROJECT_PATH)s/venv/.requirements"), label="pip install", when=when)
+    if batch.skipped:
+        puts(_green("Skipped pip install, the requirements have not changed"))
+
+
+@runs_once
+@_traced
+def reload_nginx(pool_size=None, fail_fast=None):
     """
-    Reloads the nginx config files and restarts nginx
+    Pushes the nginx config files that changed, validates them with nginx -t and reloads nginx gracefully. A
+    config that fails validation is rolled back and nginx keeps running on the old one
     """
     start = check_hosts()
     print(_yellow("Reloading the nginx config files..."))
-
-    # Stop old nginx process
-    sudo("service nginx stop")
-
-    # Load the nginx config files
-    print(_yellow("Configuring nginx"))
-    put(_r("%(FAB_CONFIG_PATH)s/templates/nginx.conf"), _r("/home/%(SERVER_USERNAME)s/nginx.conf"))
-    sudo("mv /etc/nginx/nginx.conf /etc/nginx/nginx.conf.old")
-    sudo(_r("mv /home/%(SERVER_USERNAME)s/nginx.conf /etc/nginx/nginx.conf"))
-    sudo("chown root:root /etc/nginx/nginx.conf")
-
-    _put_template({"template": "%(FAB_CONFIG_PATH)s/templates/nginx-app-proxy",
-                   "destination": "/home/%(SERVER_USERNAME)s/%(PROJECT_NAME)s"})
-    sudo("rm -rf /etc/nginx/sites-enabled/default")
-    sudo(_r("mv /home/%(SERVER_USERNAME)s/%(PROJECT_NAME)s /etc/nginx/sites-available/%(PROJECT_NAME)s"))
-    sudo(_r("chown root:root /etc/nginx/sites-available/%(PROJECT_NAME)s"))
-
-    print(_yellow("Restarting nginx"))
-    sudo("/etc/init.d/nginx restart")
+    _on_hosts(_reload_nginx, pool_size, fail_fast)
 
     time_diff = time.time() - start
     print(_yellow("Finished reloading nginx in %.2fs" % time_diff))
 
 
-def reload_supervisor():
+def _reload_nginx():
+    # Install the nginx config files that changed, check them with nginx -t and reload nginx gracefully, putting
+    # the old config back if the check fails. Does nothing when none changed
+    rendered = _rendered("nginx")
+    _check_nginx(rendered)
+    with _Batch() as batch:
+        changed = _changed_templates(rendered, batch.executor)
+        if not changed:
+            puts(_green("nginx config is up to date"))
+            return
+        _nginx_snapshot_steps(batch)
+        _install_steps(batch, changed)
+        batch.sudo("rm -f /etc/nginx/sites-enabled/default")
+        batch.sudo(_r("ln -sf /etc/nginx/sites-available/%(PROJECT_NAME)s /etc/nginx/sites-enabled/%(PROJECT_NAME)s"))
+        # nginx makes the proxy cache directory itself, but not its parents
+        batch.sudo(_r("mkdir -p %(PROXY_CACHE_DIR)s"))
+        _nginx_apply_steps(batch)
+
+
+def _reload_memcached():
+    # Install memcached.conf if it changed and restart memcached to use it, which empties the cache
+    with _Batch() as batch:
+        if _sync_templates(batch, "memcached"):
+            batch.sudo("service memcached restart", label="Restarting memcached")
+
+
+def _reload_pgbouncer():
+    # Install the PgBouncer config if it changed and reload it, which keeps the open client connections
+    with _Batch() as batch:
+        if _sync_templates(batch, "pgbouncer"):
+            batch.sudo("test ! -f /etc/default/pgbouncer || sed -i 's/^START=0/START=1/' /etc/default/pgbouncer",
+                       label="Reloading PgBouncer")
+            batch.sudo("service pgbouncer reload || service pgbouncer start")
+
+
+def _reload_system():
+    # Install the kernel and open file settings if they changed, apply them and size the swap file. nginx picks up
+    # its new limits on its next reload, and gunicorn when supervisord next starts
+    context = _template_context()
+    with _Batch() as batch:
+        if not _sync_templates(batch, "system"):
+            return
+        batch.sudo(_r("sysctl -e -p /etc/sysctl.d/60-%(PROJECT_NAME)s.conf"), label="Applying kernel settings")
+        batch.sudo(_render("test ! -f /etc/supervisord.conf || "
+                           "sed -i 's/^minfds=.*/minfds=%(NOFILE_LIMIT)d/' /etc/supervisord.conf", context))
+        _swap_steps(batch, context)
+
+
+def _swap_steps(batch, context):
+    # A swap file of SWAP_MB, made again when its size changed, or none at all
+    swap = {'file': _quote(context['SWAP_FILE']), 'mb': context['SWAP_MB'], 'bytes': context['SWAP_MB'] * 1048576}
+    if swap['mb']:
+        batch.sudo("test \"$(stat -c %%s %(file)s 2>/dev/null)\" = %(bytes)d || { swapoff %(file)s 2>/dev/null; "
+                   "rm -f %(file)s; fallocate -l %(mb)dM %(file)s && chmod 600 %(file)s && mkswap %(file)s; }" % swap,
+                   label="Sizing swap")
+        batch.sudo("swapon -s | grep -q \"^$(readlink -f %(file)s)[[:space:]]\" || swapon %(file)s" % swap)
+        batch.sudo(_append_line("%s none swap sw 0 0" % context['SWAP_FILE'], "/etc/fstab"))
+    else:
+        batch.sudo("if test -f %(file)s; then swapoff %(file)s 2>/dev/null; rm -f %(file)s; fi" % swap,
+                   label="Removing swap")
+        batch.sudo("sed -i %s /etc/fstab" % _quote("\\#^%s #d" % context['SWAP_FILE']))
+
+
+@runs_once
+@_traced
+def reload_supervisor(pool_size=None, fail_fast=None):
     """
     Reloads the supervisor config files and restarts supervisord
     """
     start = check_hosts()
     print(_yellow("Reloading the supervisor config files..."))
+    _on_hosts(_reload_supervisor, pool_size, fail_fast)
 
-    # Stop old supervisor process
-    sudo("supervisorctl stop all")
-    sudo("killall supervisord")
-
-    # Setup supervisor
-    print(_yellow("Configuring supervisor"))
-    run(_r("echo_supervisord_conf > /home/%(SERVER_USERNAME)s/supervisord.conf"))
-    _put_template({"template": "%(FAB_CONFIG_PATH)s/templates/supervisord.conf",
-                   "destination": "/home/%(SERVER_USERNAME)s/my.supervisord.conf"})
+    # Print the final message and the elapsed time
+    print(_yellow("%s in %.2fs" % ("Finished reloading supervisor", time.time() - start)))
 
-    run(_r("cat /home/{SERVER_USERNAME:s}/my.supervisord.conf >> /home/{SERVER_USERNAME:s}/supervisord.conf"))
-    run(_r("rm /home/{SERVER_USERNAME:s}/my.supervisord.conf"))
-    sudo(_r("mv /home/{SERVER_USERNAME:s}/supervisord.conf /etc/supervisord.conf"))
-    sudo("supervisord")
-    put(_r("{FAB_CONFIG_PATH:s}/templates/supervisord-init"), _r("/home/{SERVER_USERNAME:s}/supervisord-init"))
-    sudo(_r("mv /home/{SERVER_USERNAME:s}/supervisord-init /etc/init.d/supervisord"))
-    sudo("chmod +x /etc/init.d/supervisord")
-    sudo("update-rc.d supervisord defaults")
 
-    # Restart supervisor
-    sudo("supervisorctl start all")
+def _reload_supervisor():
+    # Install the supervisor config files that changed and have supervisord pick them up, or do nothing when none
+    # did. /etc/supervisord.conf is the stock config with an include of /etc/supervisord.d, written once
+    with _Batch() as batch:
+        if not _sync_templates(batch, "supervisor"):
+            puts(_green("supervisor config is up to date"))
+            return
+        batch.sudo(_render("grep -qxF '[include]' /etc/supervisord.conf 2>/dev/null || "
+                           "{ echo_supervisord_conf | sed 's/^minfds=.*/minfds=%(NOFILE_LIMIT)d/' && "
+                           "printf '\\n[include]\\nfiles = /etc/supervisord.d/*.conf\\n'; } > /etc/supervisord.conf",
+                           _template_context()), label="Configuring supervisor")
 
-    # Print the final message and the elapsed time
-    print(_yellow("%s in %.2fs" % ("Finished reloading supervisor", time.time() - start)))
+        # Start supervisord, or have a running one pick up the new config
+        batch.sudo("if test -f /tmp/supervisord.pid && kill -0 $(cat /tmp/supervisord.pid); "
+                   "then supervisorctl update; else supervisord; fi", label="Reloading supervisor")
+        batch.sudo("update-rc.d supervisord defaults")
 
 
-def reload_gunicorn():
+@runs_once
+@_traced
+def reload_gunicorn(pool_size=None, fail_fast=None):
     """
     Reloads the Gunicorn startup script and restarts gunicorn
     """
     start = check_hosts()
     print(_yellow("Reloading the gunicorn startup script..."))
-
-    # Push the gunicorn startup script to server
-    _put_template({"template": "%(FAB_CONFIG_PATH)s/templates/start_gunicorn.bash",
-                   "destination": "%(PROJECT_PATH)s/start_gunicorn.bash"})
-    sudo(_r("chmod +x %(PROJECT_PATH)s/start_gunicorn.bash"))
-
-    # Restart gunicorn to update the site
-    sudo(_r("supervisorctl restart %(PROJECT_NAME)s"))
+    _on_hosts(_reload_gunicorn, pool_size, fail_fast)
 
     time_diff = time.time() - start
     print(_yellow("Finished reloading the gunicorn startup script in %.2fs" % time_diff))
 
 
-def update_secrets(new_secret=False):
+def _reload_gunicorn(restart=True):
+    # Install the gunicorn files that changed and restart gunicorn to use them, or do nothing when none did
+    with _Batch() as batch:
+        if not _sync_templates(batch, "gunicorn"):
+            puts(_green("gunicorn config is up to date"))
+            return
+        if restart:
+            batch.sudo(_r("supervisorctl restart %(PROJECT_NAME)s"), label="Restarting gunicorn")
+
+
+@_traced
+def update_secrets(new_secret=False, secret_key=None):
     secrets_file = open(fabconf['SECRETS_PATH'], 'rb')
     new_secrets = json.load(secrets_file)
     secrets_file.close()
@@ -351,115 +634,1176 @@ def update_secrets(new_secret=False):
         # Keeps remote secret
         remote_file_path = fabconf['SETTINGSDIR'] + '/secrets.json'
         remote_file = StringIO.StringIO()
-        junk = get(remote_file_path, local_path=remote_file)
+        junk = _download(remote_file_path, local_path=remote_file)
         remote_secrets = json.loads(remote_file.getvalue())
         remote_file.close()
         new_secrets['SECRET_KEY'] = remote_secrets['SECRET_KEY']
     else:
-        new_secrets['SECRET_KEY'] = gen_secret()
+        new_secrets['SECRET_KEY'] = secret_key or gen_secret()
+
+    # Where the static files and media are and which cache to use, for settings/prod.py
+    for name in ['STATIC_URL', 'STATIC_ROOT', 'MEDIA_URL', 'MEDIA_ROOT']:
+        new_secrets[name] = fabconf[name]
+    if fabconf['S3_STATIC']:
+        new_secrets['STATIC_URL'] = fabconf['S3_STATIC_URL']
+    new_secrets['CACHES'] = _caches_setting(fabconf['ELASTICACHE_ENDPOINT'], fabconf['MEMCACHED_LISTEN'],
+                                            fabconf['MEMCACHED_PORT'], fabconf['CACHE_KEY_PREFIX'],
+                                            fabconf['CACHE_TIMEOUT'])
+    if fabconf['PGBOUNCER']:
+        # Connect to the databases through PgBouncer, which has their real hosts
+        new_secrets['DATABASES'] = _pooled_databases(new_secrets.get('DATABASES', {}), fabconf['PGBOUNCER_PORT'])[2]
 
     temp_filename = write_secrets(new_secrets)
-    put(temp_filename, _r('%(SETTINGSDIR)s/secrets.json'))
+    _upload(temp_filename, _r('%(SETTINGSDIR)s/secrets.json'))
     os.remove(temp_filename)
     print(_yellow("Writing secrets"))
 
 
-def manage(command):
+@runs_once
+@_traced
+def manage(command, pool_size=None, fail_fast=None):
     """
     Runs a python manage.py command on the server
     """
     
     # Get the instances to run commands on
-    env.hosts = fabconf['EC2_INSTANCES']
+    check_hosts()
 
     # Run the management command inside the virtualenv
-    _virtualenv("python %(MANAGEPY_PATH)s/manage.py " + command)
+    _on_hosts(lambda: _virtualenv("python %(MANAGEPY_PATH)s/manage.py " + command), pool_size, fail_fast)
+
+
+@runs_once
+@_traced
+def sync_static(pool_size=None, fail_fast=None):
+    """
+    Collects the static files locally with hashed names, uploads the new and changed ones to the S3 bucket
+    fabconf['S3_STATIC_BUCKET'] and gives the servers the manifest
+    """
+    start = time.time()
+    _sync_static()
+    check_hosts()
+    _on_hosts(_push_static_manifest, pool_size, fail_fast)
+    print(_yellow("Finished syncing the static files in %.2fs" % (time.time() - start)))
+
+
+def _sync_static():
+    """
+    Runs collectstatic locally into fabconf['LOCAL_STATIC_ROOT'] and uploads what changed to S3
+    """
+    if not fabconf['S3_STATIC_BUCKET']:
+        raise Exception("Set fabconf['S3_STATIC_BUCKET'] to the bucket for the static files")
+    print(_yellow("Collecting the static files locally..."))
+    with _span("local", "collectstatic"):
+        local(_collectstatic_command(fabconf['LOCAL_PYTHON'], fabconf['LOCAL_MANAGEPY_PATH'],
+                                     fabconf['LOCAL_SETTINGS_MODULE'], fabconf['LOCAL_STATIC_ROOT']))
+    print(_yellow("Uploading the new and changed static files to s3://%s/%s..." % (fabconf['S3_STATIC_BUCKET'],
+                                                                                  fabconf['S3_STATIC_PREFIX'])))
+    uploaded, skipped, size = _sync_s3_static(
+        _s3_bucket, fabconf['LOCAL_STATIC_ROOT'], fabconf['S3_STATIC_PREFIX'], fabconf['STATIC_MAX_AGE'],
+        fabconf['STATIC_UNHASHED_MAX_AGE'], fabconf['S3_STATIC_ACL'], fabconf['S3_STATIC_WORKERS'],
+        fabconf['S3_MULTIPART_THRESHOLD'], fabconf['S3_MULTIPART_CHUNK'])
+    print(_green("Uploaded %d static files (%.1f MiB), %d were up to date" % (uploaded, size / 1048576.0,
+                                                                              skipped)))
+
+
+def _push_static_manifest():
+    # ManifestStaticFilesStorage looks the hashed names up in STATIC_ROOT, so the servers only need the manifest
+    manifest = os.path.join(fabconf['LOCAL_STATIC_ROOT'], _STATIC_MANIFEST)
+    if not os.path.exists(manifest):
+        puts(_red("No %s yet, run fab sync_static to upload the static files" % manifest))
+        return
+    _run(_r("mkdir -p %(STATIC_ROOT)s"))
+    _upload(manifest, _r("%(STATIC_ROOT)s/") + _STATIC_MANIFEST)
+
+
+@runs_once
+def ssh_sessions(close=False):
+    """
+    Lists the hosts with a shared SSH session open, see fabconf['SSH_CONTROL_DIR'], or closes them with close=yes
+    """
+    check_hosts()
+    ssh = _ssh_command(env.user, env.key_filename, fabconf['SSH_CONTROL_DIR'], fabconf['SSH_CONTROL_PERSIST'])
+    for host in env.hosts:
+        if _as_bool(close):
+            print(_green("  %s closed" % host) if _close_session(ssh, host) else _yellow("  %s was not open" % host))
+        else:
+            print(_green("  %s open" % host) if _session_open(ssh, host) else _yellow("  %s not open" % host))
+
+
+@runs_once
+@_traced
+def create_load_balancer():
+    """
+    Creates the load balancer fabconf['ELB_NAME'] unless it exists, points its health check at
+    fabconf['HEALTH_CHECK_PATH'] and registers the servers with it
+    """
+    if not fabconf['ELB_NAME']:
+        raise Exception("Set fabconf['ELB_NAME'] to the name of the load balancer to put in front of the servers")
+    dns_name = _ensure_load_balancer(_elb_connection(), fabconf['ELB_NAME'], fabconf['AVAILABILITY_ZONES'],
+                                     fabconf['HEALTH_CHECK_PATH'])
+    print(_green("%s is at %s" % (fabconf['ELB_NAME'], dns_name)))
+    env.hosts = _all_hosts()
+    _register_hosts(env.hosts)
+
+
+@runs_once
+def elb_status():
+    """
+    Prints the instances registered with fabconf['ELB_NAME'] and whether each passes its health check
+    """
+    if not fabconf['ELB_NAME']:
+        raise Exception("There is no load balancer, set fabconf['ELB_NAME']")
+    health = _instance_health(_elb_connection(), fabconf['ELB_NAME'])
+    hosts = dict((instance_id, host) for host, instance_id in _instance_ids(_ec2_connection(), _all_hosts()).items())
+    print(_yellow("%s: %d instances" % (fabconf['ELB_NAME'], len(health))))
+    for instance_id in sorted(health):
+        state, description = health[instance_id]
+        line = "  %-12s %-55s %-13s %s" % (instance_id, hosts.get(instance_id, '-'), state, description or '')
+        print(_green(line) if state == "InService" else _red(line))
+
+
+@runs_once
+@_traced
+def scale(capacity, pool_size=None, fail_fast=None):
+    """
+    Sets the auto scaling group fabconf['ASG_NAME'] to capacity instances, first creating it and a launch
+    configuration for ec2_instancetype on the newest baked image or ec2_amis[0]. New instances are provisioned and
+    put behind fabconf['ELB_NAME'], and instances being removed are drained from it first, eg fab scale:capacity=4
+    """
+    start_time = time.time()
+    capacity = int(capacity)
+    if not fabconf['ASG_NAME']:
+        raise Exception("Set fabconf['ASG_NAME'] to the name of the auto scaling group to manage")
+    if not fabconf['HOSTS_FROM_TAGS']:
+        # The group launches and replaces instances on its own, so only their tags say which ones are servers
+        raise Exception("fab scale needs fabconf['HOSTS_FROM_TAGS'] = True, so the other commands find the group's "
+                        "instances")
+    if not fabconf['ASG_MIN_SIZE'] <= capacity <= fabconf['ASG_MAX_SIZE']:
+        raise Exception("capacity must be between ASG_MIN_SIZE (%d) and ASG_MAX_SIZE (%d)" % (
+            fabconf['ASG_MIN_SIZE'], fabconf['ASG_MAX_SIZE']))
+    ec2 = _ec2_connection()
+    autoscale = _autoscale_connection()
+
+    ami = _boot_ami(ec2)
+    launch_config = _ensure_launch_configuration(
+        autoscale, _launch_configuration_name(fabconf['INSTANCE_NAME_TAG'], ami, ec2_instancetype, ec2_keypair,
+                                              ec2_secgroups),
+        ami, ec2_instancetype, ec2_keypair, ec2_secgroups)
+    group = _ensure_group(autoscale, fabconf['ASG_NAME'], launch_config, fabconf['AVAILABILITY_ZONES'],
+                          [fabconf['ELB_NAME']] if fabconf['ELB_NAME'] else [], fabconf['ASG_MIN_SIZE'],
+                          fabconf['ASG_MAX_SIZE'], fabconf['INSTANCE_NAME_TAG'])
+
+    removing = _surplus(group, capacity)
+    if removing:
+        if fabconf['ELB_NAME']:
+            _drain(_elb_connection(), fabconf['ELB_NAME'], removing, fabconf['ELB_DRAIN_SECONDS'])
+        for instance_id in removing:
+            print(_yellow("Terminating %s" % instance_id))
+            autoscale.terminate_instance(instance_id, decrement_capacity=True)
+    else:
+        group.set_capacity(capacity)
+    ids = _wait_for_capacity(autoscale, fabconf['ASG_NAME'], capacity, fabconf['BOOT_TIMEOUT'])
+
+    # The group launches bare instances, which join the fleet the way spawn_fleet's do. Ones it launched since
+    # the last run, eg to replace an unhealthy server, are provisioned along with the ones just asked for
+    instances = _wait_for_running(ec2, ids, fabconf['BOOT_TIMEOUT']) if ids else []
+    new = [i for i in instances if not _provisioned(i)]
+    if new:
+        hosts = [i.public_dns_name for i in new]
+        secret_key = _fleet_secret_key(_all_hosts())
+        results = _run_on_hosts(lambda: _provision_new(secret_key), hosts, pool_size=int(pool_size or len(hosts)),
+                                fail_fast=_as_bool(fabconf['FAIL_FAST'] if fail_fast is None else fail_fast))
+        _print_summary(results, "Provisioning")
+        _mark_provisioned([result.host for result in results if result.ok])
+        _register_hosts([result.host for result in results if result.ok])
+        failures = _failed(results)
+        if failures:
+            raise Exception("%d of %d new instances failed to provision: %s" % (
+                len(failures), len(results), ", ".join([f.host for f in failures])))
+    print(_green("%s has %d instances, in %f minutes" % (fabconf['ASG_NAME'], capacity,
+                                                         (time.time() - start_time) / 60)))
+
+
+@runs_once
+def cache_stats(pool_size=None, fail_fast=None):
+    """
+    Prints the hit ratio, evictions, fill and connections of the memcached on each server, or of each node of the
+    ElastiCache cluster in fabconf['ELASTICACHE_ENDPOINT'], asked from the first server
+    """
+    check_hosts()
+    if fabconf['ELASTICACHE_ENDPOINT']:
+        results = _on_hosts(_elasticache_stats, pool_size, fail_fast, hosts=env.hosts[:1])
+        rows = results[0].value
+    else:
+        results = _on_hosts(_memcached_stats, pool_size, fail_fast)
+        rows = [(result.host, result.value) for result in results]
+    _print_memcached_stats(rows)
+
+
+def _memcached_stats(host=None, port=None):
+    with settings(warn_only=True):
+        output = _run(_memcached_query(host or fabconf['MEMCACHED_LISTEN'], port or fabconf['MEMCACHED_PORT'],
+                                       "stats"))
+    return _parse_memcached_stats(output)
+
+
+def _elasticache_stats():
+    host, port = fabconf['ELASTICACHE_ENDPOINT'].rsplit(':', 1)
+    with settings(warn_only=True):
+        nodes = _cluster_nodes(_run(_memcached_query(host, port, "config get cluster")))
+    return [("%s:%d" % node, _memcached_stats(*node)) for node in nodes or [(host, int(port))]]
+
+
+@runs_once
+@_traced
+def analyze_logs(files=None, local_files=None, limit=None, pool_size=None, fail_fast=None):
+    """
+    Reports the endpoints that take the most time in the nginx access logs of the servers, with their request
+    counts and latency percentiles, and the slowest requests. files is a semicolon separated list of globs on the
+    servers, by default fabconf['ACCESS_LOGS'], and local_files reads local logs instead, eg
+    fab analyze_logs:local_files="logs/*.log;logs/*.gz"
+    """
+    limit = int(limit or fabconf['ANALYZE_LOGS_LIMIT'])
+    if local_files:
+        summary = _analyze_log_lines(_local_log_lines(local_files.split(";")), limit)
+    else:
+        check_hosts()
+        paths = files.split(";") if files else fabconf['ACCESS_LOGS']
+        # Every host at once by default, as each one mostly waits on its own disk and network
+        results = _on_hosts(lambda: _host_log_summary(paths, limit), pool_size or len(env.hosts), fail_fast)
+        summary = _merge_log_summaries([result.value for result in results], limit)
+    _print_log_report(summary, limit)
+
+
+def _host_log_summary(paths, limit):
+    # The logs are streamed over ssh and summarized as they arrive, so they are never held in memory
+    ssh, host = _host_ssh()
+    with _span("logs", " ".join(paths)):
+        return _analyze_log_lines(_remote_log_lines(ssh, host, paths), limit)
+
+
+@runs_once
+def fleet_stats(interval=None, count=None, csv_file=None, json_file=None, pool_size=None):
+    """
+    Samples the CPU, load, memory, gunicorn, nginx, memcached and PgBouncer memory and connections of every server
+    at once and shows them as a table, refreshed every interval seconds until count samples or Ctrl-C. csv_file
+    appends every sample to a CSV file and json_file keeps them all in a JSON file, eg
+    fab fleet_stats:interval=10,csv_file=fleet.csv
+    """
+    check_hosts()
+    interval = float(interval or fabconf['FLEET_STATS_INTERVAL'])
+    count = int(count if count is not None else fabconf['FLEET_STATS_COUNT'])
+    pool_size = int(pool_size or fabconf['FLEET_STATS_POOL_SIZE'])
+    refresh = count != 1 and sys.stdout.isatty()
+    samples = []
+    taken = 0
+    try:
+        while True:
+            started = time.time()
+            when = time.strftime("%Y-%m-%dT%H:%M:%S")
+            results = _run_on_hosts(_fleet_sample, env.hosts, pool_size=pool_size, fail_fast=False)
+            rows = [(result.host, result.value if result.ok else None) for result in results]
+            if refresh:
+                # Clear the screen and start at the top, so the table is redrawn in place
+                sys.stdout.write("\033[2J\033[H")
+            _print_fleet_table(rows, "%s, %d hosts%s" % (when, len(rows), ", Ctrl-C to stop" if refresh else ""))
+            for failure in _failed(results):
+                print(_red("  %s: %s" % (failure.host, (failure.error or '').strip().split('\n')[-1])))
+            if csv_file:
+                _write_fleet_csv(csv_file, rows, when)
+            if json_file:
+                samples.append({'time': when, 'hosts': dict((host, stats) for host, stats in rows if stats)})
+                _write_fleet_json(json_file, samples)
+            taken += 1
+            if count and taken >= count:
+                break
+            time.sleep(max(0, interval - (time.time() - started)))
+    except KeyboardInterrupt:
+        pass
+
+
+def _fleet_sample():
+    # Each sample is a new channel on the host's shared ssh session, so refreshing costs no handshakes
+    ssh, host = _host_ssh()
+    ports = {'http': 80, 'memcached': fabconf['MEMCACHED_PORT'],
+             'pgbouncer': fabconf['PGBOUNCER_PORT'] if fabconf['PGBOUNCER'] else None}
+    return _sample_fleet_host(ssh, host, fabconf['FLEET_STATS_CPU_INTERVAL'], fabconf['GUNICORN_SOCKET'], ports)
+
+
+def check_nginx():
+    """
+    Renders the nginx config locally and checks its structure, without touching a server
+    """
+    _check_nginx(_rendered("nginx"))
+    print(_green("nginx config looks good"))
+
+
+def gunicorn_settings(instance_type=None, profile=None):
+    """
+    Prints the gunicorn settings the rendered gunicorn.conf.py works out for an instance type, by default
+    ec2_instancetype, without touching a server, eg fab gunicorn_settings:instance_type=m3.large,profile=gthread
+    """
+    instance_type = instance_type or ec2_instancetype
+    cpus, memory_mb = _instance_hardware(instance_type)
+    settings = _gunicorn_tuning(instance_type, profile)
+
+    print(_yellow("%s: %d vCPUs, %d MiB, %s profile" % (instance_type, cpus, memory_mb, settings['worker_class'])))
+    for name in sorted(settings):
+        print("  %-20s %r" % (name, settings[name]))
+
+
+def system_settings(instance_type=None):
+    """
+    Prints the kernel, open file, swap and nginx worker settings for an instance type, by default ec2_instancetype,
+    without touching a server. fab render_templates writes the sysctl, limits and nginx files they go into
+    """
+    instance_type = instance_type or ec2_instancetype
+    cpus, memory_mb = _instance_hardware(instance_type)
+    settings = _system_settings(cpus, memory_mb, fabconf['SYSTEM_SETTINGS'])
+    print(_yellow("%s: %d vCPUs, %d MiB" % (instance_type, cpus, memory_mb)))
+    for name in sorted(settings):
+        print("  %-30s %s" % (name, settings[name]))
+
+
+def pgbouncer_settings(instance_type=None):
+    """
+    Prints the PgBouncer pool sizes for an instance type, by default ec2_instancetype, and the databases it pools,
+    without touching a server
+    """
+    instance_type = instance_type or ec2_instancetype
+    settings = _gunicorn_tuning(instance_type)
+    print(_yellow("%s: %d workers with %d threads, %s" % (instance_type, settings['workers'],
+                                                          _gunicorn_threads(settings), settings['worker_class'])))
+    context = _pgbouncer_context(instance_type)
+    for name in ['PGBOUNCER_POOL_SIZE', 'PGBOUNCER_RESERVE_POOL_SIZE', 'PGBOUNCER_MAX_CLIENT_CONN']:
+        print("  %-30s %d" % (name, context[name]))
+    print(_yellow("[databases]"))
+    for line in context['PGBOUNCER_DATABASES'].splitlines():
+        print("  " + line)
+
+
+def render_templates(output_dir=None):
+    """
+    Renders all the templates locally, without touching a server, eg to check them before they are pushed.
+    Writes them to fabconf['RENDERED_DIR'] or output_dir
+    """
+    if output_dir:
+        fabconf['RENDERED_DIR'] = os.path.abspath(output_dir)
+    for rendered in _rendered():
+        print(_yellow("%s  %s -> %s" % (rendered.sha1[:12], rendered.path, rendered.template.destination)))
+
+
+@runs_once
+def benchmark(requests=None, concurrency=None, duration=None, path=None, local=False):
+    """
+    Sends concurrent requests to each host and reports throughput, latency percentiles and errors, next to the
+    previous run's. Runs for duration seconds instead of a number of requests when it is given. With local=yes
+    it benchmarks stub_app.py served locally by the rendered gunicorn config instead, which needs gunicorn
+    installed locally, eg fab benchmark:requests=5000,concurrency=50
+    """
+    options = {
+        'requests': None if duration else int(requests or fabconf['BENCHMARK_REQUESTS']),
+        'duration': float(duration) if duration else None,
+        'concurrency': int(concurrency or fabconf['BENCHMARK_CONCURRENCY']),
+        'path': path or fabconf['BENCHMARK_PATH'],
+    }
+    if _as_bool(local):
+        config_path = [r.path for r in _rendered("gunicorn") if r.template.name == "gunicorn.conf.py"][0]
+        port = int(fabconf['BENCHMARK_PORT'])
+        print(_yellow("Serving stub_app.py locally with %s on port %d" % (config_path, port)))
+        with _serve_stub(config_path, port, fabconf['FAB_CONFIG_PATH']):
+            _benchmark("local", "127.0.0.1", port, options)
+    else:
+        check_hosts()
+        for host in env.hosts:
+            _benchmark(host, host.split('@')[-1].split(':')[0], 80, options)
+
+
+# ------------------------------------------------------------------------------------------------------------------
+# PROVISIONING RESOURCES - the server state instance() and provision converge to, in the order it is applied
+# ------------------------------------------------------------------------------------------------------------------
+APT_PACKAGES = ["libpq-dev", "nginx", "memcached", "git", "python-setuptools", "python-dev", "build-essential",
+                "python-pip", "libmemcached-dev", "curl", "rsync"]
+
+PIP_PACKAGES = ["virtualenv", "virtualenvwrapper", "virtualenv-clone", "supervisor"]
+
+VIRTUALENV_PACKAGES = ["Django", "psycopg2", "gunicorn", "pylibmc", "django-elasticache", "boto", "django-storages"]
+if fabconf['GUNICORN_PROFILE'] == "gevent":
+    VIRTUALENV_PACKAGES.append("gevent")
+if fabconf['PRECOMPRESS_BROTLI']:
+    APT_PACKAGES.append("brotli")
+if fabconf['PGBOUNCER']:
+    APT_PACKAGES.append("pgbouncer")
+
+
+# The templates in templates/, grouped by what reloads them: (group, template, where it is installed, owner, mode)
+TEMPLATES = [
+    ("boto", "boto.cfg", "/etc/boto.cfg", "root:root", "644"),
+    ("gunicorn", "gunicorn.conf.py", "%(SHARED_DIR)s/gunicorn.conf.py",
+     "%(SERVER_USERNAME)s:%(SERVER_USERNAME)s", "644"),
+    ("gunicorn", "start_gunicorn.bash", "%(SHARED_DIR)s/start_gunicorn.bash",
+     "%(SERVER_USERNAME)s:%(SERVER_USERNAME)s", "755"),
+    ("nginx", "nginx.conf", "/etc/nginx/nginx.conf", "root:root", "644"),
+    ("nginx", "nginx-app-proxy", "/etc/nginx/sites-available/%(PROJECT_NAME)s", "root:root", "644"),
+    ("memcached", "memcached.conf", "/etc/memcached.conf", "root:root", "644"),
+    ("supervisor", "supervisord.conf", "/etc/supervisord.d/%(PROJECT_NAME)s.conf", "root:root", "644"),
+    ("supervisor", "supervisord-init", "/etc/init.d/supervisord", "root:root", "755"),
+]
+TEMPLATES += [
+    ("system", "sysctl.conf", "/etc/sysctl.d/60-%(PROJECT_NAME)s.conf", "root:root", "644"),
+    ("system", "limits.conf", "/etc/security/limits.d/%(PROJECT_NAME)s.conf", "root:root", "644"),
+]
+if fabconf['PGBOUNCER']:
+    TEMPLATES += [
+        ("pgbouncer", "pgbouncer.ini", "/etc/pgbouncer/pgbouncer.ini", "postgres:postgres", "640"),
+        ("pgbouncer", "pgbouncer-userlist.txt", "/etc/pgbouncer/userlist.txt", "postgres:postgres", "640"),
+    ]
+
+
+# Resources that do not depend on the project or its secrets, so they can be baked into an image by bake_image
+BAKED_RESOURCES = ["apt", "pip", "profile", "virtualenv"]
+
+
+def _baked_resources():
+    return [resource for resource in _resources() if resource.name in BAKED_RESOURCES]
+
+
+def _resources(secret_key=None):
+    """
+    Returns the Resources that make up a server. secret_key is the Django SECRET_KEY for servers that do not
+    have one yet, by default a new one is generated per server
+    """
+    resources = [
+        _Resource("apt", steps=_apt_steps,
+                  check="dpkg -s %s" % " ".join(APT_PACKAGES)),
+        _Resource("pip", steps=_pip_steps,
+                  check="test -f /usr/local/bin/virtualenvwrapper.sh && which supervisord"),
+        _Resource("system", action=lambda present: _reload_system(),
+                  inputs=_rendered_paths("system"),
+                  check=_r("test -f /etc/sysctl.d/60-%(PROJECT_NAME)s.conf")),
+        _Resource("boto", action=lambda present: _install_templates("boto"),
+                  inputs=_rendered_paths("boto"),
+                  check="test -f /etc/boto.cfg"),
+        _Resource("profile", steps=_profile_steps,
+                  check=_r("test -d %(VIRTUALENV_DIR)s && test -d %(APPS_DIR)s")),
+        _Resource("git", steps=_git_steps,
+                  uploads=[(_r("%(BITBUCKET_DEPLOY_KEY_PATH)s"),
+                            _r("/home/%(SERVER_USERNAME)s/.ssh/%(BITBUCKET_DEPLOY_KEY_NAME)s"))],
+                  check=_r("test -f /home/%(SERVER_USERNAME)s/.ssh/%(BITBUCKET_DEPLOY_KEY_NAME)s")),
+        _Resource("wheelhouse", action=lambda present: _push_wheelhouse(),
+                  inputs=_requirement_files(fabconf['LOCAL_REQUIREMENTS_DIR'], fabconf['WHEEL_REQUIREMENTS']),
+                  check=_r("test -f %(WHEELHOUSE_DIR)s/current/.complete")),
+        _Resource("virtualenv", steps=_virtualenv_steps,
+                  check=_r("test -x %(BASE_VIRTUALENV)s/bin/gunicorn")),
+        _Resource("gunicorn", action=lambda present: _reload_gunicorn(restart=False),
+                  inputs=_rendered_paths("gunicorn"),
+                  check=_r("test -f %(SHARED_DIR)s/gunicorn.conf.py && test -x %(SHARED_DIR)s/start_gunicorn.bash")),
+        _Resource("project", steps=_project_steps,
+                  check=_r("test -L %(PROJECT_PATH)s && test -x %(PROJECT_PATH)s/venv/bin/gunicorn")),
+        _Resource("nginx", steps=_nginx_steps, action=lambda present: _reload_nginx(),
+                  inputs=_rendered_paths("nginx"),
+                  check=_r("test -L /etc/nginx/sites-enabled/%(PROJECT_NAME)s")),
+        _Resource("memcached", action=lambda present: _reload_memcached(),
+                  inputs=_rendered_paths("memcached"),
+                  check="test -f /etc/memcached.conf"),
+        _Resource("secrets", action=lambda present: update_secrets(new_secret=not present, secret_key=secret_key),
+                  inputs=[fabconf['SECRETS_PATH']],
+                  check=_r("test -f %(SETTINGSDIR)s/secrets.json" +
+                           (" && grep -q '\"PORT\": %(PGBOUNCER_PORT)d' %(SETTINGSDIR)s/secrets.json"
+                            if fabconf['PGBOUNCER'] else ""))),
+        _Resource("django", steps=_django_steps),
+        _Resource("supervisor", action=lambda present: _reload_supervisor(),
+                  inputs=_rendered_paths("supervisor"),
+                  check=_r("test -x /etc/init.d/supervisord && test -f /etc/supervisord.d/%(PROJECT_NAME)s.conf")),
+    ]
+    if fabconf['PGBOUNCER']:
+        # Before the secrets point Django at it
+        resources.insert([r.name for r in resources].index("secrets"),
+                         _Resource("pgbouncer", action=lambda present: _reload_pgbouncer(),
+                                   inputs=_rendered_paths("pgbouncer"),
+                                   check="test -f /etc/pgbouncer/pgbouncer.ini"))
+    return resources
+
+
+def _apt_steps(batch):
+    batch.sudo("apt-get update -qq", label="Updating apt-get")
+    _apt(APT_PACKAGES, batch=batch)
+
+
+def _pip_steps(batch):
+    _pip(PIP_PACKAGES, batch=batch)
+
+
+def _profile_steps(batch):
+    # virtualenvwrapper
+    batch.sudo(_r("mkdir -p %(VIRTUALENV_DIR)s"), label="Configuring virtualenvwrapper")
+    batch.sudo(_r("chown -R %(SERVER_USERNAME)s: %(VIRTUALENV_DIR)s"))
+    batch.run(_append_line(_r("export WORKON_HOME=%(VIRTUALENV_DIR)s"), _r("/home/%(SERVER_USERNAME)s/.profile")))
+    batch.run(_append_line("source /usr/local/bin/virtualenvwrapper.sh", _r("/home/%(SERVER_USERNAME)s/.profile")))
+
+    # webapps alias
+    batch.run(_append_line(_r("alias webapps='cd %(APPS_DIR)s'"), _r("/home/%(SERVER_USERNAME)s/.profile")),
+              label="Creating webapps alias")
+
+    # webapps dir
+    batch.sudo(_r("mkdir -p %(APPS_DIR)s"), label="Creating webapps directory")
+    batch.sudo(_r("chown -R %(SERVER_USERNAME)s: %(APPS_DIR)s"))
+
+
+def _git_steps(batch):
+    batch.run(_r("git config --global user.name '%(GIT_USERNAME)s'"), label="Configuring git")
+    batch.run(_r("git config --global user.email '%(ADMIN_EMAIL)s'"))
+    batch.run(_r("chmod 600 /home/%(SERVER_USERNAME)s/.ssh/%(BITBUCKET_DEPLOY_KEY_NAME)s"))
+    batch.run(_append_line(_r("IdentityFile /home/%(SERVER_USERNAME)s/.ssh/%(BITBUCKET_DEPLOY_KEY_NAME)s"),
+                           _r("/home/%(SERVER_USERNAME)s/.ssh/config")))
+    batch.run(_r("ssh-keygen -F bitbucket.org -f /home/%(SERVER_USERNAME)s/.ssh/known_hosts > /dev/null || "
+                 "ssh-keyscan bitbucket.org >> /home/%(SERVER_USERNAME)s/.ssh/known_hosts"))
+
+
+def _virtualenv_steps(batch):
+    batch.run(_r("source /home/%(SERVER_USERNAME)s/.profile"))
+    batch.run(_r("test -d %(BASE_VIRTUALENV)s || mkvirtualenv --no-site-packages %(PROJECT_NAME)s"),
+              label="Creating virtualenv")
+
+    # Install django, psycopg2 drivers for Postgres, gunicorn and django cache in the base virtualenv that
+    # release virtualenvs are copied from. From the wheelhouse when the server has one
+    batch.run(_pip_install(_r("%(BASE_VIRTUALENV)s/bin/pip"), " ".join(VIRTUALENV_PACKAGES),
+                           _r("%(WHEELHOUSE_DIR)s/current")), label="Installing virtualenv packages")
+
+
+def _project_steps(batch):
+    # Shared dirs, including the one for the gunicorn logs and the ones nginx serves static files and media from
+    batch.run(_r("mkdir -p %(RELEASES_DIR)s %(SHARED_DIR)s/logs %(STATIC_ROOT)s %(MEDIA_ROOT)s"))
+
+    # Clone the git repo into the first release, with the requirements installed in its virtualenv.
+    # collectstatic and syncdb wait for the secrets
+    _release_steps(batch, manage=False)
+    _switch_steps(batch, reload=False)
+
+
+def _nginx_steps(batch):
+    # Keep the stock config, the templates are installed and nginx restarted by _reload_nginx
+    batch.sudo("test -f /etc/nginx/nginx.conf.old || cp /etc/nginx/nginx.conf /etc/nginx/nginx.conf.old",
+               label="Configuring nginx")
+
+
+def _django_steps(batch):
+    # Run collectstatic, compress the static files for nginx and run syncdb. With S3_STATIC the static files are
+    # collected locally by sync_static instead
+    if not fabconf['S3_STATIC']:
+        _virtualenv("python %(MANAGEPY_PATH)s/manage.py collectstatic -v 0 --noinput", batch=batch)
+        batch.run(_precompress(), label="Precompressing static files")
+    _virtualenv("python %(MANAGEPY_PATH)s/manage.py syncdb", batch=batch)
+
+
+# ------------------------------------------------------------------------------------------------------------------
+# RELEASES - each deploy builds a release directory with its own virtualenv under RELEASES_DIR and then points
+# the PROJECT_PATH symlink at it. These add steps to a batch; the steps share shell variables, eg $release_path
+# ------------------------------------------------------------------------------------------------------------------
+def _release_steps(batch, manage, force=False, pushed=False, changed=None):
+    """
+    Checks out the latest commit into a new release directory, links in the shared files and gives it a
+    virtualenv for its requirements. With manage, also runs collectstatic and syncdb from the release when the
+    files fabconf['STATIC_CHANGES'] and fabconf['SCHEMA_CHANGES'] match changed since the live release, or
+    always with force. With pushed the release is copied from the code _push_release rsynced to
+    fabconf['PUSH_DIR'] instead, and changed lists the files that changed, or is None when that is not known
+    """
+    batch.run(_r("release=$(date -u +%%Y%%m%%d%%H%%M%%S) && release_path=%(RELEASES_DIR)s/$release && "
+                 "mkdir -p %(RELEASES_DIR)s %(SHARED_DIR)s/logs %(STATIC_ROOT)s %(MEDIA_ROOT)s"),
+              label="Naming release")
+
+    if pushed:
+        batch.run(_r("cp -a %(PUSH_DIR)s $release_path"), label="Copying pushed release")
+    else:
+        # A mirror of the repo on the server, so each release only fetches the new commits
+        batch.run(_r("test -d %(REPO_CACHE)s || git clone -q --mirror %(BITBUCKET_REPO)s %(REPO_CACHE)s"),
+                  label="Fetching code")
+        batch.run(_r("cd %(REPO_CACHE)s && git fetch -q --prune origin"))
+        batch.run(_r("git clone -q %(REPO_CACHE)s $release_path"), label="Checking out release")
+
+    # Files that live across releases. The gunicorn files are installed by _reload_gunicorn
+    batch.run(_render("rm -rf $release_path/logs && ln -s %(SHARED_DIR)s/logs $release_path/logs && "
+                      "ln -sfn %(SHARED_DIR)s/gunicorn.conf.py $release_path/gunicorn.conf.py && "
+                      "ln -sfn %(SHARED_DIR)s/start_gunicorn.bash $release_path/start_gunicorn.bash && "
+                      "ln -sfn %(SHARED_DIR)s/secrets.json %(RELEASE_SETTINGS)s/secrets.json",
+                      dict(fabconf, RELEASE_SETTINGS=_in_release('SETTINGSDIR'))), label="Linking shared files")
+
+    # Releases with the same requirements share a virtualenv, so pip only runs when the requirements changed.
+    # A new one starts as a copy of the live one, so pip only installs what changed
+    batch.run("requirements=$(cat $release_path/requirements/*.txt | sha1sum | cut -c1-12)")
+    batch.run(_r("venv=%(VIRTUALENV_DIR)s/%(PROJECT_NAME)s-$requirements"))
+    batch.run(_r("wheels=%(WHEELHOUSE_DIR)s/") + _wheelhouse_key_command(
+        VIRTUALENV_PACKAGES, "$release_path/requirements", fabconf['WHEEL_REQUIREMENTS']))
+    batch.run(_r("source=%(PROJECT_PATH)s/venv && test -d $source || source=%(BASE_VIRTUALENV)s; "
+                 "rm -rf $venv && virtualenv-clone $(readlink -f $source) $venv && ") +
+              _pip_install("$venv/bin/pip", _r("-q -r $release_path/%(REQUIREMENTS_FILE)s"), "$wheels") +
+              " && echo $requirements > $venv/.requirements && touch $venv/.complete",
+              label="pip install", when="! test -f $venv/.complete")
+    batch.run("ln -sfn $venv $release_path/venv")
+
+    if manage:
+        # Diff against the live release's commit. Without one to diff against, or with force, everything counts
+        # as changed. Pushed releases were diffed locally
+        if pushed:
+            batch.run('changed_all=%s; changed=%s' % ('1' if force or changed is None else '',
+                                                      _quote("\n".join(changed or []))),
+                      label="Finding changed files")
+        else:
+            batch.run('old_commit=$(%s)' % _live_commit_command())
+            batch.run('changed_all=%s; if test -z "$old_commit" || ! changed=$(cd $release_path && '
+                      'git diff --name-only "$old_commit" HEAD); then changed_all=1; fi' % ('1' if force else ''),
+                      label="Finding changed files")
+        batch.run('__changed() { test -n "$changed_all" || echo "$changed" | grep -qE "$1"; }')
+
+        # With S3_STATIC the static files were collected locally and uploaded by sync_static
+        commands = [("syncdb", fabconf['SCHEMA_CHANGES'])]
+        if not fabconf['S3_STATIC']:
+            commands.insert(0, ("collectstatic -v 0 --noinput", fabconf['STATIC_CHANGES']))
+        for command, pattern in commands:
+            batch.run("(cd $release_path && source $release_path/venv/bin/activate && python %s/manage.py %s)" %
+                      (_in_release('MANAGEPY_PATH'), command), label="manage.py " + command.split()[0],
+                      when="__changed %s" % _quote(pattern))
+        if not fabconf['S3_STATIC']:
+            batch.run(_precompress(), label="Precompressing static files",
+                      when="__changed %s" % _quote(fabconf['STATIC_CHANGES']))
+
+
+def _live_commit_command():
+    # The live release's commit, from the REVISION file of a pushed release or the checkout of a fetched one
+    return _r("cat %(PROJECT_PATH)s/" + _REVISION + " 2>/dev/null || "
+              "(cd %(PROJECT_PATH)s && git rev-parse HEAD) 2>/dev/null || true")
+
+
+def _export_release():
+    """
+    Exports fabconf['DEPLOY_PUSH_REF'] of the local repo into fabconf['LOCAL_PUSH_DIR'] and returns its commit
+    """
+    commit = local(_r("cd %(LOCAL_REPO_PATH)s && git rev-parse --verify %(DEPLOY_PUSH_REF)s^{commit}"),
+                   capture=True).strip()
+    print(_yellow("Exporting %s (%s) to push to the servers" % (fabconf['DEPLOY_PUSH_REF'], commit[:12])))
+    with _span("local", "git archive"):
+        local(_export_command(fabconf['LOCAL_REPO_PATH'], commit, fabconf['LOCAL_PUSH_DIR']))
+    return commit
+
+
+def _push_release(commit):
+    """
+    rsyncs the exported commit to fabconf['PUSH_DIR'] on the current host over its shared SSH session and
+    returns the files that changed since the host's live commit, or None when they can't be worked out locally
+    """
+    ssh, host = _host_ssh()
+    with _span("rsync", fabconf['PUSH_DIR']) as fields:
+        output = local(_rsync_command(fabconf['LOCAL_PUSH_DIR'], "%s:%s" % (host, fabconf['PUSH_DIR']),
+                                      _shell_command(ssh)), capture=True)
+        files, fields['bytes'] = _rsync_stats(output)
+    puts(_green("Pushed %s, %d changed files in %d bytes" % (commit[:12], files, fields['bytes'])))
+
+    old_commit = _run(_live_commit_command()).strip()
+    if not old_commit:
+        return None
+    with settings(warn_only=True):
+        diff = local(_changed_command(fabconf['LOCAL_REPO_PATH'], old_commit, commit), capture=True)
+    return None if diff.failed else [name for name in diff.splitlines() if name]
+
+
+def _host_ssh():
+    """
+    The ssh command for the current host over its shared session, see connections.py, and the host's name
+    """
+    user, host, port = normalize(env.host_string)
+    ssh = _ssh_command(user, env.key_filename, fabconf['SSH_CONTROL_DIR'], fabconf['SSH_CONTROL_PERSIST'])
+    if port and str(port) != '22':
+        ssh += ['-p', str(port)]
+    return ssh, host
+
+
+def _switch_steps(batch, reload, restart=False):
+    """
+    Atomically points PROJECT_PATH at $release_path. With reload, gunicorn is sent HUP when the virtualenv is
+    unchanged, which starts workers on the new code while the old ones finish their requests, and restarted
+    through supervisor when it changed, gunicorn is not running from its pid file or restart is set
+    """
+    batch.run(_r("old_venv=$(readlink -f %(PROJECT_PATH)s/venv || true)"))
+    batch.run(_r("ln -sfn $release_path %(PROJECT_PATH)s.new && mv -T %(PROJECT_PATH)s.new %(PROJECT_PATH)s"),
+              label="Switching to release")
+    if reload and (restart or fabconf['GUNICORN_PRELOAD']):
+        # A preloaded app is only imported by the master, so new code needs a restart
+        batch.run(_r("sudo -n supervisorctl restart %(PROJECT_NAME)s"), label="Restarting gunicorn")
+    elif reload:
+        batch.run(_r('if test "$old_venv" = "$(readlink -f %(PROJECT_PATH)s/venv)" && test -f %(GUNICORN_PID)s && '
+                     'sudo -n kill -0 $(cat %(GUNICORN_PID)s) 2>/dev/null; '
+                     'then sudo -n kill -HUP $(cat %(GUNICORN_PID)s); '
+                     'else sudo -n supervisorctl restart %(PROJECT_NAME)s; fi'), label="Reloading gunicorn")
+
+
+def _prune_steps(batch):
+    """
+    Removes all but the newest fabconf['KEEP_RELEASES'] releases, never the current one, and the virtualenvs
+    no remaining release uses
+    """
+    batch.run(_render('cd %(RELEASES_DIR)s && current=$(basename $(readlink %(PROJECT_PATH)s)) && '
+                      'for old in $(ls -1 | sort -r | tail -n +%(KEEP_FROM)d); do '
+                      'test "$old" = "$current" || rm -rf "$old"; done',
+                      dict(fabconf, KEEP_FROM=int(fabconf['KEEP_RELEASES']) + 1)), label="Pruning old releases")
+    batch.run(_r('used=$(for old in %(RELEASES_DIR)s/*; do readlink -f $old/venv; done); '
+                 'for old in %(VIRTUALENV_DIR)s/%(PROJECT_NAME)s-*; do test -d "$old" || continue; '
+                 'echo "$used" | grep -qxF "$old" || rm -rf "$old"; done'), label="Pruning unused virtualenvs")
+
+
+def _migrate_to_releases_steps(batch):
+    """
+    Turns a server deployed before releases, where PROJECT_PATH is a plain checkout, into one whose first
+    release is that checkout
+    """
+    legacy = _r("%(RELEASES_DIR)s/00000000000000")
+    batch.run(_render("if test -d %(PROJECT_PATH)s && ! test -L %(PROJECT_PATH)s; then "
+                      "mkdir -p %(RELEASES_DIR)s %(SHARED_DIR)s && "
+                      "mv %(PROJECT_PATH)s %(LEGACY)s && ln -s %(LEGACY)s %(PROJECT_PATH)s && cd %(LEGACY)s && "
+                      "mv logs gunicorn.conf.py start_gunicorn.bash %(SHARED_DIR)s/ && "
+                      "mv %(LEGACY_SETTINGS)s/secrets.json %(SHARED_DIR)s/secrets.json && "
+                      "ln -s %(SHARED_DIR)s/logs logs && "
+                      "ln -s %(SHARED_DIR)s/gunicorn.conf.py gunicorn.conf.py && "
+                      "ln -s %(SHARED_DIR)s/start_gunicorn.bash start_gunicorn.bash && "
+                      "ln -s %(SHARED_DIR)s/secrets.json %(LEGACY_SETTINGS)s/secrets.json && "
+                      "ln -s %(BASE_VIRTUALENV)s venv; fi",
+                      dict(fabconf, LEGACY=legacy, LEGACY_SETTINGS=_in_release('SETTINGSDIR', legacy))),
+              label="Moving the old checkout into a release")
+
+
+def _in_release(key, release_path="$release_path"):
+    """
+    Where the fabconf path key, which is under PROJECT_PATH, lives in a release
+    """
+    return release_path + fabconf[key][len(fabconf['PROJECT_PATH']):]
 
 
 # ------------------------------------------------------------------------------------------------------------------
 # SUPPORT FUNCTIONS
 # ------------------------------------------------------------------------------------------------------------------
 def check_hosts():
-    # Get the hosts and record the start time
-    env.hosts = fabconf['EC2_INSTANCES']
+    # Get the hosts, from their Name tags or from project_conf.py and the inventory written by spawn_fleet, and
+    # record the start time
+    env.hosts = _all_hosts()
     start = time.time()
 
     # Check if any hosts exist
+    if not env.hosts and fabconf['HOSTS_FROM_TAGS']:
+        raise Exception("There are no running EC2 instances tagged Name=%s in %s, run 'fab spawn instance' or "
+                        "'fab scale' to create some" % (fabconf['INSTANCE_NAME_TAG'], ec2_region))
     if not env.hosts:
         raise Exception("There are no EC2 instances defined in project_conf.py, "
                         "please add some instances and try again "
                         "There are EC2 instances defined in project_conf.py, please add some instances and try again "
-                        "or run 'fab spawn_instance' to create an instance")
+                        "or run 'fab spawn_instance' to create an instance. Set fabconf['HOSTS_FROM_TAGS'] = True "
+                        "to work on the running instances tagged Name=%s instead" % fabconf['INSTANCE_NAME_TAG'])
     return start
 
 
-def _create_ec2_instance():
+def _all_hosts():
+    """
+    The running instances tagged fabconf['INSTANCE_NAME_TAG'] with fabconf['HOSTS_FROM_TAGS'], otherwise the hosts in
+    fabconf['EC2_INSTANCES'] followed by the ones in the inventory, without blanks or repeats
+    """
+    if fabconf['HOSTS_FROM_TAGS']:
+        instances = _tagged_instances(_ec2_connection(), fabconf['INSTANCE_NAME_TAG'])
+        waiting = [i.id for i in instances if not _provisioned(i)]
+        if waiting:
+            print(_yellow("Leaving out %s, not provisioned yet. 'fab scale' provisions the ones the auto scaling "
+                          "group launched" % ", ".join(waiting)))
+        return [i.public_dns_name for i in instances if _provisioned(i)]
+    hosts = []
+    for host in list(fabconf['EC2_INSTANCES']) + _inventory_hosts(fabconf['INVENTORY_PATH']):
+        if host and host not in hosts:
+            hosts.append(host)
+    return hosts
+
+
+def _on_hosts(func, pool_size=None, fail_fast=None, hosts=None):
+    """
+    Runs func on every host in hosts, or env.hosts, prints a per-host summary and raises if any host failed.
+    pool_size and fail_fast default to fabconf['POOL_SIZE'] and fabconf['FAIL_FAST']
+    """
+    if pool_size is None:
+        pool_size = fabconf['POOL_SIZE']
+    if fail_fast is None:
+        fail_fast = fabconf['FAIL_FAST']
+    if hosts is None:
+        hosts = env.hosts
+
+    results = _run_on_hosts(func, hosts, pool_size=int(pool_size), fail_fast=_as_bool(fail_fast))
+    _print_summary(results)
+
+    failures = _failed(results)
+    if failures:
+        raise Exception("%d of %d hosts failed: %s" % (len(failures), len(results),
+                                                       ", ".join([f.host for f in failures])))
+    return results
+
+
+def _as_bool(value):
     """
-    Creates EC2 Instance
+    Task arguments arrive from the command line as strings, eg fab deploy:fail_fast=no
+    """
+    if isinstance(value, basestring):
+        return value.lower() not in ('', '0', 'no', 'false', 'off')
+    return bool(value)
+
+
+def _s3_bucket():
+    """
+    The bucket for the static files, on a connection of its own
+    """
+    conn = _TracedConnection(boto.connect_s3(fabconf['AWS_ACCESS_KEY'], fabconf['AWS_SECRET_KEY']), "s3")
+    return _TracedConnection(conn.get_bucket(fabconf['S3_STATIC_BUCKET'], validate=False), "s3")
+
+
+def _ec2_connection():
+    """
+    Connects to EC2 in the project's region
     """
-    print(_yellow("Creating instance"))
     conn = boto.ec2.connect_to_region(ec2_region, aws_access_key_id=fabconf['AWS_ACCESS_KEY'],
                                       aws_secret_access_key=fabconf['AWS_SECRET_KEY'])
+    return _TracedConnection(conn, ec2_region)
 
-    image = conn.get_all_images(ec2_amis)
 
-    reservation = image[0].run(1, 1, ec2_keypair, ec2_secgroups,
-                               instance_type=ec2_instancetype)
+def _elb_connection():
+    """
+    Connects to Elastic Load Balancing in the project's region
+    """
+    conn = boto.ec2.elb.connect_to_region(ec2_region, aws_access_key_id=fabconf['AWS_ACCESS_KEY'],
+                                          aws_secret_access_key=fabconf['AWS_SECRET_KEY'])
+    return _TracedConnection(conn, ec2_region)
 
-    this_instance = reservation.instances[0]
-    conn.create_tags([this_instance.id], {"Name": fabconf['INSTANCE_NAME_TAG']})
-    
-    while this_instance.state == u'pending':
-        print(_yellow("Instance state: %s" % this_instance.state))
-        time.sleep(10)
-        this_instance.update()
 
-    print(_green("Instance state: %s" % this_instance.state))
-    print(_green("Public dns: %s" % this_instance.public_dns_name))
-    
-    return this_instance.public_dns_name
+def _autoscale_connection():
+    """
+    Connects to Auto Scaling in the project's region
+    """
+    conn = boto.ec2.autoscale.connect_to_region(ec2_region, aws_access_key_id=fabconf['AWS_ACCESS_KEY'],
+                                                aws_secret_access_key=fabconf['AWS_SECRET_KEY'])
+    return _TracedConnection(conn, ec2_region)
+
+
+def _register_hosts(hosts):
+    """
+    Registers hosts with fabconf['ELB_NAME'], if there is one, and waits for them to pass its health check
+    """
+    if not fabconf['ELB_NAME'] or not hosts:
+        return
+    ids = _instance_ids(_ec2_connection(), [normalize(host)[1] for host in hosts])
+    _register(_elb_connection(), fabconf['ELB_NAME'], sorted(ids.values()), fabconf['ELB_REGISTER_TIMEOUT'])
 
 
-def _virtualenv(params):
+def _mark_provisioned(hosts):
+    """
+    Tags the instances of hosts as provisioned, so check_hosts() finds them
+    """
+    if not hosts:
+        return
+    ec2 = _ec2_connection()
+    _tag_provisioned(ec2, _instance_ids(ec2, [normalize(host)[1] for host in hosts]).values(),
+                     time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()))
+
+
+def _balanced_instances(concurrent=None):
+    """
+    {host: instance id} for the hosts to take out of fabconf['ELB_NAME'] while they are worked on, concurrent at a
+    time, or {} when there is no load balancer. Raises if that would take every host out at once
+    """
+    if not fabconf['ELB_NAME']:
+        return {}
+    concurrent = int(fabconf['POOL_SIZE'] if concurrent is None else concurrent)
+    if 1 < len(env.hosts) <= concurrent:
+        raise Exception("Taking all %d hosts out of %s at once would leave it none to send requests to, work on "
+                        "fewer at a time" % (len(env.hosts), fabconf['ELB_NAME']))
+    return _instance_ids(_ec2_connection(), [normalize(host)[1] for host in env.hosts])
+
+
+def _out_of_rotation(instances, func):
+    """
+    Runs func with the current host drained from fabconf['ELB_NAME'] and puts it back once it is healthy, see
+    scaling.out_of_service(). Just runs func for a host that is not in instances
+    """
+    instance_id = instances.get(normalize(env.host_string)[1])
+    if instance_id is None:
+        return func()
+    with _out_of_service(_elb_connection(), fabconf['ELB_NAME'], [instance_id], fabconf['ELB_DRAIN_SECONDS'],
+                         fabconf['ELB_REGISTER_TIMEOUT']):
+        return func()
+
+
+def _fleet_secret_key(hosts):
+    """
+    The SECRET_KEY of the first of hosts, so new servers share it and sessions and signed data work whichever
+    server answers, or a new one when there are no hosts
+    """
+    if not hosts:
+        return gen_secret()
+    remote_file = StringIO.StringIO()
+    with settings(host_string=hosts[0]):
+        _download(fabconf['SETTINGSDIR'] + '/secrets.json', local_path=remote_file)
+    return json.loads(remote_file.getvalue())['SECRET_KEY']
+
+
+def _wait_until_healthy():
+    """
+    Polls fabconf['HEALTH_CHECK_PATH'] through nginx on the server until it answers 200, for up to
+    fabconf['HEALTH_CHECK_TIMEOUT'] seconds
+    """
+    puts(_yellow("Waiting for %s to answer 200" % fabconf['HEALTH_CHECK_PATH']))
+    url = "http://127.0.0.1%s" % fabconf['HEALTH_CHECK_PATH']
+    _run("for i in $(seq %d); do "
+        "code=$(curl -s -o /dev/null -w '%%{http_code}' --max-time 5 %s); "
+        "test \"$code\" = 200 && exit 0; sleep 1; "
+        "done; echo \"Health check failed with $code\"; exit 1" % (int(fabconf['HEALTH_CHECK_TIMEOUT']), _quote(url)))
+
+
+def _create_ec2_instance(conn=None, ami=None, phases=None):
+    """
+    Creates EC2 Instance. Boots the newest baked image matching the current package lists, if
+    fabconf['USE_BAKED_IMAGE'] is set and there is one, else the base Ubuntu AMI
+    """
+    conn = conn or _ec2_connection()
+    if ami is None:
+        ami = _boot_ami(conn)
+    return _launch_ec2_instance(conn, ami, phases).public_dns_name
+
+
+def _launch_ec2_instance(conn, ami, phases=None, name=None):
+    """
+    Launches one instance of ami, waits for it to be running and returns it
+    """
+    return _launch_ec2_instances(conn, ami, 1, phases, name)[0]
+
+
+def _launch_ec2_instances(conn, ami, count, phases=None, name=None):
+    """
+    Launches count instances of ami in one reservation, waits for all of them to be running and returns them.
+    They are tagged with name, by default fabconf['INSTANCE_NAME_TAG']
+    """
+    phases = phases or _Phases()
+    with phases.phase("Launching instances"):
+        print(_yellow("Creating %d instance(s) from %s" % (count, ami)))
+        image = conn.get_all_images([ami])
+
+        with _span("boto", "run_instances", ec2_region):
+            reservation = image[0].run(count, count, ec2_keypair, ec2_secgroups,
+                                       instance_type=ec2_instancetype)
+
+        instance_ids = [this_instance.id for this_instance in reservation.instances]
+        # Left out of check_hosts() until they have been provisioned
+        conn.create_tags(instance_ids, {"Name": name or fabconf['INSTANCE_NAME_TAG'], _PROVISIONED_TAG: _UNPROVISIONED})
+
+    with phases.phase("Waiting for instances to run"):
+        instances = _wait_for_running(conn, instance_ids, fabconf['BOOT_TIMEOUT'])
+
+    for this_instance in instances:
+        print(_green("Instance %s state: %s" % (this_instance.id, this_instance.state)))
+        print(_green("Public dns: %s" % this_instance.public_dns_name))
+
+    return instances
+
+
+def _boot_ami(conn):
+    """
+    Returns the id of the newest baked image for the current resources, with fabconf['USE_BAKED_IMAGE'] and if
+    there is one, else ec2_amis[0]
+    """
+    return _boot_image(conn, ec2_amis[0], lambda: _image_key(ec2_amis[0], _baked_resources()),
+                       fabconf['USE_BAKED_IMAGE'])
+
+
+def _virtualenv(params, batch=None):
     """
     Allows running commands on the server
     with an active virtualenv
     """
     with cd(fabconf['APPS_DIR']):
-        _virtualenv_command(_render(params))
+        _virtualenv_command(_render(params), batch)
+
+
+def _apt(params, batch=None):
+    """
+    Runs apt-get install commands, installing all the packages with one apt-get
+    """
+    command = "apt-get install -qq %s" % " ".join(params)
+    if batch is not None:
+        batch.sudo(command, label="Installing apt-get packages")
+    else:
+        _sudo(command)
+
+
+def _push_wheelhouse():
+    """
+    Gives the current host the wheelhouse for the local requirements, building it there if there is no local
+    copy yet
+    """
+    files = _requirement_files(fabconf['LOCAL_REQUIREMENTS_DIR'], fabconf['WHEEL_REQUIREMENTS'])
+    _sync_wheelhouse(_wheelhouse_key(VIRTUALENV_PACKAGES, files), VIRTUALENV_PACKAGES, files,
+                     fabconf['WHEELHOUSE_PATH'], fabconf['WHEELHOUSE_DIR'])
 
 
-def _apt(params):
+def _pip(params, batch=None):
     """
-    Runs apt-get install commands
+    Runs pip install commands, installing all the packages with one pip
     """
-    for pkg in params:
-        sudo("apt-get install -qq %s" % pkg)
+    command = "pip install %s" % " ".join(params)
+    if batch is not None:
+        batch.sudo(command, label="Installing pip packages")
+    else:
+        _sudo(command)
+
+
+def _rendered(group=None):
+    """
+    Renders the templates in group, or all of them, into fabconf['RENDERED_DIR']
+    """
+    templates = [_Template(g, name, _r(destination), _r(owner), mode)
+                 for g, name, destination, owner, mode in TEMPLATES if group in (None, g)]
+    return _render_templates(templates, _r("%(FAB_CONFIG_PATH)s/templates"), fabconf['RENDERED_DIR'],
+                             _template_context())
+
+
+def _template_context():
+    """
+    fabconf, with the settings worked out from the hardware of ec2_instancetype
+    """
+    cpus, memory_mb = _instance_hardware(ec2_instancetype)
+    context = dict(fabconf, INSTANCE_TYPE=ec2_instancetype)
+    context.update(_memcached_settings(cpus, memory_mb, fabconf['MEMCACHED_MEMORY_PERCENT'],
+                                       fabconf['MEMCACHED_MEMORY_MB'], fabconf['MEMCACHED_CONNECTIONS']))
+    context.update(_system_settings(cpus, memory_mb, fabconf['SYSTEM_SETTINGS']))
+    if fabconf['PGBOUNCER']:
+        context.update(_pgbouncer_context(ec2_instancetype))
+    return context
+
+
+def _instance_hardware(instance_type):
+    """
+    (vCPUs, memory in MiB) of instance_type, from fabconf['INSTANCE_HARDWARE'] or hardware.py
+    """
+    return _lookup_hardware(instance_type, fabconf['INSTANCE_HARDWARE'])
 
 
-def _pip(params):
+def _gunicorn_tuning(instance_type, profile=None):
     """
-    Runs pip install commands
+    The settings gunicorn.conf.py works out for the hardware of instance_type and profile, by default
+    fabconf['GUNICORN_PROFILE']
     """
-    for pkg in params:
-        sudo("pip install %s" % pkg)
+    cpus, memory_mb = _instance_hardware(instance_type)
+    f = open(_r("%(FAB_CONFIG_PATH)s/templates/gunicorn.conf.py"), 'rb')
+    try:
+        config = {}
+        exec _render(f.read()) in config
+    finally:
+        f.close()
+    return config['tune'](profile or config['PROFILE'], cpus, memory_mb, config['OVERRIDES'])
+
+
+def _gunicorn_threads(settings):
+    # Requests each worker serves at once, which async workers set with worker_connections
+    if settings['worker_class'] in ('gevent', 'eventlet'):
+        return settings.get('worker_connections', 1000)
+    return settings.get('threads', 1)
+
+
+def _pgbouncer_context(instance_type):
+    """
+    PgBouncer's pool sizes for the gunicorn workers on instance_type and its databases and auth file for the
+    Postgres databases in the DATABASES of fabconf['SECRETS_PATH']
+    """
+    settings = _gunicorn_tuning(instance_type)
+    context = _pgbouncer_pool_sizes(settings['workers'], _gunicorn_threads(settings),
+                                    fabconf['PGBOUNCER_MAX_DB_CONNECTIONS'])
+    secrets_file = open(fabconf['SECRETS_PATH'], 'rb')
+    try:
+        databases = json.load(secrets_file).get('DATABASES', {})
+    finally:
+        secrets_file.close()
+    lines, users, pooled = _pooled_databases(databases, fabconf['PGBOUNCER_PORT'])
+    if not lines:
+        raise Exception("PGBOUNCER is on but the DATABASES in %s has no Postgres databases" %
+                        fabconf['SECRETS_PATH'])
+    context.update(PGBOUNCER_DATABASES="\n".join(lines), PGBOUNCER_USERLIST=_pgbouncer_userlist(users))
+    return context
+
+
+def _check_nginx(rendered):
+    """
+    Raises listing the problems lint finds in the rendered nginx config
+    """
+    problems = []
+    for r in rendered:
+        f = open(r.path, 'rb')
+        try:
+            problems.extend(["%s %s" % (r.template.name, problem) for problem in _nginx_lint(f.read())])
+        finally:
+            f.close()
+    if problems:
+        raise Exception("The nginx config has problems:\n" + "\n".join(problems))
+
+
+def _benchmark(target, host, port, options):
+    """
+    Runs one benchmark against host:port, prints it next to the previous run against target and saves it to
+    fabconf['BENCHMARK_DIR'] along with the settings it ran under
+    """
+    samples, elapsed = _run_load(host, port, options['path'], options['requests'], options['duration'],
+                                 options['concurrency'])
+    run = dict(options, target=target, url="http://%s:%d%s" % (host, port, options['path']),
+               started=time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(time.time() - elapsed)),
+               summary=_summarize(samples, elapsed), gunicorn_profile=fabconf['GUNICORN_PROFILE'],
+               gunicorn_settings=fabconf['GUNICORN_SETTINGS'],
+               templates=dict((r.template.name, r.sha1) for r in _rendered("gunicorn") + _rendered("nginx")))
+    _print_run(run, _previous_run(fabconf['BENCHMARK_DIR'], target))
+    print(_green("Saved %s" % _save_run(fabconf['BENCHMARK_DIR'], run)))
+
+
+def _precompress():
+    """
+    The command that writes compressed copies of the collected static files for nginx's gzip_static
+    """
+    return _precompress_command(fabconf['STATIC_ROOT'], fabconf['PRECOMPRESS_EXTENSIONS'],
+                                fabconf['PRECOMPRESS_BROTLI'])
+
+
+def _rendered_paths(group):
+    return [rendered.path for rendered in _rendered(group)]
+
+
+def _sync_templates(batch, group):
+    """
+    Uploads the templates in group that differ from the server's copies and adds their install steps to batch.
+    Returns the templates that changed
+    """
+    return _sync_rendered(batch, _rendered(group))
+
+
+def _install_templates(group):
+    with _Batch() as batch:
+        return _sync_templates(batch, group)
 
 
 def _put(params):
     """
     Moves a file from local computer to server
     """
-    put(_render(params['file']), _render(params['destination']))
+    _upload(_render(params['file']), _render(params['destination']))
 
 
-def _put_template(params):
+def _put_template(params, batch=None):
     """
     Same as _put() but it loads a file and does variable replacement
     """
     f = open(_render(params['template']), 'r')
     template = f.read()
 
-    run(_write_to(_render(template), _render(params['destination'])))
+    command = _write_to(_render(template), _render(params['destination']))
+    if batch is not None:
+        batch.run(command, label="Writing %s" % _render(params['destination']))
+    else:
+        _run(command)
 
 
 def _render(template, context=fabconf):
@@ -480,19 +1824,30 @@ def _write_to(string, the_path):
     """
     Writes a string to a file on the server
     """
-    return "echo '" + string + "' > " + the_path
+    return "printf '%s\\n' " + _quote(string) + " > " + the_path
 
 
 def _append_to(string, the_path):
     """
     Appends to a file on the server
     """
-    return "echo '" + string + "' >> " + the_path
+    return "printf '%s\\n' " + _quote(string) + " >> " + the_path
+
+
+def _append_line(line, the_path):
+    """
+    Appends a line to a file on the server unless the file already has it
+    """
+    return "grep -qxF %s %s 2>/dev/null || echo %s >> %s" % (_quote(line), the_path, _quote(line), the_path)
 
 
-def _virtualenv_command(command):
+def _virtualenv_command(command, batch=None):
     """
-    Activates virtualenv and runs command
+    Activates virtualenv and runs command, or adds it to batch
     """
     with cd(fabconf['APPS_DIR']):
-        sudo(fabconf['ACTIVATE'] + ' && ' + command, user=fabconf['SERVER_USERNAME'])
+        if batch is not None:
+            batch.sudo(fabconf['ACTIVATE'] + ' && ' + command, label=command, user=fabconf['SERVER_USERNAME'])
+        else:
+            with _span("virtualenv", command):
+                _sudo(fabconf['ACTIVATE'] + ' && ' + command, user=fabconf['SERVER_USERNAME'])
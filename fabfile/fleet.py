@@ -0,0 +1,206 @@
+"""
+--------------------------------------------------------------------------------------
+fleet.py
+--------------------------------------------------------------------------------------
+Samples how busy each server is: CPU, load, memory, the memory of the gunicorn, nginx,
+memcached and PgBouncer processes, and the connections they hold.
+
+One command is run per host per sample. It reads /proc and ps, which every server has,
+and counts the TCP connections by state and local port on the server with awk, so
+a busy server sends back a few lines rather than its whole connection table. The CPU
+figures are the change in /proc/stat over a short sleep inside the same command.
+"""
+import os
+import csv
+import json
+import subprocess
+
+from fabric.colors import green as _green, yellow as _yellow, red as _red
+
+from batch import quote
+
+# The processes whose memory is reported, and a word their command lines contain
+PROCESSES = [('gunicorn', 'gunicorn'), ('nginx', 'nginx:'), ('memcached', 'memcached'), ('pgbouncer', 'pgbouncer')]
+
+# The columns of the CSV export, in order
+FIELDS = ['time', 'host', 'cpus', 'cpu', 'iowait', 'steal', 'load1', 'load5', 'mem_total_mb', 'mem_used_mb',
+          'swap_used_mb'] + ['%s_%s' % (name, field) for name, _ in PROCESSES for field in ('procs', 'rss_mb')] + \
+         ['http_connections', 'gunicorn_connections', 'memcached_connections', 'pgbouncer_connections',
+          'established', 'time_wait']
+
+_ESTABLISHED = '01'
+_TIME_WAIT = '06'
+
+
+def sample_command(cpu_interval, gunicorn_socket):
+    """
+    Returns a shell command that prints the sections sample() parses, measuring the CPU over cpu_interval seconds
+    """
+    return ' ; '.join([
+        'echo "== stat"', 'head -1 /proc/stat', 'sleep %s' % float(cpu_interval), 'head -1 /proc/stat',
+        'echo "== cpus"', 'grep -c ^processor /proc/cpuinfo',
+        'echo "== loadavg"', 'cat /proc/loadavg',
+        'echo "== meminfo"', 'cat /proc/meminfo',
+        # The shell running this command goes first, so it is not counted as gunicorn for the socket path below
+        'echo "== ps"', 'echo $$', 'ps -eo pid=,rss=,args=',
+        'echo "== tcp"', 'awk %s /proc/net/tcp /proc/net/tcp6 2>/dev/null' % quote(
+            'FNR > 1 { split($2, addr, ":"); count[$4 " " addr[2]]++ } END { for (k in count) print k, count[k] }'),
+        # Each connection nginx has open to gunicorn's socket is a connected socket with the socket's path
+        'echo "== unix"', 'awk %s /proc/net/unix' % quote(
+            '$6 == "03" && $8 == "%s" { n++ } END { print n + 0 }' % gunicorn_socket),
+    ])
+
+
+def sample(output, ports):
+    """
+    Returns the figures in the output of sample_command() as a dict with the keys in FIELDS, except time and
+    host. ports maps http, memcached and pgbouncer to the port each listens on
+    """
+    sections = _sections(output)
+    stats = {}
+
+    cpu = [[int(n) for n in line.split()[1:]] for line in sections.get('stat', []) if line.startswith('cpu')]
+    if len(cpu) == 2:
+        # user nice system idle iowait irq softirq steal
+        delta = [after - before for before, after in zip(cpu[0], cpu[1])]
+        delta += [0] * (8 - len(delta))
+        total = float(sum(delta[:8])) or 1.0
+        stats['cpu'] = round(100 * (total - delta[3] - delta[4]) / total, 1)
+        stats['iowait'] = round(100 * delta[4] / total, 1)
+        stats['steal'] = round(100 * delta[7] / total, 1)
+    stats['cpus'] = int((sections.get('cpus') or ['0'])[0])
+
+    load = (sections.get('loadavg') or ['0 0'])[0].split()
+    stats['load1'], stats['load5'] = float(load[0]), float(load[1])
+
+    meminfo = {}
+    for line in sections.get('meminfo', []):
+        words = line.replace(':', ' ').split()
+        if len(words) >= 2:
+            meminfo[words[0]] = int(words[1]) // 1024
+    # Kernels before 3.14 have no MemAvailable, where free memory and the page cache are the nearest thing
+    available = meminfo.get('MemAvailable', meminfo.get('MemFree', 0) + meminfo.get('Buffers', 0) +
+                            meminfo.get('Cached', 0))
+    stats['mem_total_mb'] = meminfo.get('MemTotal', 0)
+    stats['mem_used_mb'] = stats['mem_total_mb'] - available
+    stats['swap_used_mb'] = meminfo.get('SwapTotal', 0) - meminfo.get('SwapFree', 0)
+
+    for name, _ in PROCESSES:
+        stats[name + '_procs'] = stats[name + '_rss_mb'] = 0
+    processes = sections.get('ps') or ['']
+    for line in processes[1:]:
+        words = line.split(None, 2)
+        if len(words) < 3 or words[0] == processes[0] or not words[1].isdigit():
+            continue
+        for name, word in PROCESSES:
+            if word in words[2]:
+                stats[name + '_procs'] += 1
+                stats[name + '_rss_mb'] += int(words[1]) // 1024
+                break
+
+    by_port = {}
+    stats['established'] = stats['time_wait'] = 0
+    for line in sections.get('tcp', []):
+        words = line.split()
+        if len(words) != 3:
+            continue
+        state, port, count = words[0], int(words[1], 16), int(words[2])
+        if state == _ESTABLISHED:
+            stats['established'] += count
+            by_port[port] = by_port.get(port, 0) + count
+        elif state == _TIME_WAIT:
+            stats['time_wait'] += count
+    for name in ('http', 'memcached', 'pgbouncer'):
+        stats[name + '_connections'] = by_port.get(int(ports[name]), 0) if ports.get(name) else 0
+    stats['gunicorn_connections'] = int((sections.get('unix') or ['0'])[0])
+    return stats
+
+
+def sample_host(ssh, host, cpu_interval, gunicorn_socket, ports):
+    """
+    Samples host over the ssh command ssh, see sample_command() and sample()
+    """
+    proc = subprocess.Popen(ssh + [host, sample_command(cpu_interval, gunicorn_socket)], stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE)
+    output, error = proc.communicate()
+    if proc.returncode:
+        raise Exception("Sampling %s failed with exit code %d: %s" % (host, proc.returncode, error.strip()))
+    return sample(output, ports)
+
+
+def print_table(rows, title=None):
+    """
+    Prints one line per (host, stats) row, with stats None for a host that could not be sampled
+    """
+    if title:
+        print(_yellow(title))
+    width = max([len(host) for host, _ in rows] + [4])
+    print(_yellow("  %-*s %6s %6s %6s %11s %11s %6s  %-14s %-14s %-14s %-14s %6s %6s %6s" % (
+        width, "host", "cpu", "steal", "load", "mem MB", "swap MB", "http", "gunicorn", "nginx", "memcached",
+        "pgbouncer", "app", "cache", "tw")))
+    for host, stats in rows:
+        if stats is None:
+            print(_red("  %-*s not sampled" % (width, host)))
+            continue
+        processes = ["%d/%dM" % (stats[name + '_procs'], stats[name + '_rss_mb']) for name, _ in PROCESSES]
+        line = "  %-*s %5s%% %5s%% %6.2f %11s %11d %6d  %-14s %-14s %-14s %-14s %6d %6d %6d" % tuple(
+            [width, host, stats.get('cpu', '-'), stats.get('steal', '-'), stats['load1'],
+             "%d/%d" % (stats['mem_used_mb'], stats['mem_total_mb']), stats['swap_used_mb'],
+             stats['http_connections']] + processes +
+            [stats['gunicorn_connections'], stats['memcached_connections'], stats['time_wait']])
+        print(_colour(stats)(line))
+
+
+def write_csv(path, rows, when):
+    """
+    Appends (host, stats) rows sampled at when to the CSV file at path, starting it with a header if it is new
+    """
+    new = not os.path.exists(path) or os.path.getsize(path) == 0
+    f = open(path, 'ab')
+    try:
+        writer = csv.DictWriter(f, FIELDS, extrasaction='ignore')
+        if new:
+            writer.writerow(dict(zip(FIELDS, FIELDS)))
+        for host, stats in rows:
+            if stats is not None:
+                writer.writerow(dict(stats, time=when, host=host))
+    finally:
+        f.close()
+
+
+def write_json(path, samples):
+    """
+    Writes samples, a list of {time, hosts: {host: stats}}, to the JSON file at path, replacing it whole so an
+    interrupted run leaves a complete file
+    """
+    f = open(path + '.tmp', 'wb')
+    try:
+        json.dump(samples, f, indent=2, sort_keys=True)
+    finally:
+        f.close()
+    os.rename(path + '.tmp', path)
+
+
+def _sections(output):
+    sections = {}
+    lines = None
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith('== '):
+            lines = sections.setdefault(line[3:], [])
+        elif line and lines is not None:
+            lines.append(line)
+    return sections
+
+
+def _colour(stats):
+    """
+    Red for a host that is out of CPU or into swap, yellow for one getting there
+    """
+    load = stats['load1'] / stats['cpus'] if stats['cpus'] else 0
+    memory = float(stats['mem_used_mb']) / stats['mem_total_mb'] if stats['mem_total_mb'] else 0
+    if stats.get('cpu', 0) >= 90 or load >= 2 or stats['swap_used_mb'] > 0 and memory >= 0.9:
+        return _red
+    if stats.get('cpu', 0) >= 70 or load >= 1 or memory >= 0.85 or stats.get('steal', 0) >= 10:
+        return _yellow
+    return _green
@@ -0,0 +1,77 @@
+"""
+--------------------------------------------------------------------------------------
+hardware.py
+--------------------------------------------------------------------------------------
+The vCPUs and memory of the EC2 instance types, so settings that depend on the
+hardware can be worked out locally for ec2_instancetype without a server to ask.
+
+Types missing from the table can be given in fabconf['INSTANCE_HARDWARE']. Any other
+type is sized as DEFAULT_HARDWARE, a small instance, with a warning, so a new type
+never stops a deploy but does not get settings bigger than its hardware either.
+"""
+from fabric.colors import yellow as _yellow
+
+# (vCPUs, memory in MiB) assumed for an instance type that is not known
+DEFAULT_HARDWARE = (1, 1024)
+
+# Instance type: (vCPUs, memory in MiB)
+INSTANCE_TYPES = {
+    't1.micro': (1, 613),
+    't2.nano': (1, 512),
+    't2.micro': (1, 1024),
+    't2.small': (1, 2048),
+    't2.medium': (2, 4096),
+    't2.large': (2, 8192),
+    'm1.small': (1, 1740),
+    'm1.medium': (1, 3840),
+    'm1.large': (2, 7680),
+    'm1.xlarge': (4, 15360),
+    'm3.medium': (1, 3840),
+    'm3.large': (2, 7680),
+    'm3.xlarge': (4, 15360),
+    'm3.2xlarge': (8, 30720),
+    'm4.large': (2, 8192),
+    'm4.xlarge': (4, 16384),
+    'm4.2xlarge': (8, 32768),
+    'm4.4xlarge': (16, 65536),
+    'c1.medium': (2, 1740),
+    'c1.xlarge': (8, 7168),
+    'c3.large': (2, 3840),
+    'c3.xlarge': (4, 7680),
+    'c3.2xlarge': (8, 15360),
+    'c3.4xlarge': (16, 30720),
+    'c4.large': (2, 3840),
+    'c4.xlarge': (4, 7680),
+    'c4.2xlarge': (8, 15360),
+    'c4.4xlarge': (16, 30720),
+    'r3.large': (2, 15616),
+    'r3.xlarge': (4, 31232),
+    'r3.2xlarge': (8, 62464),
+    't3.nano': (2, 512),
+    't3.micro': (2, 1024),
+    't3.small': (2, 2048),
+    't3.medium': (2, 4096),
+    't3.large': (2, 8192),
+    't3.xlarge': (4, 16384),
+    't3.2xlarge': (8, 32768),
+}
+
+# The unknown types already warned about
+_warned = set()
+
+
+def instance_hardware(instance_type, overrides=None):
+    """
+    Returns (vCPUs, memory in MiB) for instance_type from overrides, {instance type: (vCPUs, memory in MiB)},
+    or INSTANCE_TYPES, and DEFAULT_HARDWARE for a type in neither
+    """
+    if overrides and instance_type in overrides:
+        cpus, memory_mb = overrides[instance_type]
+        return int(cpus), int(memory_mb)
+    if instance_type in INSTANCE_TYPES:
+        return INSTANCE_TYPES[instance_type]
+    if instance_type not in _warned:
+        _warned.add(instance_type)
+        print(_yellow("Unknown instance type %s, sizing it as %d vCPUs and %d MiB. Give its hardware in "
+                      "fabconf['INSTANCE_HARDWARE']" % ((instance_type,) + DEFAULT_HARDWARE)))
+    return DEFAULT_HARDWARE
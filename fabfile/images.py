@@ -0,0 +1,103 @@
+"""
+--------------------------------------------------------------------------------------
+images.py
+--------------------------------------------------------------------------------------
+Pre-baked AMIs. A builder instance is provisioned with the slow, project independent
+resources (apt and pip packages, the virtualenv with its compiled packages) and then
+snapshotted into an AMI.
+
+Each image is tagged with a key hashed from the base AMI and the fingerprints of the
+resources baked into it, so any change to the package lists gives a new key and the
+old images stop matching. The baked resources leave their fingerprints in the image's
+state directory, so converging an instance booted from the image skips them.
+
+The functions take a boto EC2 connection so they can be driven by a fake one.
+"""
+import time
+import hashlib
+
+from fabric.colors import green as _green, yellow as _yellow
+
+KEY_TAG = 'fabric:image-key'
+BAKED_AT_TAG = 'fabric:baked-at'
+
+
+def image_key(base_ami, resources):
+    """
+    Hashes the base AMI and the fingerprints of the resources baked on top of it
+    """
+    digest = hashlib.sha1(base_ami)
+    for resource in resources:
+        digest.update(resource.name)
+        digest.update(resource.fingerprint())
+    return digest.hexdigest()
+
+
+def find_image(conn, key):
+    """
+    Returns the newest available image of ours tagged with key, or None
+    """
+    images = conn.get_all_images(owners=['self'], filters={'tag:%s' % KEY_TAG: key})
+    images = [image for image in images if image.state == u'available']
+    if not images:
+        return None
+    return max(images, key=lambda image: image.tags.get(BAKED_AT_TAG, ''))
+
+
+def create_image(conn, instance_id, key, name_prefix, poll=15, sleep=time.sleep):
+    """
+    Snapshots instance_id into a new AMI named after name_prefix, key and the time, waits for it to become
+    available and tags it with key. Returns the image id
+    """
+    baked_at = time.strftime('%Y%m%d%H%M%S', time.gmtime())
+    name = '%s-%s-%s' % (name_prefix, key[:12], baked_at)
+    print(_yellow("Creating image %s" % name))
+    image_id = conn.create_image(instance_id, name, description='Baked by fabfile, key %s' % key)
+
+    image = conn.get_image(image_id)
+    while image.state == u'pending':
+        print(_yellow("Image state: %s" % image.state))
+        sleep(poll)
+        image.update()
+
+    if image.state != u'available':
+        raise Exception("Image %s ended up %s instead of available" % (image_id, image.state))
+
+    conn.create_tags([image_id], {KEY_TAG: key, BAKED_AT_TAG: baked_at, 'Name': name})
+    print(_green("Image %s is available" % image_id))
+    return image_id
+
+
+def bake(conn, key, launch, provision, name_prefix, force=False, poll=15, sleep=time.sleep):
+    """
+    Returns the id of the newest image baked for key, unless force is set or there is none. Then launch() starts
+    a builder instance, provision(builder) sets it up, and it is snapshotted into a new image and terminated,
+    whether or not that worked
+    """
+    existing = find_image(conn, key)
+    if existing is not None and not force:
+        print(_green("Image %s is already baked for the current packages" % existing.id))
+        return existing.id
+
+    builder = launch()
+    try:
+        provision(builder)
+        return create_image(conn, builder.id, key, name_prefix, poll, sleep)
+    finally:
+        print(_yellow("Terminating builder %s" % builder.id))
+        conn.terminate_instances([builder.id])
+
+
+def boot_image(conn, base_ami, key, enabled=True):
+    """
+    The AMI to boot new instances from: the newest image baked for key() if enabled and there is one, else
+    base_ami. key is a function, so nothing is hashed when baked images are off
+    """
+    if not enabled:
+        return base_ami
+    image = find_image(conn, key())
+    if image is None:
+        print(_yellow("No baked image matches the current packages, run fab bake_image to make one"))
+        return base_ami
+    print(_green("Using baked image %s" % image.id))
+    return image.id
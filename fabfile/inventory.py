@@ -0,0 +1,51 @@
+"""
+--------------------------------------------------------------------------------------
+inventory.py
+--------------------------------------------------------------------------------------
+The generated inventory: a JSON file listing the instances spawned by spawn_fleet, so
+they are worked on without being pasted into fabconf['EC2_INSTANCES'] by hand.
+"""
+import os
+import json
+import time
+
+
+def read_inventory(path):
+    """
+    Returns the inventory entries, each a dict with host, instance_id and launched. An
+    inventory that does not exist yet is empty
+    """
+    if not os.path.exists(path):
+        return []
+    f = open(path, 'rb')
+    try:
+        return json.load(f)['instances']
+    finally:
+        f.close()
+
+
+def inventory_hosts(path):
+    return [entry['host'] for entry in read_inventory(path)]
+
+
+def add_to_inventory(path, instances):
+    """
+    Adds (host, instance id) pairs to the inventory, replacing any entries for the same hosts
+    """
+    hosts = [host for host, instance_id in instances]
+    entries = [entry for entry in read_inventory(path) if entry['host'] not in hosts]
+    launched = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    for host, instance_id in instances:
+        entries.append({'host': host, 'instance_id': instance_id, 'launched': launched})
+    _write(path, entries)
+
+
+def _write(path, entries):
+    # Write then rename so a crash never leaves a half written inventory
+    temp_path = path + '.tmp'
+    f = open(temp_path, 'wb')
+    try:
+        json.dump({'instances': entries}, f, indent=2)
+    finally:
+        f.close()
+    os.rename(temp_path, path)
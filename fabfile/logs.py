@@ -0,0 +1,217 @@
+"""
+--------------------------------------------------------------------------------------
+logs.py
+--------------------------------------------------------------------------------------
+Finds the slow endpoints in nginx's access logs.
+
+nginx logs in the "timed" format from templates/nginx.conf: the combined format followed
+by $request_time, $upstream_response_time and $upstream_cache_status. Lines are read one
+at a time, from local files or from a server over ssh, and each is counted against its
+endpoint, the path with ids such as /users/42/ folded into /users/{id}/. Latencies are
+kept as counts per millisecond, so memory grows with the number of endpoints and not
+with the size of the logs, and summaries from several hosts add up. Paths that are not
+ids, such as slugs or probes for random URLs, can make endpoints without end, so past
+MAX_ENDPOINTS the new ones are counted together under OTHER.
+"""
+import re
+import gzip
+import glob
+import heapq
+import subprocess
+
+from fabric.colors import yellow as _yellow, red as _red
+
+# The "timed" log_format in templates/nginx.conf. Lines in the plain combined format are counted without timings
+LINE = re.compile(r'^(?P<addr>\S+) \S+ (?P<user>\S+) \[(?P<time>[^\]]+)\] "(?P<request>[^"]*)" (?P<status>\d{3}) '
+                  r'(?P<bytes>\d+|-) "(?P<referer>[^"]*)" "(?P<agent>[^"]*)"'
+                  r'(?: (?P<request_time>[\d.]+) "(?P<upstream_time>[^"]*)" (?P<cache>\S+))?')
+
+# Path segments that are ids rather than part of the endpoint: numbers, uuids and long hex strings
+ID_SEGMENT = re.compile(r'^(\d+|[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}|'
+                        r'[0-9a-fA-F]{16,})$')
+
+# The most endpoints a summary keeps apart, and the one the requests to any others are counted under
+MAX_ENDPOINTS = 1000
+OTHER = '(other endpoints)'
+
+
+def parse(line):
+    """
+    Returns the method, URL, status, request time and upstream time in seconds and cache status of an access
+    log line, with None for the times a line does not have, or None if it is not an access log line
+    """
+    match = LINE.match(line)
+    if not match:
+        return None
+    parts = match.group('request').split()
+    method, url = (parts[0], parts[1]) if len(parts) >= 2 else ('-', match.group('request') or '-')
+    request_time = float(match.group('request_time')) if match.group('request_time') else None
+    # Each upstream tried adds a comma separated time, "-" when nginx answered itself, eg from the cache
+    upstream = [float(t) for t in re.split(r'[,:]\s*', match.group('upstream_time') or '') if _is_number(t)]
+    return (method, url, int(match.group('status')), request_time, sum(upstream) if upstream else None,
+            match.group('cache') or '-')
+
+
+def endpoint(method, url):
+    """
+    The endpoint a request counts towards: its method and path, without the query string and with ids folded
+    """
+    path = url.split('?', 1)[0]
+    return '%s %s' % (method, '/'.join('{id}' if ID_SEGMENT.match(segment) else segment
+                                       for segment in path.split('/')))
+
+
+def analyze(lines, slowest=20, max_endpoints=MAX_ENDPOINTS):
+    """
+    Returns a summary of the access log lines: per endpoint the request and error counts and the latencies in
+    milliseconds as {ms: count}, for the whole request and for gunicorn, and the slowest requests. Endpoints
+    first seen once there are max_endpoints are counted under OTHER
+    """
+    summary = {'lines': 0, 'unparsed': 0, 'endpoints': {}, 'slowest': []}
+    endpoints = summary['endpoints']
+    slow = summary['slowest']
+    for line in lines:
+        summary['lines'] += 1
+        request = parse(line)
+        if request is None:
+            summary['unparsed'] += 1
+            continue
+        method, url, status, request_time, upstream_time, cache = request
+        stats = _endpoint_stats(endpoints, endpoint(method, url), max_endpoints)
+        stats['count'] += 1
+        if status >= 500:
+            stats['errors'] += 1
+        if cache == 'HIT':
+            stats['cached'] += 1
+        if request_time is not None:
+            _add(stats['latency'], request_time)
+            entry = (request_time, url, status, method)
+            if len(slow) < slowest:
+                heapq.heappush(slow, entry)
+            elif entry > slow[0]:
+                heapq.heapreplace(slow, entry)
+        if upstream_time is not None:
+            _add(stats['upstream'], upstream_time)
+    return summary
+
+
+def merge(summaries, slowest=20, max_endpoints=MAX_ENDPOINTS):
+    """
+    Adds up summaries, eg from several hosts, keeping up to max_endpoints apart like analyze()
+    """
+    total = {'lines': 0, 'unparsed': 0, 'endpoints': {}, 'slowest': []}
+    for summary in summaries:
+        total['lines'] += summary['lines']
+        total['unparsed'] += summary['unparsed']
+        total['slowest'] = heapq.nlargest(slowest, total['slowest'] + [tuple(s) for s in summary['slowest']])
+        for key, stats in summary['endpoints'].items():
+            into = _endpoint_stats(total['endpoints'], key, max_endpoints)
+            for name in ('count', 'errors', 'cached'):
+                into[name] += stats[name]
+            for name in ('latency', 'upstream'):
+                for ms, count in stats[name].items():
+                    into[name][ms] = into[name].get(ms, 0) + count
+    return total
+
+
+def percentile(counts, p):
+    """
+    The nearest-rank p-th percentile of latencies kept as {ms: count}
+    """
+    total = sum(counts.values())
+    if not total:
+        return None
+    rank = max(1, int(-(-p * total // 100)))
+    seen = 0
+    for ms in sorted(counts):
+        seen += counts[ms]
+        if seen >= rank:
+            return ms
+    return max(counts)
+
+
+def local_lines(paths):
+    """
+    Yields the lines of local log files, reading gzipped rotations too
+    """
+    for pattern in paths:
+        for path in sorted(glob.glob(pattern)):
+            f = gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+            try:
+                for line in f:
+                    yield line
+            finally:
+                f.close()
+
+
+def read_command(paths):
+    """
+    Returns a shell command that prints the log files matching the glob patterns paths, gzipped or not
+    """
+    return 'for f in %s; do if test -f "$f"; then zcat -f -- "$f"; fi; done' % ' '.join(
+        pattern.replace(' ', '\\ ') for pattern in paths)
+
+
+def remote_lines(ssh, host, paths):
+    """
+    Yields the lines of the log files matching paths on host, streamed over the ssh command ssh
+    """
+    proc = subprocess.Popen(ssh + [host, read_command(paths)], stdout=subprocess.PIPE)
+    try:
+        for line in proc.stdout:
+            yield line
+    finally:
+        proc.stdout.close()
+        if proc.wait():
+            raise Exception("Reading the logs on %s failed with exit code %d" % (host, proc.returncode))
+
+
+def print_report(summary, limit=20):
+    """
+    Prints the endpoints that take the most time in total, with their counts and latency percentiles, and the
+    slowest requests
+    """
+    print(_yellow("%d lines, %d not in the access log format, %d endpoints" % (
+        summary['lines'], summary['unparsed'], len(summary['endpoints']))))
+    rows = sorted(summary['endpoints'].items(), key=lambda item: -_total_ms(item[1]['latency']))
+    print(_yellow("  %-50s %8s %7s %7s %8s %8s %8s %8s %8s" % ("endpoint", "requests", "5xx", "cached", "p50 ms",
+                                                               "p95 ms", "p99 ms", "max ms", "app p95")))
+    for key, stats in rows[:int(limit)]:
+        latency = stats['latency']
+        values = [percentile(latency, 50), percentile(latency, 95), percentile(latency, 99),
+                  max(latency) if latency else None, percentile(stats['upstream'], 95)]
+        line = "  %-50s %8d %7d %7d " % (key[:50], stats['count'], stats['errors'], stats['cached']) + " ".join(
+            "%8s" % ('-' if value is None else value) for value in values)
+        print(_red(line) if stats['errors'] else line)
+
+    if summary['slowest']:
+        print(_yellow("Slowest requests:"))
+        for request_time, url, status, method in sorted(summary['slowest'], reverse=True):
+            print("  %8.3fs %d %s %s" % (request_time, status, method, url[:100]))
+
+
+def _endpoint_stats(endpoints, key, max_endpoints):
+    # OTHER is the one endpoint allowed past the limit
+    if key not in endpoints and len(endpoints) >= max_endpoints:
+        key = OTHER
+    stats = endpoints.get(key)
+    if stats is None:
+        stats = endpoints[key] = {'count': 0, 'errors': 0, 'cached': 0, 'latency': {}, 'upstream': {}}
+    return stats
+
+
+def _add(counts, seconds):
+    ms = int(round(seconds * 1000))
+    counts[ms] = counts.get(ms, 0) + 1
+
+
+def _total_ms(counts):
+    return sum(ms * count for ms, count in counts.items())
+
+
+def _is_number(value):
+    try:
+        float(value)
+        return True
+    except ValueError:
+        return False
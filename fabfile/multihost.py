@@ -0,0 +1,178 @@
+"""
+--------------------------------------------------------------------------------------
+multihost.py
+--------------------------------------------------------------------------------------
+Runs a function against a list of hosts, either one after another or in a pool of
+forked workers, and collects per-host timings and failures into one summary.
+
+The executor is pluggable: it is any callable taking (host, func) that runs func
+against host and returns its result. fabric_executor() does this over SSH; a fake
+executor lets the scheduling, fail-fast and summary logic run locally.
+"""
+import time
+import pickle
+import traceback
+import multiprocessing
+from Queue import Empty
+
+from fabric.api import settings
+from fabric.network import disconnect_all
+from fabric.colors import green as _green, red as _red, yellow as _yellow
+
+OK = 'ok'
+FAILED = 'failed'
+SKIPPED = 'skipped'
+
+
+class HostResult(object):
+    """
+    The outcome of running a function on one host
+    """
+    def __init__(self, host, status, elapsed=0.0, value=None, error=None):
+        self.host = host
+        self.status = status
+        self.elapsed = elapsed
+        self.value = value
+        self.error = error
+
+    @property
+    def ok(self):
+        return self.status == OK
+
+    def __repr__(self):
+        return '<HostResult %s %s %.2fs>' % (self.host, self.status, self.elapsed)
+
+
+def fabric_executor(host, func):
+    """
+    Runs func with Fabric pointed at host
+    """
+    with settings(host_string=host):
+        return func()
+
+
+def run_on_hosts(func, hosts, pool_size=1, fail_fast=True, executor=fabric_executor):
+    """
+    Runs func once per host and returns a list of HostResults in the same order as hosts.
+
+    With pool_size <= 1 the hosts are done one after another in this process. Otherwise up to
+    pool_size forked workers run at once. With fail_fast the first failure stops any further
+    hosts from being started; hosts that never ran are reported as skipped.
+    """
+    hosts = list(hosts)
+    if pool_size <= 1 or len(hosts) <= 1:
+        results = _run_serial(func, hosts, fail_fast, executor)
+    else:
+        results = _run_parallel(func, hosts, pool_size, fail_fast, executor)
+    return [results[host] for host in hosts]
+
+
+def failed(results):
+    """
+    Returns the results that did not succeed, skipped hosts included
+    """
+    return [result for result in results if not result.ok]
+
+
+def print_summary(results, title="Summary"):
+    """
+    Prints one line per host with its status and elapsed time, slowest first
+    """
+    print(_yellow("%s (%d hosts)" % (title, len(results))))
+    width = max([len(result.host) for result in results] + [4])
+    for result in sorted(results, key=lambda r: r.elapsed, reverse=True):
+        line = "  %-*s  %-7s  %8.2fs" % (width, result.host, result.status, result.elapsed)
+        if result.ok:
+            print(_green(line))
+        else:
+            print(_red(line + "  " + (result.error or '').strip().split('\n')[-1]))
+    if results:
+        print(_yellow("  %d ok, %d failed, %d skipped, slowest %.2fs" % (
+            len([r for r in results if r.status == OK]),
+            len([r for r in results if r.status == FAILED]),
+            len([r for r in results if r.status == SKIPPED]),
+            max([r.elapsed for r in results]))))
+
+
+def _run_one(func, host, executor):
+    start = time.time()
+    try:
+        value = executor(host, func)
+    except (Exception, SystemExit) as e:
+        # Fabric's abort() raises SystemExit, which should fail the host rather than the whole run
+        error = traceback.format_exc() if isinstance(e, Exception) else 'aborted'
+        return HostResult(host, FAILED, time.time() - start, error=error)
+    return HostResult(host, OK, time.time() - start, value=value)
+
+
+def _run_serial(func, hosts, fail_fast, executor):
+    results = {}
+    for host in hosts:
+        if fail_fast and any(not r.ok for r in results.values()):
+            results[host] = HostResult(host, SKIPPED, error='skipped after an earlier failure')
+            continue
+        results[host] = _run_one(func, host, executor)
+    return results
+
+
+def _worker(func, host, executor, queue):
+    result = _run_one(func, host, executor)
+    try:
+        pickle.dumps(result.value)
+    except Exception:
+        result.value = repr(result.value)
+    queue.put(result)
+    disconnect_all()
+
+
+def _run_parallel(func, hosts, pool_size, fail_fast, executor):
+    # Forked workers must not share the parent's SSH connections
+    disconnect_all()
+
+    queue = multiprocessing.Queue()
+    pending = list(hosts)
+    running = {}
+    results = {}
+    stopping = False
+
+    while running or (pending and not stopping):
+        while pending and not stopping and len(running) < pool_size:
+            host = pending.pop(0)
+            proc = multiprocessing.Process(target=_worker, args=(func, host, executor, queue))
+            proc.start()
+            running[host] = proc
+
+        # A worker that is already dead has flushed its result, so if the queue comes up empty
+        # these hosts died without reporting
+        dead = [name for name, worker in running.items() if not worker.is_alive()]
+        try:
+            result = queue.get(timeout=1)
+        except Empty:
+            for host in dead:
+                proc = running.pop(host)
+                results[host] = HostResult(host, FAILED, error='worker exited with code %s' % proc.exitcode)
+            result = None
+
+        if result is not None:
+            running.pop(result.host).join()
+            results[result.host] = result
+
+        if fail_fast and not stopping and any(not r.ok for r in results.values()):
+            stopping = True
+            # Keep the results of workers that finished while we were looking the other way
+            while True:
+                try:
+                    result = queue.get(timeout=0.1)
+                except Empty:
+                    break
+                running.pop(result.host).join()
+                results[result.host] = result
+            for host, proc in running.items():
+                proc.terminate()
+                proc.join()
+                results[host] = HostResult(host, FAILED, error='terminated after a failure on another host')
+            running = {}
+
+    for host in pending:
+        results[host] = HostResult(host, SKIPPED, error='skipped after an earlier failure')
+    return results
@@ -23,7 +23,7 @@ fabconf['ADMIN_EMAIL'] = "admin@example.com"
 fabconf['BITBUCKET_USERNAME'] = ''
 fabconf['BITBUCKET_REPO_NAME'] = ''
 
-# Name tag for your server instance on EC2
+# Name tag for your server instances on EC2. With HOSTS_FROM_TAGS the commands work on the instances that have it
 fabconf['INSTANCE_NAME_TAG'] = "MyInstance"
 
 # EC2 key. http://bit.ly/j5ImEZ
@@ -0,0 +1,86 @@
+"""
+--------------------------------------------------------------------------------------
+nginx.py
+--------------------------------------------------------------------------------------
+Applies new nginx config to a running nginx without stopping it.
+
+The rendered configs are linted locally first, so a broken template is caught before
+any server is touched. On the server the current /etc/nginx is snapshotted, the new
+files are installed and checked with nginx -t. If the check passes nginx is sent a
+graceful reload, which starts new workers on the new config while the old ones finish
+their requests and keepalive connections. If it fails the snapshot is put back, so
+the files on disk always match what nginx is running.
+"""
+import re
+
+NGINX_DIR = '/etc/nginx'
+SNAPSHOT_DIR = '/etc/nginx.previous'
+
+_TOKEN = re.compile(r'''#[^\n]*|"(?:\\.|[^"\\])*"|'(?:\\.|[^'\\])*'|[{};]|[^\s{};#"']+|\n|\s+''')
+_PLACEHOLDER = re.compile(r'%\(\w+\)\w')
+
+
+def lint(text):
+    """
+    Checks the structure of an nginx config: braces that balance, directives ended with ; and closed
+    quotes, and no %(name)s placeholders left from the template. Returns a list of problems, each
+    prefixed with its line number
+    """
+    problems = []
+    depth = []
+    pending = None
+    line = 1
+    position = 0
+    while position < len(text):
+        match = _TOKEN.match(text, position)
+        if not match:
+            problems.append("line %d: unclosed quote" % line)
+            break
+        token = match.group(0)
+        position = match.end()
+
+        if token == '{':
+            depth.append(line)
+            pending = None
+        elif token == '}':
+            if pending is not None:
+                problems.append("line %d: missing ; after directive" % pending)
+                pending = None
+            if not depth:
+                problems.append("line %d: } without a matching {" % line)
+            else:
+                depth.pop()
+        elif token == ';':
+            pending = None
+        elif not token.isspace() and not token.startswith('#') and pending is None:
+            pending = line
+        line += token.count('\n')
+
+    if pending is not None:
+        problems.append("line %d: missing ; after directive" % pending)
+    for opened in depth:
+        problems.append("line %d: { is never closed" % opened)
+    for number, text_line in enumerate(text.splitlines()):
+        for placeholder in _PLACEHOLDER.findall(text_line):
+            problems.append("line %d: %s was not rendered" % (number + 1, placeholder))
+    return problems
+
+
+def snapshot_steps(batch):
+    """
+    Adds a step that copies the current config aside, to be put back if the new one does not validate
+    """
+    batch.sudo('rm -rf %s && cp -a %s %s' % (SNAPSHOT_DIR, NGINX_DIR, SNAPSHOT_DIR), label="Snapshotting nginx config")
+
+
+def apply_steps(batch, pid_file='/var/run/nginx.pid'):
+    """
+    Adds the steps that validate the installed config with nginx -t and either reload nginx gracefully, or
+    start it when it is not running, or restore the snapshot and fail
+    """
+    batch.sudo('if nginx -t; then rm -rf %(snapshot)s; else '
+               'rm -rf %(nginx)s && mv %(snapshot)s %(nginx)s && '
+               'echo "nginx -t failed, the previous config was restored" && exit 1; fi'
+               % {'snapshot': SNAPSHOT_DIR, 'nginx': NGINX_DIR}, label="Validating nginx config")
+    batch.sudo('if test -f %(pid)s && kill -0 $(cat %(pid)s) 2>/dev/null; then nginx -s reload; '
+               'else service nginx start; fi' % {'pid': pid_file}, label="Reloading nginx")
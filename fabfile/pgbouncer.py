@@ -0,0 +1,69 @@
+"""
+--------------------------------------------------------------------------------------
+pgbouncer.py
+--------------------------------------------------------------------------------------
+Puts PgBouncer between gunicorn and Postgres on each server, so the database sees a
+small pool of connections per server however many workers and threads there are.
+
+PgBouncer runs in transaction pooling mode: a server connection is only held for the
+length of a transaction. The pool is sized from the gunicorn workers and threads, which
+is the most transactions a server can have open at once, capped by a per server budget
+of database connections. The Postgres databases in the DATABASES setting are pointed
+at PgBouncer on 127.0.0.1, with server side cursors turned off as transaction pooling
+needs, and PgBouncer gets their real hosts and credentials.
+"""
+
+POSTGRES_ENGINES = ('postgresql', 'postgis')
+
+
+def pool_sizes(workers, threads, max_db_connections=None):
+    """
+    Returns the pool size per database and user, the reserve pool and the most client connections for a server
+    running workers gunicorn workers with threads threads each. The pool and the reserve together use at most
+    max_db_connections
+    """
+    concurrency = int(workers) * int(threads)
+    pool = min(concurrency, int(max_db_connections)) if max_db_connections else concurrency
+    reserve = max(1, pool // 5)
+    if max_db_connections:
+        pool = min(pool, int(max_db_connections) - reserve)
+    return {
+        'PGBOUNCER_POOL_SIZE': max(1, pool),
+        'PGBOUNCER_RESERVE_POOL_SIZE': reserve,
+        # Old and new workers are both connected while gunicorn reloads
+        'PGBOUNCER_MAX_CLIENT_CONN': max(100, concurrency * 2),
+    }
+
+
+def pooled_databases(databases, port):
+    """
+    Splits DATABASES into PgBouncer's [databases] lines, the (user, password) pairs for its auth file and a copy
+    of DATABASES with the Postgres databases pointed at PgBouncer on port. Each database is known to PgBouncer by
+    its alias in DATABASES
+    """
+    lines = []
+    users = []
+    pooled = {}
+    for alias in sorted(databases):
+        database = dict(databases[alias])
+        if not any(engine in database.get('ENGINE', '') for engine in POSTGRES_ENGINES):
+            pooled[alias] = database
+            continue
+        lines.append('%s = host=%s port=%s dbname=%s' % (alias, database.get('HOST') or '127.0.0.1',
+                                                         database.get('PORT') or 5432, database['NAME']))
+        if (database.get('USER'), database.get('PASSWORD')) not in users:
+            users.append((database.get('USER'), database.get('PASSWORD')))
+        database.update(NAME=alias, HOST='127.0.0.1', PORT=port, DISABLE_SERVER_SIDE_CURSORS=True)
+        pooled[alias] = database
+    return lines, users, pooled
+
+
+def userlist(users):
+    """
+    Returns PgBouncer's auth file for the (user, password) pairs
+    """
+    return ''.join('"%s" "%s"\n' % (_escape(user), _escape(password or '')) for user, password in users)
+
+
+def _escape(value):
+    return value.replace('"', '""')
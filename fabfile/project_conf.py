@@ -55,5 +55,254 @@ fabconf['BITBUCKET_DEPLOY_KEY_PATH'] = "%s/%s" % (fabconf['SSH_PATH'], fabconf['
 # Creates the ssh location of your bitbucket repo from the above details
 fabconf['BITBUCKET_REPO'] = "ssh://git@bitbucket.org/%s/%s.git" % (fabconf['BITBUCKET_USERNAME'], fabconf['BITBUCKET_REPO_NAME'])
 
-# Virtualenv activate command
-fabconf['ACTIVATE'] = "source /home/%s/.virtualenvs/%s/bin/activate" % (fabconf['SERVER_USERNAME'], fabconf['PROJECT_NAME'])
+# Virtualenv that holds the packages every release needs. Release virtualenvs start as copies of it
+fabconf['BASE_VIRTUALENV'] = "%s/%s" % (fabconf['VIRTUALENV_DIR'], fabconf['PROJECT_NAME'])
+
+# Each deploy is built in its own directory under RELEASES_DIR, and PROJECT_PATH is a symlink to the live one.
+# Logs, secrets and the gunicorn files are kept in SHARED_DIR and linked into each release
+fabconf['RELEASES_DIR'] = "%s/releases/%s" % (fabconf['APPS_DIR'], fabconf['PROJECT_NAME'])
+fabconf['SHARED_DIR'] = "%s/shared/%s" % (fabconf['APPS_DIR'], fabconf['PROJECT_NAME'])
+fabconf['REPO_CACHE'] = "%s/repo.git" % fabconf['SHARED_DIR']
+
+# The ssh processes the fabfile starts, eg rsync, share one session per host through sockets in SSH_CONTROL_DIR,
+# which stay open for SSH_CONTROL_PERSIST after the last use so the next task reuses them
+fabconf['SSH_CONTROL_DIR'] = "%s/cm" % fabconf['SSH_PATH']
+fabconf['SSH_CONTROL_PERSIST'] = "10m"
+
+# Ship DEPLOY_PUSH_REF of the local repo to the servers with rsync on deploy, instead of each server fetching it
+# from bitbucket. It is exported into LOCAL_PUSH_DIR and each server keeps its copy in PUSH_DIR, so only the
+# changed files are sent
+fabconf['DEPLOY_PUSH'] = False
+fabconf['DEPLOY_PUSH_REF'] = "master"
+fabconf['LOCAL_REPO_PATH'] = os.path.dirname(os.path.abspath(fabconf['FAB_CONFIG_PATH']))
+fabconf['LOCAL_PUSH_DIR'] = os.path.join(fabconf['FAB_CONFIG_PATH'], 'push')
+fabconf['PUSH_DIR'] = "%s/push" % fabconf['SHARED_DIR']
+
+# Number of releases to keep for rollback
+fabconf['KEEP_RELEASES'] = 5
+
+# Requirements installed into each release's virtualenv, relative to the project
+fabconf['REQUIREMENTS_FILE'] = "requirements/production.txt"
+
+# Wheels for VIRTUALENV_PACKAGES and these requirements files are built once on a server, kept locally in
+# WHEELHOUSE_PATH and pushed to each server's WHEELHOUSE_DIR, so installs skip the package index and compiling.
+# The fabfile folder sits in the root of the Django project, next to its requirements folder
+fabconf['LOCAL_REQUIREMENTS_DIR'] = os.path.join(os.path.dirname(os.path.abspath(fabconf['FAB_CONFIG_PATH'])),
+                                                 'requirements')
+fabconf['WHEEL_REQUIREMENTS'] = ["common.txt", "prod.txt", "production.txt"]
+fabconf['WHEELHOUSE_PATH'] = os.path.join(fabconf['FAB_CONFIG_PATH'], 'wheelhouse')
+fabconf['WHEELHOUSE_DIR'] = "/home/%s/wheelhouse" % fabconf['SERVER_USERNAME']
+
+# Where collectstatic puts the static files and Django keeps uploaded media, outside the releases so they are kept
+# across deploys, and the URLs nginx serves them on. They are added to secrets.json for settings/prod.py
+fabconf['STATIC_URL'] = "/static/"
+fabconf['STATIC_ROOT'] = "%s/static" % fabconf['SHARED_DIR']
+fabconf['MEDIA_URL'] = "/media/"
+fabconf['MEDIA_ROOT'] = "%s/media" % fabconf['SHARED_DIR']
+
+# Seconds browsers and proxies may cache static files and media for. Static files with the hash
+# ManifestStaticFilesStorage puts in their names, eg app.3f2a9c1b4e5d.css, get STATIC_MAX_AGE and are marked
+# immutable, as a new version gets a new name. The rest, which keep their names across versions, get
+# STATIC_UNHASHED_MAX_AGE, whether nginx or S3 serves them
+fabconf['STATIC_MAX_AGE'] = 365 * 24 * 3600
+fabconf['STATIC_UNHASHED_MAX_AGE'] = 300
+fabconf['MEDIA_MAX_AGE'] = 7 * 24 * 3600
+
+# Static files with these extensions are compressed after collectstatic, so nginx serves the .gz copies as they
+# are. With PRECOMPRESS_BROTLI .br copies are written too, which nginx only serves if it has the ngx_brotli module
+fabconf['PRECOMPRESS_EXTENSIONS'] = ["css", "js", "map", "json", "svg", "html", "txt", "xml", "ico", "eot", "ttf",
+                                     "otf"]
+fabconf['PRECOMPRESS_BROTLI'] = False
+
+# Don't edit. The nginx directive for the .br copies
+fabconf['NGINX_BROTLI_STATIC'] = "brotli_static on;" if fabconf['PRECOMPRESS_BROTLI'] else "# brotli_static off;"
+
+# Serve the static files from the S3 bucket S3_STATIC_BUCKET instead of nginx. collectstatic then runs once,
+# locally, and sync_static and deploy upload the new and changed files to the bucket under S3_STATIC_PREFIX from
+# S3_STATIC_WORKERS threads. The servers skip collectstatic and only get the manifest of hashed names
+fabconf['S3_STATIC'] = False
+fabconf['S3_STATIC_BUCKET'] = ""
+fabconf['S3_STATIC_PREFIX'] = "static/"
+fabconf['S3_STATIC_WORKERS'] = 8
+fabconf['S3_STATIC_ACL'] = "public-read"
+
+# Don't edit. The STATIC_URL Django uses with S3_STATIC
+fabconf['S3_STATIC_URL'] = "https://%s.s3.amazonaws.com/%s" % (fabconf['S3_STATIC_BUCKET'], fabconf['S3_STATIC_PREFIX'])
+
+# Files of at least S3_MULTIPART_THRESHOLD bytes are uploaded in parts of S3_MULTIPART_CHUNK bytes, at least 5 MiB
+fabconf['S3_MULTIPART_THRESHOLD'] = 16 * 1024 * 1024
+fabconf['S3_MULTIPART_CHUNK'] = 8 * 1024 * 1024
+
+# How collectstatic runs locally for S3_STATIC: the python with the project's requirements, the settings module
+# and where the files are collected to. manage.py is in the PROJECT_NAME folder of the local repo
+fabconf['LOCAL_PYTHON'] = "python"
+fabconf['LOCAL_MANAGEPY_PATH'] = os.path.join(fabconf['LOCAL_REPO_PATH'], fabconf['PROJECT_NAME'])
+fabconf['LOCAL_SETTINGS_MODULE'] = "%s.settings.prod" % fabconf['PROJECT_NAME']
+fabconf['LOCAL_STATIC_ROOT'] = os.path.join(fabconf['FAB_CONFIG_PATH'], 'static')
+
+# Deploys diff the new commit against the live one and only run collectstatic and syncdb when a changed file
+# matches these regular expressions (grep -E). New requirements or settings can bring new apps, so they count too
+fabconf['STATIC_CHANGES'] = r"(^|/)static/|^requirements/|(^|/)settings/"
+fabconf['SCHEMA_CHANGES'] = r"(^|/)models(\.py$|/)|(^|/)migrations/|^requirements/|(^|/)settings/"
+
+# Virtualenv activate command, for the virtualenv of the live release
+fabconf['ACTIVATE'] = "source %s/venv/bin/activate" % fabconf['PROJECT_PATH']
+
+# Where the templates are rendered locally before they are pushed, see fab render_templates
+fabconf['RENDERED_DIR'] = os.path.join(fabconf['FAB_CONFIG_PATH'], 'rendered')
+
+# Where provisioning records what it has applied, so reruns skip what is already done
+fabconf['STATE_DIR'] = "/home/%s/.provisioned" % fabconf['SERVER_USERNAME']
+
+# Seconds to wait for a new instance to reach the running state, and then for ssh to answer on it
+fabconf['BOOT_TIMEOUT'] = 600
+fabconf['SSH_TIMEOUT'] = 300
+
+# Boot new instances from the newest image made by fab bake_image for the current packages, when there is one
+fabconf['USE_BAKED_IMAGE'] = True
+
+# Generated list of the instances spawned by fab spawn_fleet. Worked on along with fabconf['EC2_INSTANCES']
+fabconf['INVENTORY_PATH'] = os.path.join(fabconf['FAB_CONFIG_PATH'], 'inventory.json')
+
+# Find the servers as the running instances whose Name tag is INSTANCE_NAME_TAG, which every instance launched by
+# the fabfile or the auto scaling group has, instead of EC2_INSTANCES and the inventory. fab scale needs it. Off,
+# as it also picks up any other instance with that tag, eg one launched by hand
+fabconf['HOSTS_FROM_TAGS'] = False
+
+# The Elastic Load Balancer in front of the servers, or None. New servers are registered with it. Deploys take
+# each server out of it, wait ELB_DRAIN_SECONDS for the requests it already sent to finish, and put it back once
+# it passes the health check at HEALTH_CHECK_PATH, waiting up to ELB_REGISTER_TIMEOUT seconds
+fabconf['ELB_NAME'] = None
+fabconf['ELB_DRAIN_SECONDS'] = 30
+fabconf['ELB_REGISTER_TIMEOUT'] = 300
+
+# The auto scaling group fab scale manages, or None, and the fewest and most instances it may have
+fabconf['ASG_NAME'] = None
+fabconf['ASG_MIN_SIZE'] = 1
+fabconf['ASG_MAX_SIZE'] = 10
+
+# The availability zones the load balancer and the auto scaling group span
+fabconf['AVAILABILITY_ZONES'] = ["%sa" % ec2_region]
+
+# Gunicorn writes its pid here so deploys can reload it gracefully with HUP
+fabconf['GUNICORN_PID'] = "/tmp/%s-gunicorn.pid" % fabconf['PROJECT_NAME']
+
+# Gunicorn worker profile: "sync" for CPU bound apps, "gthread" for apps that wait on the database, or "gevent"
+# for apps that mostly wait on other services. Workers, threads and timeouts are worked out from the host's CPUs
+# and memory when gunicorn starts, see fab gunicorn_settings. Settings here override the computed ones, eg
+# {"workers": 4, "max_requests": 500}
+fabconf['GUNICORN_PROFILE'] = "sync"
+fabconf['GUNICORN_SETTINGS'] = {}
+
+# Memory one worker is expected to use, and memory left for everything else on the host, in MiB
+fabconf['GUNICORN_WORKER_MEMORY_MB'] = 150
+fabconf['GUNICORN_RESERVED_MEMORY_MB'] = 512
+
+# Load the app in the master before forking the workers, which saves memory but means deploys restart gunicorn
+# instead of reloading it gracefully
+fabconf['GUNICORN_PRELOAD'] = False
+
+# Unix socket gunicorn listens on and nginx proxies to
+fabconf['GUNICORN_SOCKET'] = "/tmp/%s-gunicorn.sock" % fabconf['PROJECT_NAME']
+
+# Idle connections each nginx worker keeps open to gunicorn, so requests do not pay for a new connection. Only the
+# gthread and gevent profiles keep them open, sync workers close each one. Must be at least 1
+fabconf['UPSTREAM_KEEPALIVE'] = 16
+
+# Buffers nginx reads each gunicorn response into, so a slow client does not hold up a worker
+fabconf['PROXY_BUFFER_SIZE'] = "16k"
+fabconf['PROXY_BUFFERS'] = "16 16k"
+
+# Micro-cache for anonymous GET and HEAD responses, off unless the project opts in. Responses Django marks private
+# or that set cookies are never cached, and requests with these cookies or an Authorization header bypass the cache.
+# Add any other cookie the site logs users in with, and leave it off if pages differ per user without one. Cached
+# responses are served stale for up to PROXY_CACHE_INACTIVE while gunicorn is down or restarting
+fabconf['PROXY_CACHE'] = False
+fabconf['PROXY_CACHE_TTL'] = "1s"
+fabconf['PROXY_CACHE_DIR'] = "/var/cache/nginx/%s" % fabconf['PROJECT_NAME']
+fabconf['PROXY_CACHE_KEYS_SIZE'] = "10m"
+fabconf['PROXY_CACHE_MAX_SIZE'] = "256m"
+fabconf['PROXY_CACHE_INACTIVE'] = "10m"
+fabconf['PROXY_CACHE_BYPASS_COOKIES'] = ["sessionid", "csrftoken", "messages"]
+
+# Don't edit. The cache zone, or off, and the pattern for the cookies that bypass it
+fabconf['NGINX_PROXY_CACHE'] = "app_cache" if fabconf['PROXY_CACHE'] else "off"
+fabconf['NGINX_CACHE_BYPASS_COOKIES'] = "|".join(fabconf['PROXY_CACHE_BYPASS_COOKIES'])
+
+# nginx buffers up to NGINX_LOG_BUFFER of access log lines and writes them at least every NGINX_LOG_FLUSH
+fabconf['NGINX_LOG_BUFFER'] = "32k"
+fabconf['NGINX_LOG_FLUSH'] = "5s"
+
+# The access logs analyze_logs reads on each server, rotated and gzipped ones included, and how many endpoints and
+# slow requests it lists
+fabconf['ACCESS_LOGS'] = ["%s/logs/nginx-access.log*" % fabconf['SHARED_DIR']]
+fabconf['ANALYZE_LOGS_LIMIT'] = 20
+
+# The vCPUs and memory of instance types hardware.py does not know, which the gunicorn, memcached, PgBouncer and
+# system settings are worked out from, eg {'c5.large': (2, 4096)}. Other unknown types are sized as a small instance
+fabconf['INSTANCE_HARDWARE'] = {}
+
+# The kernel, open file and nginx worker settings are worked out for ec2_instancetype by tuning.py, see
+# fab system_settings. Any of them can be set here, eg {'SOMAXCONN': 8192, 'SWAP_MB': 0}
+fabconf['SYSTEM_SETTINGS'] = {}
+
+# Where the swap file goes on instances that get one
+fabconf['SWAP_FILE'] = "/swapfile"
+
+# fleet_stats samples every server each FLEET_STATS_INTERVAL seconds, FLEET_STATS_POOL_SIZE at once, measuring the
+# CPU over FLEET_STATS_CPU_INTERVAL seconds, and stops after FLEET_STATS_COUNT samples, or runs until Ctrl-C with 0
+fabconf['FLEET_STATS_INTERVAL'] = 5
+fabconf['FLEET_STATS_POOL_SIZE'] = 20
+fabconf['FLEET_STATS_CPU_INTERVAL'] = 1
+fabconf['FLEET_STATS_COUNT'] = 0
+
+# memcached on each server gets MEMCACHED_MEMORY_PERCENT of the instance's memory and connections to match, worked
+# out for ec2_instancetype, unless MEMCACHED_MEMORY_MB or MEMCACHED_CONNECTIONS are set. Leave room for it in
+# GUNICORN_RESERVED_MEMORY_MB
+fabconf['MEMCACHED_MEMORY_PERCENT'] = 10
+fabconf['MEMCACHED_MEMORY_MB'] = None
+fabconf['MEMCACHED_CONNECTIONS'] = None
+fabconf['MEMCACHED_LISTEN'] = "127.0.0.1"
+fabconf['MEMCACHED_PORT'] = 11211
+
+# Configuration endpoint of an ElastiCache memcached cluster, eg "name.abc123.cfg.use1.cache.amazonaws.com:11211",
+# for the servers to share instead of each using its own memcached
+fabconf['ELASTICACHE_ENDPOINT'] = ""
+
+# Django's cache key prefix and default timeout in seconds, written to secrets.json with the rest of CACHES
+fabconf['CACHE_KEY_PREFIX'] = fabconf['PROJECT_NAME']
+fabconf['CACHE_TIMEOUT'] = 300
+
+# Run PgBouncer on each server in transaction pooling mode and point the Postgres databases in the DATABASES of
+# the secrets file at it. Its pools are sized from the gunicorn workers, up to PGBOUNCER_MAX_DB_CONNECTIONS
+# connections to each database from each server. Keep that times the number of servers under the database's
+# max_connections
+fabconf['PGBOUNCER'] = False
+fabconf['PGBOUNCER_PORT'] = 6432
+fabconf['PGBOUNCER_MAX_DB_CONNECTIONS'] = 50
+
+# Servers rolling_deploy updates at a time, and the page each must answer 200 on before the next batch starts
+fabconf['ROLLING_BATCH_SIZE'] = 1
+fabconf['HEALTH_CHECK_PATH'] = "/"
+fabconf['HEALTH_CHECK_TIMEOUT'] = 60
+
+# Where a trace of each run of a task is written, as JSON that chrome://tracing opens, and how many of the slowest
+# steps are printed when it finishes
+fabconf['TRACE_DIR'] = os.path.join(fabconf['FAB_CONFIG_PATH'], 'traces')
+fabconf['TRACE_SLOWEST'] = 15
+
+# What fab benchmark requests, how many requests it sends and from how many connections at once, where it keeps
+# the results of each run, and the local port it serves stub_app.py on for fab benchmark:local=yes
+fabconf['BENCHMARK_PATH'] = fabconf['HEALTH_CHECK_PATH']
+fabconf['BENCHMARK_REQUESTS'] = 1000
+fabconf['BENCHMARK_CONCURRENCY'] = 10
+fabconf['BENCHMARK_DIR'] = os.path.join(fabconf['FAB_CONFIG_PATH'], 'benchmarks')
+fabconf['BENCHMARK_PORT'] = 8765
+
+# Number of hosts deploy, update_packages, reload_* and manage work on at once. 1 does them one after another.
+# Can be overridden per run, eg fab deploy:pool_size=10
+fabconf['POOL_SIZE'] = 1
+
+# Stop starting new hosts after the first failure, or carry on and report all failures at the end.
+# Can be overridden per run, eg fab deploy:fail_fast=no
+fabconf['FAIL_FAST'] = True
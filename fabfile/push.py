@@ -0,0 +1,57 @@
+"""
+--------------------------------------------------------------------------------------
+push.py
+--------------------------------------------------------------------------------------
+Ships the code from this computer instead of every server fetching it from the git
+remote.
+
+The commit to deploy is exported once, locally, with git archive, and rsynced to a
+push directory on each server. rsync compares files by checksum and sends only the
+changed parts of changed files, so a deploy sends little more than the diff. Each
+release is copied from the push directory and has a REVISION file with its commit, which
+the next deploy diffs against locally to decide whether collectstatic and syncdb run.
+"""
+from batch import quote
+
+REVISION = 'REVISION'
+
+
+def export_command(repo, commit, directory):
+    """
+    Returns a shell command that replaces directory with the files of commit in the git repo at repo, plus a
+    REVISION file holding commit
+    """
+    return ('cd %(repo)s && rm -rf %(tmp)s && mkdir -p %(tmp)s && git archive %(commit)s | tar -x -C %(tmp)s && '
+            'echo %(commit)s > %(tmp)s/%(revision)s && rm -rf %(directory)s && mv %(tmp)s %(directory)s' % {
+                'repo': quote(repo), 'commit': quote(commit), 'directory': quote(directory),
+                'tmp': quote(directory + '.tmp'), 'revision': REVISION})
+
+
+def rsync_command(source, destination, ssh):
+    """
+    Returns a shell command that makes destination, eg host:/path, a copy of the directory source over the ssh
+    command ssh. Files are compared by checksum, as every export gets new modification times
+    """
+    return 'rsync -rlpcz --delete --stats -e %s %s/ %s/' % (quote(ssh), quote(source), quote(destination))
+
+
+def rsync_stats(output):
+    """
+    Returns the number of files rsync sent and the bytes it sent, from its --stats output
+    """
+    stats = {}
+    for line in output.splitlines():
+        if ':' in line:
+            name, value = line.split(':', 1)
+            words = value.split()
+            if words:
+                stats[name.strip()] = words[0].replace(',', '')
+    files = stats.get('Number of regular files transferred', stats.get('Number of files transferred', '0'))
+    return int(files), int(stats.get('Total bytes sent', '0'))
+
+
+def changed_command(repo, old_commit, new_commit):
+    """
+    Returns a shell command that lists the files that differ between two commits of the git repo at repo
+    """
+    return 'cd %s && git diff --name-only %s %s' % (quote(repo), quote(old_commit), quote(new_commit))
@@ -0,0 +1,113 @@
+"""
+--------------------------------------------------------------------------------------
+readiness.py
+--------------------------------------------------------------------------------------
+Waits for new instances to become usable by polling instead of sleeping for a fixed
+time. Polls back off exponentially and give up at an overall deadline.
+
+The clock, sleep, EC2 connection and socket connector are all passed in, so the
+waits can be driven by fakes without touching AWS or the network.
+"""
+import time
+import socket
+from contextlib import contextmanager
+
+from boto.exception import EC2ResponseError
+from fabric.colors import green as _green, yellow as _yellow
+
+
+def poll(check, timeout, what, initial=1.0, factor=2.0, maximum=15.0, retry_on=(), clock=time.time,
+         sleep=time.sleep):
+    """
+    Calls check() until it returns something truthy and returns that. Waits initial seconds after the
+    first miss, multiplying by factor after each further miss up to maximum. Exceptions of the retry_on
+    types count as misses. Raises once timeout seconds have passed, with the last of those exceptions
+    """
+    deadline = clock() + timeout
+    delay = initial
+    last_error = None
+    while True:
+        try:
+            result = check()
+        except retry_on as e:
+            result, last_error = None, e
+        if result:
+            return result
+        remaining = deadline - clock()
+        if remaining <= 0:
+            message = "Timed out after %ds waiting for %s" % (timeout, what)
+            if last_error is not None:
+                message += ", last error: %s" % last_error
+            raise Exception(message)
+        sleep(min(delay, remaining))
+        delay = min(delay * factor, maximum)
+
+
+def wait_for_running(conn, instance_ids, timeout, clock=time.time, sleep=time.sleep):
+    """
+    Polls EC2 until every instance in instance_ids is running and returns the instances, in the same order.
+    Raises if any of them ends up in another state than pending or running
+    """
+    def check():
+        reservations = conn.get_all_instances(instance_ids)
+        instances = dict((i.id, i) for r in reservations for i in r.instances)
+        if len(instances) < len(instance_ids):
+            return None
+
+        states = [instances[i].state for i in instance_ids]
+        for instance_id, state in zip(instance_ids, states):
+            if state not in (u'pending', u'running'):
+                raise Exception("Instance %s is %s" % (instance_id, state))
+        print(_yellow("Instance state: %s" % ", ".join(states)))
+        if all(state == u'running' for state in states):
+            return [instances[i] for i in instance_ids]
+        return None
+
+    # New instances can take a moment to show up in the API
+    return poll(check, timeout, "%s to run" % ", ".join(instance_ids), retry_on=(EC2ResponseError,),
+                clock=clock, sleep=sleep)
+
+
+def check_ssh(host, port=22, connect=socket.create_connection, timeout=5):
+    """
+    Returns True when sshd on host answers with its banner, which it does not do until it is ready for
+    logins. Raises socket.error otherwise
+    """
+    sock = connect((host, port), timeout)
+    try:
+        banner = sock.recv(4)
+    finally:
+        sock.close()
+    if not banner.startswith('SSH-'):
+        raise socket.error("%s:%d answered %r instead of an ssh banner" % (host, port, banner))
+    return True
+
+
+def wait_for_ssh(host, timeout, port=22, connect=socket.create_connection, clock=time.time, sleep=time.sleep):
+    """
+    Polls host until sshd answers
+    """
+    poll(lambda: check_ssh(host, port, connect), timeout, "ssh on %s" % host,
+         retry_on=(socket.error, socket.timeout), clock=clock, sleep=sleep)
+    print(_green("SSH is up on %s" % host))
+
+
+class Phases(object):
+    """
+    Records how long each named phase of a task took
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self.timings = []
+
+    @contextmanager
+    def phase(self, name):
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.timings.append((name, self.clock() - start))
+
+    def print_summary(self):
+        for name, seconds in self.timings:
+            print(_yellow("  %8.2fs  %s" % (seconds, name)))
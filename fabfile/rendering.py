@@ -0,0 +1,143 @@
+"""
+--------------------------------------------------------------------------------------
+rendering.py
+--------------------------------------------------------------------------------------
+Renders the templates in fabfile/templates locally and installs them on the servers.
+
+Each template is rendered with % against a context, normally fabconf, into a local
+output directory, so the exact files a server gets can be inspected without one.
+Installing compares the sha1 of each rendered file with the installed copy in one
+round trip, uploads only those that differ as a single tarball and installs them
+with a rename, so a file on the server is never half written. Nothing changed means
+nothing is uploaded, and callers can skip their reloads.
+"""
+import os
+import binascii
+import hashlib
+import tarfile
+
+from tracing import put
+
+from batch import fabric_executor, quote
+
+
+class Template(object):
+    """
+    A template under the templates directory, the group of templates it is reloaded with and where it is
+    installed. owner is user:group and mode is an octal string for install
+    """
+    def __init__(self, group, name, destination, owner='root:root', mode='644'):
+        self.group = group
+        self.name = name
+        self.destination = destination
+        self.owner = owner
+        self.mode = mode
+
+    def __repr__(self):
+        return '<Template %s -> %s>' % (self.name, self.destination)
+
+
+class Rendered(object):
+    """
+    A template rendered to a local file, with the sha1 of its contents
+    """
+    def __init__(self, template, path, sha1):
+        self.template = template
+        self.path = path
+        self.sha1 = sha1
+
+
+def render_templates(templates, templates_dir, output_dir, context):
+    """
+    Renders templates into output_dir/<group>/<name> and returns them as Rendered
+    """
+    rendered = []
+    for template in templates:
+        f = open(os.path.join(templates_dir, template.name), 'rb')
+        try:
+            contents = f.read() % context
+        finally:
+            f.close()
+
+        path = os.path.join(output_dir, template.group, template.name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # Several workers may render at once, so each writes its own file and renames it into place
+        temp_path = '%s.%d' % (path, os.getpid())
+        f = open(temp_path, 'wb')
+        try:
+            f.write(contents)
+        finally:
+            f.close()
+        os.rename(temp_path, path)
+        rendered.append(Rendered(template, path, hashlib.sha1(contents).hexdigest()))
+    return rendered
+
+
+def remote_hashes(paths, executor=fabric_executor):
+    """
+    Returns {path: sha1} for those of paths that exist on the server, read in one round trip
+    """
+    output, exit_code = executor('sha1sum %s 2>/dev/null; true' % ' '.join([quote(path) for path in paths]))
+    hashes = {}
+    for line in output.splitlines():
+        words = line.strip().split(None, 1)
+        if len(words) == 2 and len(words[0]) == 40:
+            hashes[words[1]] = words[0]
+    return hashes
+
+
+def changed_templates(rendered, executor=fabric_executor):
+    """
+    Returns those of rendered that differ from the installed copies on the server
+    """
+    if not rendered:
+        return []
+    installed = remote_hashes([r.template.destination for r in rendered], executor)
+    return [r for r in rendered if installed.get(r.template.destination) != r.sha1]
+
+
+def install_steps(batch, changed, uploader=put):
+    """
+    Uploads the changed rendered templates in one tarball and adds the steps that install them to batch
+    """
+    if not changed:
+        return
+    staging = '/tmp/templates-%s' % binascii.hexlify(os.urandom(6))
+    tarball = _pack(changed)
+    try:
+        uploader(tarball, staging + '.tar.gz')
+    finally:
+        os.remove(tarball)
+
+    batch.run('mkdir -m 700 %s && tar xzf %s.tar.gz -C %s && rm %s.tar.gz' % (staging, staging, staging, staging),
+              label="Unpacking templates")
+    for number, r in enumerate(changed):
+        user, group = r.template.owner.split(':')
+        destination = r.template.destination
+        batch.sudo('mkdir -p %s && install -o %s -g %s -m %s %s/%d %s.new && mv -f %s.new %s' % (
+            quote(os.path.dirname(destination)), user, group, r.template.mode, staging, number,
+            quote(destination), quote(destination), quote(destination)), label="Installing %s" % destination)
+    batch.run('rm -rf %s' % staging)
+
+
+def sync_templates(batch, rendered, uploader=put):
+    """
+    Finds the rendered templates that differ from the installed copies, uploads them in one tarball and adds
+    the steps that install them to batch. Returns the templates that changed
+    """
+    changed = changed_templates(rendered, batch.executor)
+    install_steps(batch, changed, uploader)
+    return [r.template for r in changed]
+
+
+def _pack(rendered):
+    # The files go in under their index, the install steps map them to their destinations
+    path = os.path.join(os.path.dirname(rendered[0].path), '.upload-%d.tar.gz' % os.getpid())
+    tar = tarfile.open(path, 'w:gz')
+    try:
+        for number, r in enumerate(rendered):
+            tar.add(r.path, arcname=str(number))
+    finally:
+        tar.close()
+    return path
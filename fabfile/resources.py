@@ -0,0 +1,126 @@
+"""
+--------------------------------------------------------------------------------------
+resources.py
+--------------------------------------------------------------------------------------
+Declarative provisioning. A server is described as an ordered list of Resources, each
+a piece of state such as the apt packages, the virtualenv or the nginx config.
+
+converge() reads every resource's stored fingerprint and check result from the server
+in one round trip, then applies only the resources that are missing or whose
+definition changed, as one batch. After a resource is applied its fingerprint is
+written to fabconf['STATE_DIR'] on the server, so a rerun against a healthy box
+skips everything.
+"""
+import hashlib
+
+from tracing import put
+from fabric.colors import green as _green, yellow as _yellow
+
+from batch import Batch, fabric_executor, script_command, quote
+
+
+class Resource(object):
+    """
+    A piece of server state.
+
+    steps(batch) adds the shell steps that bring the resource about; they should be safe to
+    rerun. uploads are (local, remote) files put on the server before any steps run. check is
+    an optional shell test that must pass for the resource to count as present. action is an
+    optional local callable, run after the steps with whether check passed. inputs are extra
+    local files whose contents count towards the fingerprint.
+    """
+    def __init__(self, name, steps=None, uploads=(), check=None, action=None, inputs=()):
+        self.name = name
+        self.steps = steps
+        self.uploads = list(uploads)
+        self.check = check
+        self.action = action
+        self.inputs = list(inputs)
+
+    def fingerprint(self):
+        """
+        Hashes everything that defines the resource: its rendered steps, check and local files
+        """
+        recorder = Batch(executor=None)
+        if self.steps:
+            self.steps(recorder)
+
+        digest = hashlib.sha1(self.name)
+        for label, command in recorder.steps:
+            digest.update(command)
+        digest.update(self.check or '')
+        for local, remote in self.uploads:
+            digest.update(remote)
+            digest.update(_read(local))
+        for local in self.inputs:
+            digest.update(_read(local))
+        return digest.hexdigest()
+
+    def __repr__(self):
+        return '<Resource %s>' % self.name
+
+
+def remote_states(resources, state_dir, executor=fabric_executor):
+    """
+    Returns {name: (stored fingerprint, check passed)} for resources, read in one round trip
+    """
+    lines = ['rm -f "$0"']
+    for resource in resources:
+        lines.append('stored=$(cat %s 2>/dev/null || true)' % quote('%s/%s' % (state_dir, resource.name)))
+        lines.append('( %s ) >/dev/null 2>&1 && present=1 || present=0' % (resource.check or 'true'))
+        lines.append('echo "@@state %s ${stored:--} $present"' % resource.name)
+    output, exit_code = executor(script_command('\n'.join(lines) + '\n'))
+
+    states = {}
+    for line in output.splitlines():
+        words = line.strip().split()
+        if len(words) == 4 and words[0] == '@@state':
+            states[words[1]] = (words[2] if words[2] != '-' else None, words[3] == '1')
+    return states
+
+
+def converge(resources, state_dir, force=(), executor=fabric_executor, uploader=put):
+    """
+    Applies the resources that are missing, failing their check or changed since they were last applied,
+    plus any named in force. Returns the names of the applied resources and the step timings
+    """
+    states = remote_states(resources, state_dir, executor)
+
+    stale = []
+    for resource in resources:
+        fingerprint = resource.fingerprint()
+        stored, present = states.get(resource.name, (None, False))
+        if resource.name in force or stored != fingerprint or not present:
+            stale.append((resource, fingerprint, present))
+
+    skipped = [resource.name for resource in resources if resource.name not in [r.name for r, f, p in stale]]
+    if skipped:
+        print(_green("Up to date: %s" % ", ".join(skipped)))
+    if not stale:
+        return [], []
+    print(_yellow("Applying: %s" % ", ".join([resource.name for resource, f, p in stale])))
+
+    for resource, fingerprint, present in stale:
+        for local, remote in resource.uploads:
+            uploader(local, remote)
+
+    batch = Batch(executor)
+    for resource, fingerprint, present in stale:
+        if resource.steps:
+            resource.steps(batch)
+        if resource.action:
+            batch.flush()
+            resource.action(present)
+        batch.run('mkdir -p %s && echo %s > %s' % (quote(state_dir), fingerprint,
+                                                  quote('%s/%s' % (state_dir, resource.name))),
+                  label="Recording %s" % resource.name)
+    batch.flush()
+    return [resource.name for resource, f, p in stale], batch.timings
+
+
+def _read(path):
+    f = open(path, 'rb')
+    try:
+        return f.read()
+    finally:
+        f.close()
@@ -0,0 +1,220 @@
+"""
+--------------------------------------------------------------------------------------
+scaling.py
+--------------------------------------------------------------------------------------
+Puts the servers behind an Elastic Load Balancer, grows and shrinks them with an auto
+scaling group, and finds them by their Name tag instead of a list kept by hand.
+
+Every instance the fabfile or the group launches is tagged with INSTANCE_NAME_TAG, so
+the running instances with that tag are the servers. They are also tagged
+Provisioned=no until they have been provisioned, so a bare instance, such as one the
+group launches to replace an unhealthy server, is left out until fab scale provisions
+it. Instances without the Provisioned tag predate it and count as provisioned.
+
+A server is taken out of the load balancer before it is worked on and waits there
+while the requests already sent to it finish, then goes back in once it passes the
+load balancer's health check.
+
+The functions take boto EC2, ELB and auto scaling connections, and the clock and sleep
+they wait with, so they can be driven by fake ones.
+"""
+import time
+import hashlib
+from contextlib import contextmanager
+
+from boto.ec2.elb import HealthCheck
+from boto.ec2.autoscale import LaunchConfiguration, AutoScalingGroup
+from boto.ec2.autoscale.tag import Tag
+from fabric.colors import green as _green, yellow as _yellow
+
+from readiness import poll
+
+IN_SERVICE = 'InService'
+
+# The tag that says whether an instance has been provisioned: UNPROVISIONED, or the time it was
+PROVISIONED_TAG = 'Provisioned'
+UNPROVISIONED = 'no'
+
+
+def tagged_instances(ec2, name_tag):
+    """
+    Returns the running instances whose Name tag is name_tag, oldest first
+    """
+    reservations = ec2.get_all_instances(filters={'tag:Name': name_tag, 'instance-state-name': 'running'})
+    instances = [i for r in reservations for i in r.instances if i.public_dns_name]
+    return sorted(instances, key=lambda i: (i.launch_time, i.id))
+
+
+def provisioned(instance):
+    """
+    Whether instance has been provisioned, judging by its PROVISIONED_TAG
+    """
+    return instance.tags.get(PROVISIONED_TAG) != UNPROVISIONED
+
+
+def mark_provisioned(ec2, ids, when):
+    """
+    Tags the instances ids as provisioned at when
+    """
+    if ids:
+        ec2.create_tags(list(ids), {PROVISIONED_TAG: when})
+
+
+def instance_ids(ec2, hosts):
+    """
+    Returns {host: instance id} for the instances whose public DNS names are in hosts
+    """
+    if not hosts:
+        return {}
+    reservations = ec2.get_all_instances(filters={'dns-name': list(hosts)})
+    return dict((i.public_dns_name, i.id) for r in reservations for i in r.instances)
+
+
+def ensure_load_balancer(elb, name, zones, health_check_path, port=80):
+    """
+    Creates the load balancer name in zones, forwarding HTTP to port on the instances, unless it exists, and
+    points its health check at health_check_path. Returns its DNS name
+    """
+    existing = [balancer for balancer in elb.get_all_load_balancers() if balancer.name == name]
+    if existing:
+        balancer = existing[0]
+    else:
+        print(_yellow("Creating load balancer %s in %s" % (name, ", ".join(zones))))
+        balancer = elb.create_load_balancer(name, zones, [(80, port, 'http')])
+    # Two checks in a row decide, so a server goes back into service 20s after it is healthy
+    elb.configure_health_check(name, HealthCheck(interval=10, target='HTTP:%d%s' % (port, health_check_path),
+                                                 healthy_threshold=2, unhealthy_threshold=2, timeout=5))
+    return balancer.dns_name
+
+
+def instance_health(elb, name, ids=None):
+    """
+    Returns {instance id: (state, description)} for the instances registered with the load balancer name, or
+    for ids
+    """
+    return dict((state.instance_id, (state.state, state.description))
+                for state in elb.describe_instance_health(name, ids))
+
+
+def register(elb, name, ids, timeout, clock=time.time, sleep=time.sleep):
+    """
+    Registers ids with the load balancer name and waits for all of them to pass its health check
+    """
+    elb.register_instances(name, list(ids))
+
+    def check():
+        health = instance_health(elb, name, list(ids))
+        waiting = [i for i in ids if health.get(i, (None, None))[0] != IN_SERVICE]
+        if waiting:
+            print(_yellow("Waiting for %s to come into service" % ", ".join(
+                "%s (%s)" % (i, health.get(i, ('unknown', None))[0]) for i in waiting)))
+        return not waiting
+
+    poll(check, timeout, "%s to come into service on %s" % (", ".join(ids), name), clock=clock, sleep=sleep)
+    print(_green("%s in service on %s" % (", ".join(ids), name)))
+
+
+def drain(elb, name, ids, seconds, sleep=time.sleep):
+    """
+    Deregisters those of ids registered with the load balancer name, so it sends them no new requests, and
+    waits seconds for the requests it already sent to finish. Returns the ids that were registered
+    """
+    registered = [i for i in ids if i in instance_health(elb, name)]
+    if registered:
+        print(_yellow("Draining %s from %s for %ds" % (", ".join(registered), name, seconds)))
+        elb.deregister_instances(name, registered)
+        sleep(seconds)
+    return registered
+
+
+@contextmanager
+def out_of_service(elb, name, ids, drain_seconds, timeout, clock=time.time, sleep=time.sleep):
+    """
+    Takes ids out of the load balancer name for the length of the with block and puts them back once they pass
+    its health check. If the block fails they are put back without waiting, and the health check keeps them out
+    until they are healthy again
+    """
+    registered = drain(elb, name, ids, drain_seconds, sleep)
+    try:
+        yield registered
+    except (Exception, SystemExit):
+        if registered:
+            elb.register_instances(name, registered)
+        raise
+    if registered:
+        register(elb, name, registered, timeout, clock, sleep)
+
+
+def launch_configuration_name(prefix, image_id, instance_type, key_name, security_groups):
+    """
+    A launch configuration can not be changed once made, so its name is hashed from what it launches
+    """
+    digest = hashlib.sha1('%s %s %s %s' % (image_id, instance_type, key_name, ','.join(sorted(security_groups))))
+    return '%s-%s' % (prefix, digest.hexdigest()[:12])
+
+
+def ensure_launch_configuration(autoscale, name, image_id, instance_type, key_name, security_groups):
+    """
+    Creates the launch configuration name unless it exists, and returns name
+    """
+    if not autoscale.get_all_launch_configurations(names=[name]):
+        print(_yellow("Creating launch configuration %s for %s on %s" % (name, image_id, instance_type)))
+        autoscale.create_launch_configuration(LaunchConfiguration(
+            name=name, image_id=image_id, key_name=key_name, security_groups=security_groups,
+            instance_type=instance_type))
+    return name
+
+
+def ensure_group(autoscale, name, launch_config, zones, load_balancers, min_size, max_size, name_tag):
+    """
+    Creates the auto scaling group name, or points an existing one at launch_config and min_size and max_size.
+    Its instances are registered with load_balancers, tagged name_tag and marked unprovisioned. Returns the group
+    """
+    groups = autoscale.get_all_groups(names=[name])
+    if not groups:
+        print(_yellow("Creating auto scaling group %s" % name))
+        autoscale.create_auto_scaling_group(AutoScalingGroup(
+            name=name, launch_config=launch_config, availability_zones=zones, load_balancers=load_balancers,
+            min_size=min_size, max_size=max_size))
+    # The group's instances carry the Name tag, so they are found along with the ones launched by hand once they
+    # have been provisioned. Set on existing groups too, in case they were made before the Provisioned tag
+    autoscale.create_or_update_tags([
+        Tag(key='Name', value=name_tag, propagate_at_launch=True, resource_id=name),
+        Tag(key=PROVISIONED_TAG, value=UNPROVISIONED, propagate_at_launch=True, resource_id=name)])
+    if not groups:
+        return autoscale.get_all_groups(names=[name])[0]
+
+    group = groups[0]
+    if (group.launch_config_name, int(group.min_size), int(group.max_size)) != (launch_config, min_size, max_size):
+        print(_yellow("Updating auto scaling group %s to %s, %d to %d instances" % (name, launch_config, min_size,
+                                                                                   max_size)))
+        group.launch_config_name = launch_config
+        group.min_size = min_size
+        group.max_size = max_size
+        group.update()
+    return group
+
+
+def surplus(group, capacity):
+    """
+    The instances to remove to bring group down to capacity, the ones on an old launch configuration first
+    """
+    instances = list(group.instances or [])
+    instances.sort(key=lambda i: i.launch_config_name == group.launch_config_name)
+    return [i.instance_id for i in instances[:max(0, len(instances) - capacity)]]
+
+
+def wait_for_capacity(autoscale, name, capacity, timeout, clock=time.time, sleep=time.sleep):
+    """
+    Polls the group name until it has capacity instances, all in service, and returns their ids
+    """
+    def check():
+        instances = autoscale.get_all_groups(names=[name])[0].instances or []
+        states = [i.lifecycle_state for i in instances]
+        print(_yellow("%s: %d of %d instances, %s" % (name, len(instances), capacity, ", ".join(states) or "none")))
+        if len(instances) == capacity and all(state == IN_SERVICE for state in states):
+            # Wrapped, as an empty group is done too
+            return ([i.instance_id for i in instances],)
+        return None
+
+    return poll(check, timeout, "%s to have %d instances" % (name, capacity), clock=clock, sleep=sleep)[0]
@@ -0,0 +1,215 @@
+"""
+--------------------------------------------------------------------------------------
+static_sync.py
+--------------------------------------------------------------------------------------
+Puts the static files on S3 without running collectstatic on every server.
+
+collectstatic runs once, locally, with ManifestStaticFilesStorage, so every file also
+gets a copy with a hash of its contents in its name and staticfiles.json maps the
+names to the hashed ones. The bucket is listed once and a file is only uploaded when
+no object has its ETag, which S3 sets to the MD5 of the contents, or for multipart
+uploads to the MD5 of the parts' MD5s, so the same ETag can be worked out locally.
+Uploads run on several threads, each with its own connection, and large files go up
+in parts. Hashed files are cached for a long time, the rest only briefly.
+
+The bucket comes from a connect function, so the sync can be run against a fake one.
+"""
+import os
+import json
+import hashlib
+import mimetypes
+import threading
+import Queue
+
+from batch import quote
+from tracing import span
+
+MANIFEST = 'staticfiles.json'
+
+# S3 will not take smaller parts, except the last
+MIN_CHUNK_SIZE = 5 * 1024 * 1024
+
+# Run by python -c from the directory with manage.py. STATIC_ROOT and the storage are set before Django starts,
+# so whatever the settings module says, the files are collected into the given directory with hashed names
+COLLECTSTATIC_SCRIPT = """import sys
+sys.path.insert(0, '.')
+import django
+from django.conf import settings
+settings.STATIC_ROOT = sys.argv[1]
+settings.STATICFILES_STORAGE = 'django.contrib.staticfiles.storage.ManifestStaticFilesStorage'
+django.setup()
+from django.core.management import call_command
+call_command('collectstatic', interactive=False, verbosity=0)
+"""
+
+
+def collectstatic_command(python, managepy_path, settings_module, root):
+    """
+    Returns a shell command that collects the static files of the project in managepy_path into root, with the
+    hashed names and manifest of ManifestStaticFilesStorage
+    """
+    return 'cd %s && DJANGO_SETTINGS_MODULE=%s %s -c %s %s' % (quote(managepy_path), quote(settings_module),
+                                                                python, quote(COLLECTSTATIC_SCRIPT), quote(root))
+
+
+def local_files(root):
+    """
+    Returns {name: path} for the files under root, with names relative to root and separated by /
+    """
+    files = {}
+    for directory, dirs, names in os.walk(root):
+        for name in names:
+            path = os.path.join(directory, name)
+            files[os.path.relpath(path, root).replace(os.sep, '/')] = path
+    return files
+
+
+def hashed_names(root):
+    """
+    The names in root's manifest that have a hash of their contents in them
+    """
+    path = os.path.join(root, MANIFEST)
+    if not os.path.exists(path):
+        raise Exception("%s has no %s, collect the static files with ManifestStaticFilesStorage" % (root, MANIFEST))
+    f = open(path, 'rb')
+    try:
+        return set(json.load(f).get('paths', {}).values())
+    finally:
+        f.close()
+
+
+def etag(path, threshold, chunk_size):
+    """
+    The ETag S3 gives path once uploaded, in parts of chunk_size if it is at least threshold bytes
+    """
+    size = os.path.getsize(path)
+    f = open(path, 'rb')
+    try:
+        if size < threshold:
+            return _md5(f, size).hexdigest()
+        digests = []
+        while f.tell() < size:
+            digests.append(_md5(f, min(chunk_size, size - f.tell())).digest())
+    finally:
+        f.close()
+    return '%s-%d' % (hashlib.md5(''.join(digests)).hexdigest(), len(digests))
+
+
+def remote_etags(bucket, prefix):
+    """
+    Returns {name: ETag} for the objects in bucket under prefix, with the prefix taken off the names
+    """
+    return dict((key.name[len(prefix):], key.etag.strip('"')) for key in bucket.list(prefix))
+
+
+def headers(name, hashed, max_age, unhashed_max_age):
+    """
+    The Content-Type and Cache-Control headers for the static file name. Hashed files never change, so they
+    are cached for max_age, the rest for unhashed_max_age
+    """
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    if content_type.startswith('text/') or content_type in ('application/javascript', 'application/json'):
+        content_type += '; charset=utf-8'
+    if hashed:
+        cache_control = 'public, max-age=%d, immutable' % max_age
+    else:
+        cache_control = 'public, max-age=%d' % unhashed_max_age
+    return {'Content-Type': content_type, 'Cache-Control': cache_control}
+
+
+def upload(bucket, name, path, headers, policy, threshold, chunk_size):
+    """
+    Uploads path to bucket as name, in parts of chunk_size if it is at least threshold bytes. A multipart
+    upload that fails is cancelled, so its parts are not kept and billed
+    """
+    size = os.path.getsize(path)
+    if size < threshold:
+        bucket.new_key(name).set_contents_from_filename(path, headers=headers, policy=policy)
+        return size
+    multipart = bucket.initiate_multipart_upload(name, headers=headers, policy=policy)
+    try:
+        f = open(path, 'rb')
+        try:
+            part = 0
+            while f.tell() < size:
+                part += 1
+                offset = f.tell()
+                multipart.upload_part_from_file(f, part, size=min(chunk_size, size - offset))
+                f.seek(offset + min(chunk_size, size - offset))
+        finally:
+            f.close()
+        multipart.complete_upload()
+    except Exception:
+        multipart.cancel_upload()
+        raise
+    return size
+
+
+def sync(connect, root, prefix, max_age, unhashed_max_age, policy='public-read', workers=8,
+         threshold=16 * 1024 * 1024, chunk_size=8 * 1024 * 1024):
+    """
+    Uploads the files collected in root that are new or changed to the bucket connect() returns, under
+    prefix, from workers threads. The manifest goes last, so it only names files that are already there.
+    Returns the number of files uploaded and skipped and the bytes uploaded, and raises listing the files that
+    failed after trying them all
+    """
+    chunk_size = max(int(chunk_size), MIN_CHUNK_SIZE)
+    files = local_files(root)
+    hashed = hashed_names(root)
+    remote = remote_etags(connect(), prefix)
+    pending = [name for name in sorted(files) if remote.get(name) != etag(files[name], threshold, chunk_size)]
+
+    queue = Queue.Queue()
+    for name in pending:
+        if name != MANIFEST:
+            queue.put(name)
+    uploaded = [0]
+    failures = []
+    lock = threading.Lock()
+
+    def send(bucket, name):
+        try:
+            with span('s3', prefix + name) as fields:
+                fields['bytes'] = upload(bucket, prefix + name, files[name],
+                                         headers(name, name in hashed, max_age, unhashed_max_age), policy,
+                                         threshold, chunk_size)
+            with lock:
+                uploaded[0] += fields['bytes']
+        except Exception as e:
+            with lock:
+                failures.append((name, e))
+
+    def worker():
+        bucket = None
+        while True:
+            try:
+                name = queue.get_nowait()
+            except Queue.Empty:
+                return
+            bucket = bucket or connect()
+            send(bucket, name)
+
+    threads = [threading.Thread(target=worker) for i in range(max(1, min(int(workers), queue.qsize())))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if MANIFEST in pending and not failures:
+        send(connect(), MANIFEST)
+
+    if failures:
+        raise Exception("%d of %d static files did not upload:\n%s" % (
+            len(failures), len(pending), "\n".join("  %s: %s" % (name, e) for name, e in sorted(failures))))
+    return len(pending), len(files) - len(pending), uploaded[0]
+
+
+def _md5(f, size):
+    digest = hashlib.md5()
+    while size > 0:
+        block = f.read(min(size, 1024 * 1024))
+        if not block:
+            break
+        digest.update(block)
+        size -= len(block)
+    return digest
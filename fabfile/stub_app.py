@@ -0,0 +1,21 @@
+"""
+--------------------------------------------------------------------------------------
+stub_app.py
+--------------------------------------------------------------------------------------
+A WSGI app for fab benchmark:local=yes to serve under the rendered gunicorn config,
+so the gunicorn settings can be load tested without Django, a database or a server.
+
+It answers every request with a short page. ?sleep=<seconds> holds the request for that
+long first, to stand in for time spent waiting on the database.
+"""
+import time
+import urlparse
+
+
+def application(environ, start_response):
+    query = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+    if 'sleep' in query:
+        time.sleep(float(query['sleep'][0]))
+    body = 'OK\n'
+    start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+    return [body]
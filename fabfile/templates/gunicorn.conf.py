@@ -1,9 +1,54 @@
 import os
+import ast
+
+# Rendered from fabfile/templates/gunicorn.conf.py. The settings are worked out from the host's CPUs and memory
+# when gunicorn starts. fab gunicorn_settings prints what they come to for an instance type
+PROFILE = "%(GUNICORN_PROFILE)s"
+OVERRIDES = ast.literal_eval("""%(GUNICORN_SETTINGS)r""")
+WORKER_MEMORY_MB = int("%(GUNICORN_WORKER_MEMORY_MB)d")
+RESERVED_MEMORY_MB = int("%(GUNICORN_RESERVED_MEMORY_MB)d")
+PRELOAD = "%(GUNICORN_PRELOAD)s" == "True"
+
 
 def numCPUs():
     if not hasattr(os, "sysconf"):
         raise RuntimeError("No sysconf detected.")
     return os.sysconf("SC_NPROCESSORS_ONLN")
 
-bind = "127.0.0.1:8002"
-workers = numCPUs() * 2 + 1
\ No newline at end of file
+
+def memoryMB():
+    return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") // (1024 * 1024)
+
+
+def tune(profile, cpus, memory_mb, overrides):
+    """
+    Returns the gunicorn settings for profile on a host with cpus and memory_mb, with overrides applied
+    """
+    # Never start more workers than fit in the memory left over by the OS, nginx and memcached
+    fit = max(1, (memory_mb - RESERVED_MEMORY_MB) // WORKER_MEMORY_MB)
+    settings = {
+        "bind": "unix:%(GUNICORN_SOCKET)s",
+        "worker_class": profile,
+        "max_requests": 1000,
+        "graceful_timeout": 30,
+        "preload_app": PRELOAD,
+    }
+    if profile == "sync":
+        # One request per worker at a time, for CPU bound apps
+        settings.update(workers=min(cpus * 2 + 1, fit), threads=1, timeout=30)
+    elif profile == "gthread":
+        # Fewer processes each serving several requests on threads, for apps that wait on the database
+        settings.update(workers=min(cpus + 1, fit), threads=4, timeout=60, keepalive=5)
+    elif profile == "gevent":
+        # Greenlets, for apps that spend most of their time waiting on other services. Needs gevent installed
+        settings.update(workers=min(cpus + 1, fit), worker_connections=1000, timeout=120, keepalive=5)
+    else:
+        raise ValueError("Unknown gunicorn profile " + repr(profile))
+    settings.update(overrides)
+
+    # Spread worker restarts out so they do not all recycle at once
+    settings.setdefault("max_requests_jitter", settings["max_requests"] // 10)
+    return settings
+
+
+globals().update(tune(PROFILE, numCPUs(), memoryMB(), OVERRIDES))
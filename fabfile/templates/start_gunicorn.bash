@@ -6,4 +6,5 @@ set -e
 %(ACTIVATE)s
 
 # Start gunicorn going
-exec gunicorn %(PROJECT_NAME)s.wsgi:application -c %(PROJECT_PATH)s/gunicorn.conf.py 
\ No newline at end of file
+exec gunicorn %(PROJECT_NAME)s.wsgi:application -c %(PROJECT_PATH)s/gunicorn.conf.py --pid %(GUNICORN_PID)s \
+    --chdir %(PROJECT_PATH)s 
\ No newline at end of file
@@ -0,0 +1,234 @@
+"""
+--------------------------------------------------------------------------------------
+tracing.py
+--------------------------------------------------------------------------------------
+Records where a task's time goes: every run, sudo, put and get, every boto call and
+every step of a batch becomes a span with its wall time, host, exit code and the bytes
+it transferred.
+
+trace() wraps a task run and traced_task() decorates a task with it. Spans are appended
+to a file as they finish, so the ones from forked multihost workers are collected too,
+and when the task ends they are written out as one JSON file in the Chrome trace event
+format, which chrome://tracing and https://ui.perfetto.dev open as a timeline with a
+row per host. The slowest spans are printed as a table. Outside trace() nothing is
+recorded.
+"""
+import os
+import json
+import time
+from functools import wraps
+from contextlib import contextmanager
+
+from fabric.api import env, run as _fabric_run, sudo as _fabric_sudo, put as _fabric_put, get as _fabric_get
+from fabric.colors import yellow as _yellow
+
+# The spans file of the task being traced, inherited by forked workers
+_spans_path = None
+
+
+@contextmanager
+def trace(task, trace_dir, slowest=15, clock=time.time):
+    """
+    Records the spans of the with block, then writes them to trace_dir/<time>-<task>.json and prints the
+    slowest. Nested traces are part of the outer one
+    """
+    global _spans_path
+    if _spans_path is not None:
+        yield
+        return
+    if not os.path.isdir(trace_dir):
+        os.makedirs(trace_dir)
+    started = clock()
+    name = '%s-%s' % (time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(started)), task)
+    _spans_path = os.path.join(trace_dir, '.%s.%d.spans' % (name, os.getpid()))
+    try:
+        yield
+    finally:
+        spans_path, _spans_path = _spans_path, None
+        spans = read_spans(spans_path)
+        path = os.path.join(trace_dir, name + '.json')
+        write_chrome_trace(path, task, started, clock() - started, spans)
+        if os.path.exists(spans_path):
+            os.remove(spans_path)
+        print_slowest(spans, slowest)
+        print(_yellow("Trace written to %s" % path))
+
+
+def traced_task(trace_dir, slowest=15):
+    """
+    Decorates a task so that each run of it is traced into trace_dir
+    """
+    def decorate(task):
+        @wraps(task)
+        def traced_run(*args, **kwargs):
+            with trace(task.__name__, trace_dir, slowest):
+                return task(*args, **kwargs)
+        return traced_run
+    return decorate
+
+
+def record(category, name, start, duration, host=None, exit_code=None, transferred=None):
+    """
+    Records a span that has already finished. Does nothing outside trace()
+    """
+    if _spans_path is None:
+        return
+    span = {'category': category, 'name': name, 'start': start, 'duration': duration,
+            'host': host or env.get('host_string') or 'local', 'pid': os.getpid(),
+            'exit_code': exit_code, 'bytes': transferred}
+    # One write per line in append mode, so spans from several workers do not interleave
+    f = open(_spans_path, 'ab')
+    try:
+        f.write(json.dumps(span) + '\n')
+    finally:
+        f.close()
+
+
+@contextmanager
+def span(category, name, host=None, clock=time.time):
+    """
+    Records the with block as a span on host, by default env.host_string. The block can set 'exit_code' and
+    'bytes' on the dict it is given
+    """
+    fields = {'exit_code': None, 'bytes': None}
+    start = clock()
+    try:
+        yield fields
+    except Exception:
+        # An interrupted or exited task is not a failed span
+        if fields['exit_code'] is None:
+            fields['exit_code'] = 1
+        raise
+    finally:
+        record(category, name, start, clock() - start, host, fields['exit_code'], fields['bytes'])
+
+
+def traced(category, describe, measure):
+    """
+    Decorates a function so each call is a span named describe(*args, **kwargs). measure(result, args, kwargs)
+    returns the call's (exit code, bytes)
+    """
+    def decorate(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(category, describe(*args, **kwargs)) as fields:
+                result = func(*args, **kwargs)
+                fields['exit_code'], fields['bytes'] = measure(result, args, kwargs)
+                return result
+        return wrapper
+    return decorate
+
+
+def _command_name(command, *args, **kwargs):
+    return command
+
+
+def _transfer_name(*args, **kwargs):
+    paths = list(args[:2]) + [kwargs.get(key) for key in ('local_path', 'remote_path') if key in kwargs]
+    return ' -> '.join(path if isinstance(path, basestring) else '<file>' for path in paths)
+
+
+def _measure_command(result, args, kwargs):
+    return getattr(result, 'return_code', None), len(result or '')
+
+
+def _measure_put(result, args, kwargs):
+    local = args[0] if args else kwargs.get('local_path')
+    return (1 if getattr(result, 'failed', None) else 0), _size(local)
+
+
+def _measure_get(result, args, kwargs):
+    return (1 if getattr(result, 'failed', None) else 0), sum(_size(path) or 0 for path in result or [])
+
+
+def _size(local):
+    if isinstance(local, basestring):
+        return os.path.getsize(local) if os.path.isfile(local) else None
+    if hasattr(local, 'getvalue'):
+        return len(local.getvalue())
+    return None
+
+
+# Fabric's operations, traced. Use these in place of the ones from fabric.api
+run = traced('run', _command_name, _measure_command)(_fabric_run)
+sudo = traced('sudo', _command_name, _measure_command)(_fabric_sudo)
+put = traced('put', _transfer_name, _measure_put)(_fabric_put)
+get = traced('get', _transfer_name, _measure_get)(_fabric_get)
+
+
+class TracedConnection(object):
+    """
+    Wraps a boto connection so that each of its method calls is a span
+    """
+    def __init__(self, conn, region=None):
+        self._conn = conn
+        self._region = region
+
+    def __getattr__(self, name):
+        value = getattr(self._conn, name)
+        if not callable(value):
+            return value
+
+        @wraps(value)
+        def call(*args, **kwargs):
+            start = time.time()
+            exit_code = 1
+            try:
+                result = value(*args, **kwargs)
+                exit_code = 0
+                return result
+            finally:
+                record('boto', name, start, time.time() - start, host=self._region, exit_code=exit_code)
+        return call
+
+
+def read_spans(path):
+    """
+    Returns the spans recorded in path, oldest first
+    """
+    if not os.path.exists(path):
+        return []
+    f = open(path, 'rb')
+    try:
+        spans = [json.loads(line) for line in f if line.strip()]
+    finally:
+        f.close()
+    return sorted(spans, key=lambda s: s['start'])
+
+
+def write_chrome_trace(path, task, started, elapsed, spans):
+    """
+    Writes spans as complete events in the Chrome trace event format, with a process per host and a thread
+    per local worker, and the task, its start and its length under otherData
+    """
+    hosts = []
+    events = []
+    for s in spans:
+        if s['host'] not in hosts:
+            hosts.append(s['host'])
+            events.append({'name': 'process_name', 'ph': 'M', 'pid': len(hosts), 'args': {'name': s['host']}})
+        events.append({'name': s['name'], 'cat': s['category'], 'ph': 'X', 'pid': hosts.index(s['host']) + 1,
+                       'tid': s['pid'], 'ts': int((s['start'] - started) * 1e6), 'dur': int(s['duration'] * 1e6),
+                       'args': {'host': s['host'], 'exit_code': s['exit_code'], 'bytes': s['bytes']}})
+    f = open(path + '.tmp', 'wb')
+    try:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms',
+                   'otherData': {'task': task, 'started': started, 'elapsed': elapsed}}, f)
+    finally:
+        f.close()
+    os.rename(path + '.tmp', path)
+
+
+def print_slowest(spans, limit=15):
+    """
+    Prints the limit slowest spans with their host, kind, exit code and bytes transferred
+    """
+    if not spans or not limit:
+        return
+    print(_yellow("Slowest steps:"))
+    print(_yellow("  %9s  %-30s  %-8s  %4s  %10s  %s" % ("seconds", "host", "kind", "exit", "bytes", "step")))
+    for s in sorted(spans, key=lambda s: s['duration'], reverse=True)[:int(limit)]:
+        name = ' '.join(s['name'].split())
+        print(_yellow("  %9.2f  %-30s  %-8s  %4s  %10s  %s" % (
+            s['duration'], s['host'][:30], s['category'], '-' if s['exit_code'] is None else s['exit_code'],
+            '-' if s['bytes'] is None else s['bytes'], name[:80] + ('...' if len(name) > 80 else ''))))
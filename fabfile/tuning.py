@@ -0,0 +1,44 @@
+"""
+--------------------------------------------------------------------------------------
+tuning.py
+--------------------------------------------------------------------------------------
+Sizes the kernel's connection queues, the open file limits, swap and nginx's workers
+for an instance, so connections are not queued or refused by the kernel while the CPU
+still has room.
+
+The stock kernel accepts 128 pending connections per listening socket, however many
+CPUs there are, and gives each process 1024 open files. The settings here grow with
+the vCPUs and memory from hardware.py, and are rendered into templates/sysctl.conf,
+templates/limits.conf and templates/nginx.conf like every other template.
+"""
+
+
+def system_settings(cpus, memory_mb, overrides=None):
+    """
+    Returns the kernel, limits and nginx settings for a host with cpus and memory_mb, with overrides applied
+    """
+    # nginx runs a worker per CPU. Each proxied request holds a client and an upstream connection
+    worker_connections = _clamp(memory_mb * 4, 1024, 16384)
+    rlimit_nofile = worker_connections * 2 + 1024
+    somaxconn = _clamp(cpus * 1024, 4096, 65535)
+    settings = {
+        'NGINX_WORKER_CONNECTIONS': worker_connections,
+        'NGINX_WORKER_RLIMIT_NOFILE': rlimit_nofile,
+        # Open files for every other process, gunicorn through supervisord's minfds
+        'NOFILE_LIMIT': max(65536, rlimit_nofile),
+        'SOMAXCONN': somaxconn,
+        'TCP_MAX_SYN_BACKLOG': _clamp(somaxconn * 2, 8192, 65535),
+        'NETDEV_MAX_BACKLOG': _clamp(cpus * 2500, 5000, 65535),
+        'IP_LOCAL_PORT_RANGE': '10240 65535',
+        # A quarter of the memory in KiB, over twice the kernel's own default, and room for every process's limit
+        'FILE_MAX': max(memory_mb * 256, max(65536, rlimit_nofile) * 4),
+        # Small instances get as much swap as memory, so a burst of workers is slow rather than OOM killed
+        'SWAP_MB': memory_mb if memory_mb < 2048 else 0,
+        'SWAPPINESS': 10,
+    }
+    settings.update(overrides or {})
+    return settings
+
+
+def _clamp(value, low, high):
+    return int(max(low, min(high, value)))
@@ -0,0 +1,142 @@
+"""
+--------------------------------------------------------------------------------------
+wheelhouse.py
+--------------------------------------------------------------------------------------
+A cache of built wheels for the project's requirements, so packages like psycopg2 and
+pylibmc are compiled once instead of on every host.
+
+The wheelhouse is keyed by a hash of the package list and the local requirements
+files it is built from. It is built on the first server that needs it, since the wheels have to match
+the servers' platform, and copied back as a tarball to fabconf['WHEELHOUSE_PATH'].
+Every other server gets the tarball pushed in one upload and installs from it with
+pip --no-index --find-links, without going to the package index.
+
+The shell helpers compute the same key on the server from a checkout's requirements,
+so a release whose requirements match a pushed wheelhouse installs from it and any
+other release falls back to the index.
+"""
+import os
+import fcntl
+import hashlib
+
+from tracing import put, get
+from fabric.colors import green as _green, yellow as _yellow
+
+from batch import Batch, fabric_executor, quote
+
+
+def requirement_files(requirements_dir, names):
+    """
+    The files named in names that exist in requirements_dir, in the order the key hashes them
+    """
+    paths = [os.path.join(requirements_dir, name) for name in names]
+    return [path for path in paths if os.path.exists(path)]
+
+
+def wheelhouse_key(packages, files):
+    """
+    Hashes the package list and the contents of the requirements files
+    """
+    digest = hashlib.sha1(' '.join(packages) + '\n')
+    for path in files:
+        f = open(path, 'rb')
+        try:
+            digest.update(f.read())
+        finally:
+            f.close()
+    return digest.hexdigest()[:12]
+
+
+def key_command(packages, requirements_dir, names):
+    """
+    Returns a shell command substitution giving the wheelhouse key for the files named in names in
+    requirements_dir on the server. It hashes the same bytes as wheelhouse_key
+    """
+    paths = ' '.join(['%s/%s' % (requirements_dir, name) for name in names])
+    return '$({ echo %s; cat %s 2>/dev/null; } | sha1sum | cut -c1-12)' % (quote(' '.join(packages)), paths)
+
+
+def pip_install(pip, args, wheels):
+    """
+    Returns a shell command that installs args with pip from the wheelhouse directory wheels when it is
+    complete, and from the package index otherwise
+    """
+    return 'if test -f %s/.complete; then %s install --no-index --find-links=%s %s; else %s install %s; fi' % (
+        wheels, pip, wheels, args, pip, args)
+
+
+def sync_wheelhouse(key, packages, files, local_dir, remote_dir, executor=fabric_executor,
+                    uploader=put, downloader=get):
+    """
+    Makes sure the server has the wheelhouse for key under remote_dir and points remote_dir/current at it.
+    Pushes the local copy when there is one, otherwise builds it on the server and fetches the tarball into
+    local_dir. Concurrent callers on this machine wait for each other, so only one of them builds
+    """
+    target = '%s/%s' % (remote_dir, key)
+    with Batch(executor) as batch:
+        _finish_steps(batch, key, remote_dir, when='test -f %s/.complete' % target)
+    if not batch.skipped:
+        return False
+
+    if not os.path.isdir(local_dir):
+        os.makedirs(local_dir)
+    tarball = os.path.join(local_dir, '%s.tar.gz' % key)
+    lock = open(tarball + '.lock', 'wb')
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(tarball):
+            _build(key, packages, files, tarball, remote_dir, executor, uploader, downloader)
+        else:
+            print(_yellow("Pushing wheelhouse %s" % key))
+            with Batch(executor) as batch:
+                batch.run('mkdir -p %s' % remote_dir)
+            uploader(tarball, '%s.tar.gz' % target)
+            with Batch(executor) as batch:
+                batch.run('rm -rf %s.tmp && mkdir %s.tmp && tar xzf %s.tar.gz -C %s.tmp && rm -rf %s && '
+                          'mv %s.tmp/%s %s && rmdir %s.tmp' % (target, target, target, target, target,
+                                                               target, key, target, target),
+                          label="Unpacking wheelhouse")
+                _finish_steps(batch, key, remote_dir)
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
+    return True
+
+
+def _build(key, packages, files, tarball, remote_dir, executor, uploader, downloader):
+    """
+    Builds the wheelhouse on the server, in a build virtualenv with an up to date pip and wheel, and fetches
+    it as a tarball
+    """
+    print(_yellow("Building wheelhouse %s" % key))
+    target = '%s/%s' % (remote_dir, key)
+    sources = '%s.src' % target
+
+    with Batch(executor) as batch:
+        batch.run('mkdir -p %s' % sources)
+    for path in files:
+        uploader(path, '%s/%s' % (sources, os.path.basename(path)))
+
+    requirements = ' '.join(['-r %s/%s' % (sources, os.path.basename(path)) for path in files])
+    with Batch(executor) as batch:
+        batch.run('test -x %s/.build/bin/pip || virtualenv -q %s/.build' % (remote_dir, remote_dir),
+                  label="Creating wheel build virtualenv")
+        batch.run('%s/.build/bin/pip install -q --upgrade pip wheel' % remote_dir)
+        batch.run('rm -rf %s.tmp && %s/.build/bin/pip wheel -q --wheel-dir=%s.tmp %s %s' % (
+            target, remote_dir, target, ' '.join(packages), requirements), label="Building wheels")
+        batch.run('touch %s.tmp/.complete && rm -rf %s %s && mv %s.tmp %s' % (target, target, sources, target, target))
+        batch.run('tar czf %s.tar.gz -C %s %s' % (target, remote_dir, key), label="Packing wheelhouse")
+
+    downloader('%s.tar.gz' % target, tarball + '.tmp')
+    os.rename(tarball + '.tmp', tarball)
+    print(_green("Wheelhouse %s saved to %s" % (key, tarball)))
+
+    with Batch(executor) as batch:
+        batch.run('rm -f %s.tar.gz' % target)
+        _finish_steps(batch, key, remote_dir)
+
+
+def _finish_steps(batch, key, remote_dir, when=None):
+    # Point current at the wheelhouse and drop the ones for old requirements
+    batch.run('ln -sfn %s %s/current && cd %s && for old in *; do test "$old" = %s || test "$old" = current || '
+              'rm -rf "$old"; done' % (key, remote_dir, remote_dir, key), label="Pruning old wheelhouses", when=when)
@@ -0,0 +1,11 @@
+"""
+Tests for the fabfile's modules. They run locally against fake executors and boto connections, so they need
+Fabric and boto (pip install -r fabfile/requirements.txt) but no AWS account or servers. From the repo root:
+
+    python -m unittest discover
+"""
+import os
+import sys
+
+# The fabfile's modules import each other by bare name, as Fabric puts the fabfile folder on the path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fabfile'))
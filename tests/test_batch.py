@@ -0,0 +1,144 @@
+import os
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+from fabric.api import settings
+
+from batch import Batch, quote, INLINE_LIMIT
+
+
+def local_executor(command):
+    """
+    Runs the batch command in a local bash, as the server's login shell would
+    """
+    proc = subprocess.Popen(['bash', '-c', command], stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+    return output, proc.returncode
+
+
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.calls = []
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def executor(self, command):
+        self.calls.append(command)
+        return local_executor(command)
+
+    def path(self, name):
+        return os.path.join(self.dir, name)
+
+    def test_runs_the_steps_in_one_round_trip(self):
+        batch = Batch(self.executor)
+        batch.run('echo one > %s' % self.path('one'), label='one')
+        batch.run('echo two > %s' % self.path('two'), label='two')
+        batch.flush()
+        self.assertEqual(len(self.calls), 1)
+        self.assertTrue(os.path.exists(self.path('one')) and os.path.exists(self.path('two')))
+        self.assertEqual([label for label, seconds in batch.timings], ['one', 'two'])
+
+    def test_steps_share_a_shell(self):
+        batch = Batch(self.executor)
+        batch.run('name=carried')
+        batch.run('echo $name > %s' % self.path('out'))
+        batch.flush()
+        self.assertEqual(open(self.path('out')).read(), 'carried\n')
+
+    def test_names_the_failed_step_and_stops(self):
+        batch = Batch(self.executor)
+        batch.run('true', label='fine')
+        batch.run('exit 3', label='broken')
+        batch.run('touch %s' % self.path('after'), label='after')
+        try:
+            batch.flush()
+            self.fail("flush should have raised")
+        except Exception as e:
+            self.assertIn("step 2 of 3 failed (exit code 3): broken", str(e))
+        self.assertFalse(os.path.exists(self.path('after')))
+
+    def test_a_step_stops_at_its_first_failing_command(self):
+        batch = Batch(self.executor)
+        batch.run('false; touch %s; true' % self.path('after'), label='first fails')
+        try:
+            batch.flush()
+            self.fail("flush should have raised")
+        except Exception as e:
+            self.assertIn("step 1 of 1 failed (exit code 1): first fails", str(e))
+        self.assertFalse(os.path.exists(self.path('after')))
+
+    def test_failures_inside_conditions_are_not_step_failures(self):
+        batch = Batch(self.executor)
+        batch.run('if false; then exit 1; fi; test -f /nonexistent || touch %s' % self.path('ran'))
+        batch.flush()
+        self.assertTrue(os.path.exists(self.path('ran')))
+
+    def test_skips_steps_whose_condition_fails(self):
+        batch = Batch(self.executor)
+        batch.run('touch %s' % self.path('skipped'), label='skipped', when='false')
+        batch.run('touch %s' % self.path('ran'), label='ran', when='true')
+        batch.flush()
+        self.assertEqual(batch.skipped, ['skipped'])
+        self.assertFalse(os.path.exists(self.path('skipped')))
+        self.assertTrue(os.path.exists(self.path('ran')))
+
+    def test_runs_steps_in_fabrics_cwd(self):
+        batch = Batch(self.executor)
+        with settings(cwd=self.dir):
+            batch.run('pwd > out')
+        batch.flush()
+        self.assertEqual(open(self.path('out')).read().strip(), os.path.realpath(self.dir))
+
+    def test_sudo_steps_never_prompt(self):
+        batch = Batch(None)
+        batch.sudo('whoami', user='www')
+        self.assertEqual(batch.steps[0][1], "sudo -n -H -u www bash -l -c 'whoami'")
+
+    def test_does_not_flush_when_the_block_raises(self):
+        try:
+            with Batch(self.executor) as batch:
+                batch.run('true')
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(self.calls, [])
+
+    def test_sends_small_scripts_inline(self):
+        uploads = []
+        batch = Batch(self.executor, lambda *args, **kwargs: uploads.append(args))
+        batch.run('true')
+        batch.flush()
+        self.assertEqual(uploads, [])
+
+    def test_uploads_scripts_too_big_for_a_command_line(self):
+        uploads = []
+
+        def uploader(script, path, mode=None):
+            uploads.append((path, mode))
+            f = open(path, 'wb')
+            f.write(script.getvalue())
+            f.close()
+
+        batch = Batch(self.executor, uploader)
+        batch.run('printf %%s %s > %s' % (quote('x' * INLINE_LIMIT * 3), self.path('big')))
+        batch.flush()
+        self.assertLess(len(self.calls[0]), 1024)
+        self.assertEqual(os.path.getsize(self.path('big')), INLINE_LIMIT * 3)
+        path, mode = uploads[0]
+        self.assertEqual(mode, 0600)
+        # The script removes itself
+        self.assertFalse(os.path.exists(path))
+
+
+class QuoteTest(unittest.TestCase):
+    def test_quotes_single_quotes(self):
+        output = subprocess.check_output(['bash', '-c', 'printf %s ' + quote("it's $HOME")])
+        self.assertEqual(output, "it's $HOME")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+import errno
+import shutil
+import socket
+import httplib
+import tempfile
+import threading
+import unittest
+
+from benchmark import run_load, percentile, summarize, save_run, previous_run
+
+
+class Clock(object):
+    """
+    A clock that moves on by step every time it is read
+    """
+    def __init__(self, step=0.01):
+        self.now = 0.0
+        self.step = step
+        self.lock = threading.Lock()
+
+    def __call__(self):
+        with self.lock:
+            self.now += self.step
+            return self.now
+
+
+class FakeResponse(object):
+    def __init__(self, status, headers):
+        self.status = status
+        self.headers = headers
+
+    def read(self):
+        return 'ok'
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+
+class Server(object):
+    """
+    Hands out connections that answer with the statuses in turn, or raise them when they are exceptions
+    """
+    def __init__(self, statuses=(200,), headers=None):
+        self.statuses = list(statuses)
+        self.headers = headers or {}
+        self.lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+        self.closed = 0
+
+    def __call__(self, host, port, timeout=None):
+        with self.lock:
+            self.connections += 1
+        return FakeConnection(self)
+
+    def answer(self, path):
+        with self.lock:
+            status = self.statuses[len(self.requests) % len(self.statuses)]
+            self.requests.append(path)
+        if isinstance(status, Exception):
+            raise status
+        return FakeResponse(status, self.headers)
+
+
+class FakeConnection(object):
+    def __init__(self, server):
+        self.server = server
+        self.path = None
+
+    def request(self, method, path):
+        self.path = path
+
+    def getresponse(self):
+        return self.server.answer(self.path)
+
+    def close(self):
+        with self.server.lock:
+            self.server.closed += 1
+
+
+class RunLoadTest(unittest.TestCase):
+    def test_sends_the_requests_over_kept_alive_connections(self):
+        server = Server()
+        samples, elapsed = run_load('web', 80, '/a/', requests=40, concurrency=4, connection_factory=server,
+                                    clock=Clock())
+        self.assertEqual(len(samples), 40)
+        self.assertEqual(server.requests, ['/a/'] * 40)
+        self.assertTrue(server.connections <= 4)
+        self.assertEqual(server.closed, server.connections)
+        self.assertTrue(elapsed > 0)
+
+    def test_reconnects_when_the_server_closes(self):
+        server = Server(headers={'connection': 'close'})
+        run_load('web', 80, '/', requests=10, concurrency=1, connection_factory=server, clock=Clock())
+        self.assertEqual(server.connections, 10)
+
+    def test_runs_for_a_duration(self):
+        # Each request reads the clock twice and checks for more once, so 0.3s of 0.01s ticks is 10 requests
+        samples, elapsed = run_load('web', 80, '/', duration=0.3, concurrency=1, connection_factory=Server(),
+                                    clock=Clock())
+        self.assertEqual(len(samples), 10)
+        self.assertEqual([round(latency, 6) for latency, status in samples], [0.01] * 10)
+
+    def test_records_failures_by_errno_or_exception(self):
+        refused = socket.error(errno.ECONNREFUSED, 'Connection refused')
+        server = Server([200, refused, httplib.BadStatusLine(''), 503])
+        samples, elapsed = run_load('web', 80, '/', requests=4, concurrency=1, connection_factory=server,
+                                    clock=Clock())
+        self.assertEqual([status for latency, status in samples], [200, 'ECONNREFUSED', 'BadStatusLine', 503])
+        self.assertEqual(server.connections, 3)
+
+    def test_needs_requests_or_a_duration(self):
+        self.assertRaises(Exception, run_load, 'web', 80, '/', connection_factory=Server())
+
+
+class PercentileTest(unittest.TestCase):
+    def test_nearest_rank(self):
+        ordered = range(1, 101)
+        self.assertEqual([percentile(ordered, p) for p in (0, 50, 95, 99, 100)], [1, 50, 95, 99, 100])
+        self.assertEqual(percentile([7], 99), 7)
+        self.assertEqual(percentile([], 50), None)
+
+
+class SummarizeTest(unittest.TestCase):
+    def test_throughput_errors_and_latencies(self):
+        samples = [(0.010, 200)] * 90 + [(0.100, 200)] * 5 + [(0.500, 502)] * 4 + [(1.0, 'ECONNRESET')]
+        summary = summarize(samples, 2.0)
+        self.assertEqual(summary['requests'], 100)
+        self.assertEqual(summary['throughput'], 50.0)
+        self.assertEqual((summary['errors'], summary['error_rate']), (5, 0.05))
+        self.assertEqual(summary['latency_ms'], {'mean': 44.0, 'p50': 10.0, 'p95': 100.0, 'p99': 500.0,
+                                                 'max': 1000.0})
+        self.assertEqual(summary['statuses'], {'200': 95, '502': 4, 'ECONNRESET': 1})
+
+    def test_no_samples(self):
+        summary = summarize([], 0)
+        self.assertEqual((summary['requests'], summary['error_rate'], summary['throughput']), (0, 0.0, 0.0))
+        self.assertEqual(summary['latency_ms']['p99'], None)
+
+
+class SavedRunsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_previous_run_is_the_latest_against_the_target(self):
+        self.assertEqual(previous_run(self.dir, 'local'), None)
+        for started, target in [('2026-10-17T10:00:00Z', 'local'), ('2026-10-17T11:00:00Z', 'local'),
+                                ('2026-10-17T12:00:00Z', 'ubuntu@web1')]:
+            save_run(self.dir, {'started': started, 'target': target})
+        self.assertEqual(previous_run(self.dir, 'local')['started'], '2026-10-17T11:00:00Z')
+        self.assertEqual(previous_run(self.dir, 'ubuntu@web1')['started'], '2026-10-17T12:00:00Z')
+        self.assertEqual(previous_run(self.dir, 'web2'), None)
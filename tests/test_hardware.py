@@ -0,0 +1,31 @@
+import sys
+import unittest
+from StringIO import StringIO
+
+import hardware
+from hardware import instance_hardware, DEFAULT_HARDWARE
+
+
+class InstanceHardwareTest(unittest.TestCase):
+    def setUp(self):
+        hardware._warned.clear()
+        self.stdout, sys.stdout = sys.stdout, StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_known_types(self):
+        self.assertEqual(instance_hardware('t2.medium'), (2, 4096))
+        self.assertEqual(instance_hardware('t3.medium'), (2, 4096))
+
+    def test_overrides_win(self):
+        self.assertEqual(instance_hardware('c5.large', {'c5.large': (2, 4096)}), (2, 4096))
+        self.assertEqual(instance_hardware('t2.medium', {'t2.medium': ('4', '8192')}), (4, 8192))
+        self.assertEqual(sys.stdout.getvalue(), '')
+
+    def test_unknown_types_get_the_default_with_a_warning(self):
+        self.assertEqual(instance_hardware('x9.huge'), DEFAULT_HARDWARE)
+        self.assertEqual(instance_hardware('x9.huge', {'c5.large': (2, 4096)}), DEFAULT_HARDWARE)
+        output = sys.stdout.getvalue()
+        self.assertTrue('Unknown instance type x9.huge' in output, output)
+        self.assertEqual(output.count('x9.huge'), 1)
@@ -0,0 +1,176 @@
+import unittest
+
+from images import image_key, find_image, create_image, bake, boot_image, KEY_TAG, BAKED_AT_TAG
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeImage(object):
+    """
+    An image that is pending for the first pending_polls updates
+    """
+    def __init__(self, id, tags=None, state=u'available', pending_polls=0, final_state=u'available'):
+        self.id = id
+        self.tags = tags or {}
+        self.state = state
+        self.pending_polls = pending_polls
+        self.final_state = final_state
+
+    def update(self):
+        self.pending_polls -= 1
+        if self.pending_polls <= 0:
+            self.state = self.final_state
+
+
+class FakeEC2(object):
+    def __init__(self, images=(), pending_polls=0, final_state=u'available'):
+        self.images = list(images)
+        self.pending_polls = pending_polls
+        self.final_state = final_state
+        self.log = []
+
+    def get_all_images(self, owners=None, filters=None):
+        self.log.append(('get_all_images', owners, filters))
+        tags = dict((k[len('tag:'):], v) for k, v in filters.items())
+        return [i for i in self.images if all(i.tags.get(k) == v for k, v in tags.items())]
+
+    def create_image(self, instance_id, name, description=None):
+        self.log.append(('create_image', instance_id, name))
+        image = FakeImage('ami-new', state=u'pending', pending_polls=self.pending_polls, final_state=self.final_state)
+        self.images.append(image)
+        return image.id
+
+    def get_image(self, image_id):
+        return [i for i in self.images if i.id == image_id][0]
+
+    def create_tags(self, ids, tags):
+        self.log.append(('create_tags', ids, sorted(tags)))
+        for image in self.images:
+            if image.id in ids:
+                image.tags.update(tags)
+
+    def terminate_instances(self, ids):
+        self.log.append(('terminate_instances', ids))
+
+
+class FakeResource(object):
+    def __init__(self, name, fingerprint):
+        self.name = name
+        self._fingerprint = fingerprint
+
+    def fingerprint(self):
+        return self._fingerprint
+
+
+class Builder(object):
+    """
+    Stands in for launching and provisioning a builder instance, recording the calls
+    """
+    def __init__(self, fail=False):
+        self.fail = fail
+        self.launched = []
+        self.provisioned = []
+
+    def launch(self):
+        instance = Obj(id='i-builder')
+        self.launched.append(instance.id)
+        return instance
+
+    def provision(self, instance):
+        self.provisioned.append(instance.id)
+        if self.fail:
+            raise Exception("apt-get failed")
+
+
+def baked(id, key, at, state=u'available'):
+    return FakeImage(id, tags={KEY_TAG: key, BAKED_AT_TAG: at}, state=state)
+
+
+class ImageKeyTest(unittest.TestCase):
+    def test_changes_with_the_base_ami_and_every_fingerprint(self):
+        resources = [FakeResource('apt', 'a1'), FakeResource('pip', 'p1')]
+        key = image_key('ami-1', resources)
+        self.assertEqual(key, image_key('ami-1', [FakeResource('apt', 'a1'), FakeResource('pip', 'p1')]))
+        self.assertNotEqual(key, image_key('ami-2', resources))
+        self.assertNotEqual(key, image_key('ami-1', [FakeResource('apt', 'a1'), FakeResource('pip', 'p2')]))
+
+
+class FindImageTest(unittest.TestCase):
+    def test_picks_the_newest_available_image_for_the_key(self):
+        conn = FakeEC2([baked('ami-old', 'k', '20240101000000'), baked('ami-new', 'k', '20240301000000'),
+                        baked('ami-broken', 'k', '20240401000000', state=u'failed'),
+                        baked('ami-other', 'other', '20240501000000')])
+        self.assertEqual(find_image(conn, 'k').id, 'ami-new')
+        self.assertEqual(conn.log, [('get_all_images', ['self'], {'tag:%s' % KEY_TAG: 'k'})])
+
+    def test_none_without_a_match(self):
+        self.assertEqual(find_image(FakeEC2([baked('ami-other', 'other', '20240101000000')]), 'k'), None)
+
+
+class CreateImageTest(unittest.TestCase):
+    def test_waits_for_the_image_and_tags_it(self):
+        conn = FakeEC2(pending_polls=3)
+        sleeps = []
+        self.assertEqual(create_image(conn, 'i-1', 'k' * 40, 'web', poll=15, sleep=sleeps.append), 'ami-new')
+        self.assertEqual(sleeps, [15, 15, 15])
+        self.assertEqual(conn.log[-1], ('create_tags', ['ami-new'], sorted([KEY_TAG, BAKED_AT_TAG, 'Name'])))
+        image = conn.get_image('ami-new')
+        self.assertEqual(image.tags[KEY_TAG], 'k' * 40)
+        self.assertTrue(image.tags['Name'].startswith('web-' + 'k' * 12 + '-'))
+
+    def test_an_image_that_fails_is_not_tagged(self):
+        conn = FakeEC2(pending_polls=1, final_state=u'failed')
+        self.assertRaises(Exception, create_image, conn, 'i-1', 'k', 'web', sleep=lambda s: None)
+        self.assertEqual([entry for entry in conn.log if entry[0] == 'create_tags'], [])
+
+
+class BakeTest(unittest.TestCase):
+    def test_a_hit_reuses_the_image(self):
+        conn = FakeEC2([baked('ami-baked', 'k', '20240101000000')])
+        builder = Builder()
+        self.assertEqual(bake(conn, 'k', builder.launch, builder.provision, 'web'), 'ami-baked')
+        self.assertEqual(builder.launched, [])
+        self.assertEqual([entry[0] for entry in conn.log], ['get_all_images'])
+
+    def test_a_miss_bakes_tags_and_terminates_the_builder(self):
+        conn = FakeEC2([baked('ami-stale', 'old', '20240101000000')], pending_polls=2)
+        builder = Builder()
+        image_id = bake(conn, 'k', builder.launch, builder.provision, 'web', sleep=lambda s: None)
+        self.assertEqual(image_id, 'ami-new')
+        self.assertEqual(builder.provisioned, ['i-builder'])
+        self.assertEqual([entry[0] for entry in conn.log],
+                         ['get_all_images', 'create_image', 'create_tags', 'terminate_instances'])
+        self.assertEqual(conn.log[-1], ('terminate_instances', ['i-builder']))
+        self.assertEqual(find_image(conn, 'k').id, 'ami-new')
+
+    def test_force_bakes_over_a_hit(self):
+        conn = FakeEC2([baked('ami-baked', 'k', '20240101000000')])
+        builder = Builder()
+        self.assertEqual(bake(conn, 'k', builder.launch, builder.provision, 'web', force=True), 'ami-new')
+        self.assertEqual(builder.launched, ['i-builder'])
+
+    def test_the_builder_is_terminated_when_provisioning_fails(self):
+        conn = FakeEC2()
+        builder = Builder(fail=True)
+        self.assertRaises(Exception, bake, conn, 'k', builder.launch, builder.provision, 'web')
+        self.assertEqual([entry[0] for entry in conn.log], ['get_all_images', 'terminate_instances'])
+
+
+class BootImageTest(unittest.TestCase):
+    def test_boots_the_baked_image_on_a_hit(self):
+        conn = FakeEC2([baked('ami-baked', 'k', '20240101000000')])
+        self.assertEqual(boot_image(conn, 'ami-base', lambda: 'k'), 'ami-baked')
+
+    def test_falls_back_to_the_base_ami_on_a_miss(self):
+        self.assertEqual(boot_image(FakeEC2(), 'ami-base', lambda: 'k'), 'ami-base')
+
+    def test_disabled_bypasses_the_lookup_and_the_key(self):
+        def key():
+            raise AssertionError("the key is not needed")
+
+        conn = FakeEC2([baked('ami-baked', 'k', '20240101000000')])
+        self.assertEqual(boot_image(conn, 'ami-base', key, enabled=False), 'ami-base')
+        self.assertEqual(conn.log, [])
@@ -0,0 +1,93 @@
+import unittest
+
+from logs import parse, endpoint, analyze, merge, percentile, OTHER
+
+
+def line(url, status=200, request_time='0.120', upstream='0.100', cache='-', method='GET'):
+    return ('10.0.0.1 - - [17/Oct/2026:10:00:00 +0000] "%s %s HTTP/1.1" %d 512 "-" "curl/7.0" %s "%s" %s' %
+            (method, url, status, request_time, upstream, cache))
+
+
+class ParseTest(unittest.TestCase):
+    def test_timed_format(self):
+        self.assertEqual(parse(line('/a/?page=2')), ('GET', '/a/?page=2', 200, 0.12, 0.1, '-'))
+
+    def test_adds_up_the_upstreams_tried(self):
+        self.assertEqual(parse(line('/a/', upstream='0.100, 0.250'))[4], 0.35)
+
+    def test_answered_by_nginx(self):
+        self.assertEqual(parse(line('/a/', upstream='-', cache='HIT'))[4:], (None, 'HIT'))
+
+    def test_combined_format_has_no_times(self):
+        combined = '10.0.0.1 - - [17/Oct/2026:10:00:00 +0000] "GET / HTTP/1.1" 200 512 "-" "curl/7.0"'
+        self.assertEqual(parse(combined), ('GET', '/', 200, None, None, '-'))
+
+    def test_not_a_log_line(self):
+        self.assertEqual(parse('garbage'), None)
+
+
+class EndpointTest(unittest.TestCase):
+    def test_folds_ids(self):
+        self.assertEqual(endpoint('GET', '/users/42/posts/0123456789abcdef0123/'), 'GET /users/{id}/posts/{id}/')
+        self.assertEqual(endpoint('PUT', '/a/123e4567-e89b-12d3-a456-426614174000'), 'PUT /a/{id}')
+
+    def test_drops_the_query_string(self):
+        self.assertEqual(endpoint('GET', '/search/?q=1'), 'GET /search/')
+
+    def test_keeps_words(self):
+        self.assertEqual(endpoint('GET', '/blog/hello-world/'), 'GET /blog/hello-world/')
+
+
+class AnalyzeTest(unittest.TestCase):
+    def test_counts_per_endpoint(self):
+        summary = analyze([line('/users/1/'), line('/users/2/', status=502), line('/users/3/', cache='HIT'),
+                           'garbage'])
+        self.assertEqual((summary['lines'], summary['unparsed']), (4, 1))
+        stats = summary['endpoints']['GET /users/{id}/']
+        self.assertEqual((stats['count'], stats['errors'], stats['cached']), (3, 1, 1))
+        self.assertEqual(stats['latency'], {120: 3})
+        self.assertEqual(stats['upstream'], {100: 3})
+
+    def test_keeps_the_slowest_requests(self):
+        summary = analyze([line('/%d/' % i, request_time='%d.000' % i) for i in range(10)], slowest=3)
+        self.assertEqual(sorted(r[1] for r in summary['slowest']), ['/7/', '/8/', '/9/'])
+
+    def test_counts_endpoints_past_the_limit_together(self):
+        summary = analyze([line('/page-%d/' % i) for i in range(10)], max_endpoints=3)
+        self.assertEqual(len(summary['endpoints']), 4)
+        self.assertEqual(summary['endpoints'][OTHER]['count'], 7)
+
+
+class MergeTest(unittest.TestCase):
+    def test_adds_up_hosts(self):
+        one = analyze([line('/a/', request_time='0.100'), line('/b/', request_time='3.000')])
+        two = analyze([line('/a/', request_time='0.100', status=500), line('/a/', request_time='0.200')])
+        total = merge([one, two], slowest=2)
+        self.assertEqual(total['lines'], 4)
+        stats = total['endpoints']['GET /a/']
+        self.assertEqual((stats['count'], stats['errors'], stats['latency']), (3, 1, {100: 2, 200: 1}))
+        self.assertEqual([r[1] for r in sorted(total['slowest'], reverse=True)], ['/b/', '/a/'])
+
+    def test_counts_endpoints_past_the_limit_together(self):
+        one = analyze([line('/a/'), line('/b/')])
+        two = analyze([line('/c/'), line('/d/')])
+        total = merge([one, two], max_endpoints=3)
+        self.assertEqual(sorted(total['endpoints']), sorted(['GET /a/', 'GET /b/', 'GET /c/', OTHER]))
+        self.assertEqual(total['endpoints'][OTHER]['count'], 1)
+
+
+class PercentileTest(unittest.TestCase):
+    def test_nearest_rank(self):
+        counts = dict((ms, 1) for ms in range(1, 101))
+        self.assertEqual([percentile(counts, p) for p in (50, 95, 99, 100)], [50, 95, 99, 100])
+
+    def test_weighted_by_count(self):
+        self.assertEqual(percentile({10: 9, 1000: 1}, 90), 10)
+        self.assertEqual(percentile({10: 9, 1000: 1}, 91), 1000)
+
+    def test_empty(self):
+        self.assertEqual(percentile({}, 50), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+import os
+import time
+import unittest
+
+from multihost import run_on_hosts, failed, OK, FAILED, SKIPPED
+
+
+def call(host, func):
+    return func(host)
+
+
+def fails_on(*bad):
+    def func(host):
+        if host in bad:
+            raise Exception("broken on %s" % host)
+        return host.upper()
+    return func
+
+
+class SerialTest(unittest.TestCase):
+    def test_runs_each_host_in_order(self):
+        seen = []
+        results = run_on_hosts(lambda host: seen.append(host) or host.upper(), ['a', 'b', 'c'], executor=call)
+        self.assertEqual(seen, ['a', 'b', 'c'])
+        self.assertEqual([(r.host, r.status, r.value) for r in results], [('a', OK, 'A'), ('b', OK, 'B'),
+                                                                          ('c', OK, 'C')])
+
+    def test_fail_fast_skips_the_rest(self):
+        results = run_on_hosts(fails_on('b'), ['a', 'b', 'c'], executor=call)
+        self.assertEqual([r.status for r in results], [OK, FAILED, SKIPPED])
+        self.assertIn("broken on b", results[1].error)
+        self.assertEqual([r.host for r in failed(results)], ['b', 'c'])
+
+    def test_without_fail_fast_runs_every_host(self):
+        results = run_on_hosts(fails_on('a'), ['a', 'b', 'c'], fail_fast=False, executor=call)
+        self.assertEqual([r.status for r in results], [FAILED, OK, OK])
+
+    def test_abort_fails_the_host(self):
+        def abort(host):
+            raise SystemExit(1)
+        results = run_on_hosts(abort, ['a'], executor=call)
+        self.assertEqual((results[0].status, results[0].error), (FAILED, 'aborted'))
+
+
+class ParallelTest(unittest.TestCase):
+    def test_runs_hosts_at_once(self):
+        start = time.time()
+        results = run_on_hosts(lambda host: time.sleep(0.5) or host.upper(), ['a', 'b', 'c', 'd'], pool_size=4,
+                               executor=call)
+        self.assertLess(time.time() - start, 1.5)
+        self.assertEqual([(r.host, r.status, r.value) for r in results], [('a', OK, 'A'), ('b', OK, 'B'),
+                                                                          ('c', OK, 'C'), ('d', OK, 'D')])
+
+    def test_unpicklable_values_come_back_as_repr(self):
+        results = run_on_hosts(lambda host: lambda: None, ['a', 'b'], pool_size=2, executor=call)
+        self.assertEqual([r.status for r in results], [OK, OK])
+        self.assertTrue(results[0].value.startswith('<function'))
+
+    def test_fail_fast_stops_the_others(self):
+        def slow_unless_a(host):
+            if host == 'a':
+                raise Exception("broken on a")
+            time.sleep(5)
+        start = time.time()
+        results = run_on_hosts(slow_unless_a, ['a', 'b', 'c', 'd'], pool_size=2, executor=call)
+        self.assertLess(time.time() - start, 4)
+        self.assertEqual([r.status for r in results], [FAILED, FAILED, SKIPPED, SKIPPED])
+        self.assertIn('terminated', results[1].error)
+
+    def test_without_fail_fast_runs_every_host(self):
+        results = run_on_hosts(fails_on('b'), ['a', 'b', 'c'], pool_size=2, fail_fast=False, executor=call)
+        self.assertEqual([r.status for r in results], [OK, FAILED, OK])
+
+    def test_worker_that_dies_fails_its_host(self):
+        def die(host):
+            if host == 'b':
+                os._exit(3)
+            return host
+        results = run_on_hosts(die, ['a', 'b'], pool_size=2, fail_fast=False, executor=call)
+        self.assertEqual([r.status for r in results], [OK, FAILED])
+        self.assertIn('exited with code 3', results[1].error)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+import os
+import re
+import imp
+import sys
+import unittest
+
+from nginx import lint
+from tuning import system_settings
+
+FABFILE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fabfile')
+
+
+def sample_fabconf():
+    """
+    fabconf from project_conf on top of my_project_conf_sample.py, as django-admin startproject renders it
+    """
+    f = open(os.path.join(FABFILE_DIR, 'my_project_conf_sample.py'), 'rb')
+    try:
+        source = f.read().replace('{{ project_name }}', 'mysite')
+    finally:
+        f.close()
+    module = imp.new_module('my_project_conf')
+    exec source in module.__dict__
+    sys.modules['my_project_conf'] = module
+    sys.modules.pop('project_conf', None)
+    import project_conf
+    return project_conf.fabconf
+
+
+def render(name, context):
+    f = open(os.path.join(FABFILE_DIR, 'templates', name), 'rb')
+    try:
+        return f.read() % context
+    finally:
+        f.close()
+
+
+class ShippedTemplatesTest(unittest.TestCase):
+    def setUp(self):
+        self.context = dict(sample_fabconf(), **system_settings(2, 4096))
+
+    def test_nginx_conf_lints_clean(self):
+        self.assertEqual(lint(render('nginx.conf', self.context)), [])
+
+    def test_app_proxy_lints_clean(self):
+        self.assertEqual(lint(render('nginx-app-proxy', self.context)), [])
+
+    def test_only_hashed_static_files_are_immutable(self):
+        config = render('nginx-app-proxy', self.context)
+        self.assertTrue('add_header Cache-Control $static_cache_control;' in config)
+        self.assertTrue('default "public, max-age=%d";' % self.context['STATIC_UNHASHED_MAX_AGE'] in config)
+        hashed = re.search(r'"~(.+)" "public, max-age=%d, immutable";' % self.context['STATIC_MAX_AGE'], config)
+        for uri in ['/static/css/app.3f2a9c1b4e5d.css', '/static/admin/js/core.0123456789ab.js']:
+            self.assertTrue(re.search(hashed.group(1), uri), uri)
+        for uri in ['/static/css/app.css', '/static/robots.txt', '/static/js/app.3f2a9c1b.js']:
+            self.assertFalse(re.search(hashed.group(1), uri), uri)
+
+    def test_app_proxy_lints_clean_with_the_options_on(self):
+        self.context.update(NGINX_PROXY_CACHE='app_cache', NGINX_BROTLI_STATIC='brotli_static on;')
+        self.assertEqual(lint(render('nginx-app-proxy', self.context)), [])
+
+
+class LintTest(unittest.TestCase):
+    def test_a_clean_config(self):
+        config = ('# comment with { and ;\n'
+                  'events {\n  worker_connections 1024;\n}\n'
+                  'http {\n  log_format x \'$a "quoted; {" \'\n             \'$b\';\n'
+                  '  location / {\n    return 200 "}";\n  }\n}\n')
+        self.assertEqual(lint(config), [])
+
+    def test_a_brace_that_is_never_closed(self):
+        self.assertEqual(lint('http {\n  server {\n    listen 80;\n  }\n'), ["line 1: { is never closed"])
+
+    def test_a_closing_brace_without_an_opening_one(self):
+        self.assertEqual(lint('http {\n  listen 80;\n}\n}\n'), ["line 4: } without a matching {"])
+
+    def test_a_missing_semicolon_before_a_closing_brace(self):
+        self.assertEqual(lint('http {\n  sendfile on\n}\n'), ["line 2: missing ; after directive"])
+
+    def test_a_missing_semicolon_at_the_end(self):
+        self.assertEqual(lint('worker_processes auto'), ["line 1: missing ; after directive"])
+
+    def test_an_unclosed_quote(self):
+        self.assertEqual(lint('http {\n  gzip_disable "MSIE;\n}\n')[0], "line 2: unclosed quote")
+
+    def test_placeholders_left_from_the_template(self):
+        config = 'http {\n  listen 80 backlog=%(SOMAXCONN)d;\n  root %(PROJECT_PATH)s;\n}\n'
+        self.assertEqual(lint(config), ["line 2: %(SOMAXCONN)d was not rendered",
+                                        "line 3: %(PROJECT_PATH)s was not rendered"])
@@ -0,0 +1,102 @@
+import os
+import unittest
+import ConfigParser
+from StringIO import StringIO
+
+from pgbouncer import pool_sizes, pooled_databases, userlist
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fabfile', 'templates')
+
+DATABASES = {
+    'default': {'ENGINE': 'django.db.backends.postgresql_psycopg2', 'NAME': 'app', 'USER': 'app',
+                'PASSWORD': 'secret', 'HOST': 'db.example.com', 'PORT': '5433'},
+    'replica': {'ENGINE': 'django.contrib.gis.db.backends.postgis', 'NAME': 'app', 'USER': 'app',
+                'PASSWORD': 'secret', 'HOST': 'replica.example.com'},
+    'legacy': {'ENGINE': 'django.db.backends.mysql', 'NAME': 'old', 'USER': 'old', 'HOST': 'mysql.example.com'},
+}
+
+
+def render(name, context):
+    f = open(os.path.join(TEMPLATES_DIR, name), 'rb')
+    try:
+        return f.read() % context
+    finally:
+        f.close()
+
+
+class PoolSizesTest(unittest.TestCase):
+    def test_the_pool_covers_every_worker_thread(self):
+        sizes = pool_sizes(4, 2, 50)
+        self.assertEqual(sizes['PGBOUNCER_POOL_SIZE'], 8)
+        self.assertEqual(sizes['PGBOUNCER_RESERVE_POOL_SIZE'], 1)
+
+    def test_the_pool_and_reserve_stay_within_the_connection_budget(self):
+        for workers, threads, budget in [(9, 8, 50), (17, 4, 20), (3, 1000, 100), (4, 3, 12), (5, 5, 2)]:
+            sizes = pool_sizes(workers, threads, budget)
+            self.assertTrue(sizes['PGBOUNCER_POOL_SIZE'] + sizes['PGBOUNCER_RESERVE_POOL_SIZE'] <= budget,
+                            (workers, threads, budget, sizes))
+            self.assertTrue(sizes['PGBOUNCER_POOL_SIZE'] >= 1)
+
+    def test_a_capped_pool_gives_a_fifth_to_the_reserve(self):
+        sizes = pool_sizes(9, 8, 50)
+        self.assertEqual((sizes['PGBOUNCER_POOL_SIZE'], sizes['PGBOUNCER_RESERVE_POOL_SIZE']), (40, 10))
+
+    def test_no_budget_pools_every_worker_thread(self):
+        sizes = pool_sizes(9, 8)
+        self.assertEqual((sizes['PGBOUNCER_POOL_SIZE'], sizes['PGBOUNCER_RESERVE_POOL_SIZE']), (72, 14))
+
+    def test_clients_cover_old_and_new_workers_during_a_reload(self):
+        self.assertEqual(pool_sizes(2, 1, 50)['PGBOUNCER_MAX_CLIENT_CONN'], 100)
+        self.assertEqual(pool_sizes(9, 8, 50)['PGBOUNCER_MAX_CLIENT_CONN'], 144)
+
+
+class PooledDatabasesTest(unittest.TestCase):
+    def setUp(self):
+        self.lines, self.users, self.pooled = pooled_databases(DATABASES, 6432)
+
+    def test_postgres_databases_point_at_pgbouncer(self):
+        for alias in ('default', 'replica'):
+            database = self.pooled[alias]
+            self.assertEqual((database['HOST'], database['PORT'], database['NAME']), ('127.0.0.1', 6432, alias))
+            self.assertTrue(database['DISABLE_SERVER_SIDE_CURSORS'])
+            self.assertEqual((database['USER'], database['PASSWORD']), ('app', 'secret'))
+            self.assertEqual(database['ENGINE'], DATABASES[alias]['ENGINE'])
+
+    def test_other_databases_are_left_alone(self):
+        self.assertEqual(self.pooled['legacy'], DATABASES['legacy'])
+
+    def test_pgbouncer_gets_the_real_hosts(self):
+        self.assertEqual(self.lines, ['default = host=db.example.com port=5433 dbname=app',
+                                      'replica = host=replica.example.com port=5432 dbname=app'])
+
+    def test_each_user_is_listed_once(self):
+        self.assertEqual(self.users, [('app', 'secret')])
+
+    def test_the_settings_are_not_changed(self):
+        self.assertEqual(DATABASES['default']['HOST'], 'db.example.com')
+
+
+class UserlistTest(unittest.TestCase):
+    def test_quotes_are_doubled(self):
+        self.assertEqual(userlist([('app', 'se"cr"et'), ('o"brien', None)]),
+                         '"app" "se""cr""et"\n"o""brien" ""\n')
+
+
+class TemplatesTest(unittest.TestCase):
+    def setUp(self):
+        lines, users, pooled = pooled_databases(DATABASES, 6432)
+        self.context = dict(pool_sizes(9, 8, 50), INSTANCE_TYPE='m3.large', PGBOUNCER_PORT=6432,
+                            PGBOUNCER_DATABASES="\n".join(lines),
+                            PGBOUNCER_USERLIST=userlist(users + [('a%b', '100%')]))
+
+    def test_pgbouncer_ini(self):
+        config = ConfigParser.RawConfigParser()
+        config.readfp(StringIO(render('pgbouncer.ini', self.context)))
+        self.assertEqual(config.get('databases', 'default'), 'host=db.example.com port=5433 dbname=app')
+        self.assertEqual(config.get('pgbouncer', 'listen_port'), '6432')
+        self.assertEqual(config.get('pgbouncer', 'pool_mode'), 'transaction')
+        self.assertEqual(config.get('pgbouncer', 'default_pool_size'), '40')
+        self.assertEqual(config.get('pgbouncer', 'reserve_pool_size'), '10')
+
+    def test_userlist_is_rendered_as_is(self):
+        self.assertEqual(render('pgbouncer-userlist.txt', self.context), '"app" "secret"\n"a%b" "100%"\n')
@@ -0,0 +1,221 @@
+import socket
+import unittest
+
+from boto.exception import EC2ResponseError
+
+from readiness import poll, wait_for_running, check_ssh, wait_for_ssh, Phases
+
+
+NOT_FOUND = ('<Response><Errors><Error><Code>InvalidInstanceID.NotFound</Code>'
+             '<Message>The instance ID does not exist</Message></Error></Errors></Response>')
+
+
+class Clock(object):
+    """
+    A clock that only moves when something sleeps on it
+    """
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class Checks(object):
+    """
+    A check that misses misses times, then returns result
+    """
+    def __init__(self, misses, result='ready', error=None):
+        self.misses = misses
+        self.result = result
+        self.error = error
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.calls <= self.misses:
+            if self.error is not None:
+                raise self.error
+            return None
+        return self.result
+
+
+class FakeEC2(object):
+    """
+    Instances that are unknown to the API for unknown_polls polls, then pending for pending_polls more
+    """
+    def __init__(self, ids, unknown_polls=0, pending_polls=0, final_state=u'running'):
+        self.ids = ids
+        self.unknown_polls = unknown_polls
+        self.pending_polls = pending_polls
+        self.final_state = final_state
+        self.polls = 0
+
+    def get_all_instances(self, instance_ids):
+        self.polls += 1
+        if self.polls <= self.unknown_polls:
+            raise EC2ResponseError(400, 'Bad Request', NOT_FOUND)
+        state = u'pending' if self.polls <= self.unknown_polls + self.pending_polls else self.final_state
+        return [Obj(instances=[Obj(id=i, state=state) for i in self.ids])]
+
+
+class FakeSocket(object):
+    def __init__(self, banner):
+        self.banner = banner
+        self.closed = False
+
+    def recv(self, size):
+        return self.banner[:size]
+
+    def close(self):
+        self.closed = True
+
+
+class Connector(object):
+    """
+    Refuses the first refusals connections, then answers with banner
+    """
+    def __init__(self, refusals, banner='SSH-2.0-OpenSSH'):
+        self.refusals = refusals
+        self.banner = banner
+        self.sockets = []
+
+    def __call__(self, address, timeout):
+        if len(self.sockets) < self.refusals:
+            self.sockets.append(None)
+            raise socket.error(111, 'Connection refused')
+        sock = FakeSocket(self.banner)
+        self.sockets.append(sock)
+        return sock
+
+
+class PollTest(unittest.TestCase):
+    def test_returns_the_result_after_some_misses(self):
+        clock = Clock()
+        check = Checks(3)
+        self.assertEqual(poll(check, 60, 'it', clock=clock, sleep=clock.sleep), 'ready')
+        self.assertEqual(check.calls, 4)
+        self.assertEqual(len(clock.sleeps), 3)
+
+    def test_no_sleep_when_the_first_check_passes(self):
+        clock = Clock()
+        self.assertEqual(poll(Checks(0), 60, 'it', clock=clock, sleep=clock.sleep), 'ready')
+        self.assertEqual(clock.sleeps, [])
+
+    def test_backs_off_exponentially_up_to_the_maximum(self):
+        clock = Clock()
+        poll(Checks(7), 1000, 'it', initial=1.0, factor=2.0, maximum=15.0, clock=clock, sleep=clock.sleep)
+        self.assertEqual(clock.sleeps, [1.0, 2.0, 4.0, 8.0, 15.0, 15.0, 15.0])
+
+    def test_the_last_sleep_stops_at_the_deadline(self):
+        clock = Clock()
+        self.assertRaises(Exception, poll, Checks(100), 10, 'it', clock=clock, sleep=clock.sleep)
+        self.assertEqual(clock.sleeps, [1.0, 2.0, 4.0, 3.0])
+        self.assertEqual(clock.now, 10.0)
+
+    def test_times_out_with_what_it_waited_for(self):
+        clock = Clock()
+        try:
+            poll(Checks(100), 30, 'the thing', clock=clock, sleep=clock.sleep)
+        except Exception as e:
+            self.assertEqual(str(e), "Timed out after 30s waiting for the thing")
+        else:
+            self.fail("poll did not time out")
+
+    def test_times_out_with_the_last_error(self):
+        clock = Clock()
+        check = Checks(100, error=socket.error(111, 'Connection refused'))
+        try:
+            poll(check, 30, 'ssh', retry_on=(socket.error,), clock=clock, sleep=clock.sleep)
+        except Exception as e:
+            self.assertTrue(str(e).startswith("Timed out after 30s waiting for ssh, last error: "), str(e))
+            self.assertTrue('Connection refused' in str(e), str(e))
+        else:
+            self.fail("poll did not time out")
+
+    def test_retried_errors_are_misses(self):
+        clock = Clock()
+        check = Checks(2, error=socket.error(111, 'Connection refused'))
+        self.assertEqual(poll(check, 60, 'ssh', retry_on=(socket.error,), clock=clock, sleep=clock.sleep), 'ready')
+        self.assertEqual(clock.sleeps, [1.0, 2.0])
+
+    def test_other_errors_are_raised_at_once(self):
+        clock = Clock()
+        check = Checks(2, error=ValueError('broken'))
+        self.assertRaises(ValueError, poll, check, 60, 'it', retry_on=(socket.error,), clock=clock, sleep=clock.sleep)
+        self.assertEqual(check.calls, 1)
+
+
+class WaitForRunningTest(unittest.TestCase):
+    def test_waits_through_unknown_and_pending_instances(self):
+        clock = Clock()
+        conn = FakeEC2(['i-1', 'i-2'], unknown_polls=2, pending_polls=2)
+        instances = wait_for_running(conn, ['i-1', 'i-2'], 300, clock=clock, sleep=clock.sleep)
+        self.assertEqual([i.id for i in instances], ['i-1', 'i-2'])
+        self.assertEqual(conn.polls, 5)
+
+    def test_a_terminated_instance_fails_at_once(self):
+        clock = Clock()
+        conn = FakeEC2(['i-1'], final_state=u'terminated')
+        self.assertRaises(Exception, wait_for_running, conn, ['i-1'], 300, clock=clock, sleep=clock.sleep)
+        self.assertEqual(conn.polls, 1)
+
+    def test_times_out_with_the_api_error(self):
+        clock = Clock()
+        conn = FakeEC2(['i-1'], unknown_polls=1000)
+        try:
+            wait_for_running(conn, ['i-1'], 60, clock=clock, sleep=clock.sleep)
+        except Exception as e:
+            self.assertTrue('InvalidInstanceID.NotFound' in str(e), str(e))
+        else:
+            self.fail("wait_for_running did not time out")
+
+
+class SshTest(unittest.TestCase):
+    def test_check_ssh_needs_the_banner(self):
+        connect = Connector(0, banner='HTTP/1.1 400')
+        self.assertRaises(socket.error, check_ssh, 'web1', connect=connect)
+        self.assertTrue(connect.sockets[0].closed)
+        self.assertTrue(check_ssh('web1', connect=Connector(0)))
+
+    def test_waits_until_sshd_answers(self):
+        clock = Clock()
+        connect = Connector(3)
+        wait_for_ssh('web1', 60, connect=connect, clock=clock, sleep=clock.sleep)
+        self.assertEqual(len(connect.sockets), 4)
+        self.assertEqual(clock.sleeps, [1.0, 2.0, 4.0])
+
+    def test_times_out_with_the_connection_error(self):
+        clock = Clock()
+        try:
+            wait_for_ssh('web1', 20, connect=Connector(1000), clock=clock, sleep=clock.sleep)
+        except Exception as e:
+            self.assertTrue('waiting for ssh on web1' in str(e), str(e))
+            self.assertTrue('Connection refused' in str(e), str(e))
+        else:
+            self.fail("wait_for_ssh did not time out")
+
+
+class PhasesTest(unittest.TestCase):
+    def test_records_each_phase_even_when_it_fails(self):
+        clock = Clock()
+        phases = Phases(clock)
+        with phases.phase('boot'):
+            clock.sleep(30)
+        try:
+            with phases.phase('deploy'):
+                clock.sleep(5)
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertEqual(phases.timings, [('boot', 30.0), ('deploy', 5.0)])
@@ -0,0 +1,239 @@
+import unittest
+
+from scaling import tagged_instances, provisioned, mark_provisioned, register, drain, out_of_service, \
+    ensure_group, surplus, wait_for_capacity, launch_configuration_name, PROVISIONED_TAG, UNPROVISIONED
+
+
+class Clock(object):
+    """
+    A clock that only moves when something sleeps on it
+    """
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class Obj(object):
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeEC2(object):
+    def __init__(self, instances):
+        self.instances = instances
+        self.filters = None
+
+    def get_all_instances(self, filters=None):
+        self.filters = filters
+        return [Obj(instances=[i]) for i in self.instances]
+
+    def create_tags(self, ids, tags):
+        for instance in self.instances:
+            if instance.id in ids:
+                instance.tags.update(tags)
+
+
+class FakeELB(object):
+    """
+    A load balancer whose instances pass the health check after checks_to_pass looks at them
+    """
+    def __init__(self, registered=(), checks_to_pass=1):
+        self.registered = dict((i, 0) for i in registered)
+        self.checks_to_pass = checks_to_pass
+        self.log = []
+
+    def register_instances(self, name, ids):
+        self.log.append(('register', name, sorted(ids)))
+        for i in ids:
+            self.registered.setdefault(i, 0)
+
+    def deregister_instances(self, name, ids):
+        self.log.append(('deregister', name, sorted(ids)))
+        for i in ids:
+            del self.registered[i]
+
+    def describe_instance_health(self, name, ids=None):
+        states = []
+        for i in sorted(self.registered):
+            if ids is None or i in ids:
+                self.registered[i] += 1
+                passing = self.registered[i] > self.checks_to_pass
+                states.append(Obj(instance_id=i, state='InService' if passing else 'OutOfService', description=''))
+        return states
+
+
+class FakeGroup(object):
+    def __init__(self, name, launch_config_name, min_size, max_size, instances=()):
+        self.name = name
+        self.launch_config_name = launch_config_name
+        self.min_size = min_size
+        self.max_size = max_size
+        self.instances = list(instances)
+        self.updates = 0
+
+    def update(self):
+        self.updates += 1
+
+
+class FakeAutoscale(object):
+    def __init__(self, groups=()):
+        self.groups = dict((g.name, g) for g in groups)
+        self.created = []
+        self.tags = []
+
+    def get_all_groups(self, names=None):
+        return [self.groups[name] for name in names if name in self.groups]
+
+    def create_auto_scaling_group(self, group):
+        self.created.append(group)
+        self.groups[group.name] = FakeGroup(group.name, group.launch_config_name, group.min_size, group.max_size)
+
+    def create_or_update_tags(self, tags):
+        self.tags.extend((t.key, t.value, t.propagate_at_launch, t.resource_id) for t in tags)
+
+
+def instance(id, launch_time, **tags):
+    return Obj(id=id, public_dns_name='%s.example.com' % id, launch_time=launch_time, tags=tags)
+
+
+class InstancesTest(unittest.TestCase):
+    def test_tagged_instances_oldest_first(self):
+        ec2 = FakeEC2([instance('i-2', '2026-10-02'), instance('i-1', '2026-10-01')])
+        self.assertEqual([i.id for i in tagged_instances(ec2, 'web')], ['i-1', 'i-2'])
+        self.assertEqual(ec2.filters, {'tag:Name': 'web', 'instance-state-name': 'running'})
+
+    def test_provisioned(self):
+        ec2 = FakeEC2([instance('i-1', '1', Name='web'),
+                       instance('i-2', '2', Name='web', **{PROVISIONED_TAG: UNPROVISIONED})])
+        self.assertEqual([provisioned(i) for i in ec2.instances], [True, False])
+        mark_provisioned(ec2, ['i-2'], '2026-10-17T00:00:00Z')
+        self.assertTrue(provisioned(ec2.instances[1]))
+
+
+class LoadBalancerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_register_waits_for_the_health_check(self):
+        elb = FakeELB(checks_to_pass=3)
+        register(elb, 'web', ['i-1', 'i-2'], 60, self.clock, self.clock.sleep)
+        self.assertEqual(elb.log, [('register', 'web', ['i-1', 'i-2'])])
+        self.assertEqual(len(self.clock.sleeps), 3)
+
+    def test_register_times_out(self):
+        elb = FakeELB(checks_to_pass=1000)
+        self.assertRaises(Exception, register, elb, 'web', ['i-1'], 30, self.clock, self.clock.sleep)
+        self.assertEqual(self.clock.now, 30)
+
+    def test_drain_deregisters_and_waits(self):
+        elb = FakeELB(registered=['i-1', 'i-2'])
+        self.assertEqual(drain(elb, 'web', ['i-1', 'i-3'], 20, self.clock.sleep), ['i-1'])
+        self.assertEqual(elb.log, [('deregister', 'web', ['i-1'])])
+        self.assertEqual(self.clock.sleeps, [20])
+
+    def test_drain_does_nothing_for_unregistered_instances(self):
+        elb = FakeELB(registered=['i-1'])
+        self.assertEqual(drain(elb, 'web', ['i-2'], 20, self.clock.sleep), [])
+        self.assertEqual((elb.log, self.clock.sleeps), ([], []))
+
+    def test_out_of_service_puts_them_back_once_healthy(self):
+        elb = FakeELB(registered=['i-1', 'i-2'], checks_to_pass=2)
+        with out_of_service(elb, 'web', ['i-1'], 5, 60, self.clock, self.clock.sleep) as registered:
+            self.assertEqual(registered, ['i-1'])
+            self.assertNotIn('i-1', elb.registered)
+        self.assertEqual(elb.log, [('deregister', 'web', ['i-1']), ('register', 'web', ['i-1'])])
+        self.assertIn('i-1', elb.registered)
+        # Waited for the drain, then for the health check
+        self.assertEqual(self.clock.sleeps[0], 5)
+        self.assertTrue(len(self.clock.sleeps) > 1)
+
+    def test_out_of_service_puts_them_back_without_waiting_on_failure(self):
+        elb = FakeELB(registered=['i-1', 'i-2'], checks_to_pass=1000)
+        try:
+            with out_of_service(elb, 'web', ['i-1'], 5, 60, self.clock, self.clock.sleep):
+                raise ValueError("deploy failed")
+        except ValueError:
+            pass
+        else:
+            self.fail("the failure should be raised")
+        self.assertEqual(elb.log, [('deregister', 'web', ['i-1']), ('register', 'web', ['i-1'])])
+        self.assertEqual(self.clock.sleeps, [5])
+
+    def test_out_of_service_puts_them_back_after_an_abort(self):
+        elb = FakeELB(registered=['i-1'])
+        self.assertRaises(SystemExit, self._abort_in, elb)
+        self.assertIn('i-1', elb.registered)
+
+    def _abort_in(self, elb):
+        with out_of_service(elb, 'web', ['i-1'], 0, 60, self.clock, self.clock.sleep):
+            raise SystemExit(1)
+
+
+class GroupTest(unittest.TestCase):
+    def test_creates_the_group_and_tags_it(self):
+        autoscale = FakeAutoscale()
+        group = ensure_group(autoscale, 'web-asg', 'web-lc', ['us-west-2a'], ['web'], 1, 4, 'web')
+        self.assertEqual(group.name, 'web-asg')
+        created = autoscale.created[0]
+        self.assertEqual((created.launch_config_name, created.load_balancers, created.min_size, created.max_size),
+                         ('web-lc', ['web'], 1, 4))
+        self.assertEqual(sorted(autoscale.tags), [('Name', 'web', True, 'web-asg'),
+                                                  (PROVISIONED_TAG, UNPROVISIONED, True, 'web-asg')])
+
+    def test_updates_a_changed_group(self):
+        existing = FakeGroup('web-asg', 'old-lc', 1, 4)
+        autoscale = FakeAutoscale([existing])
+        group = ensure_group(autoscale, 'web-asg', 'new-lc', ['us-west-2a'], ['web'], 2, 6, 'web')
+        self.assertTrue(group is existing)
+        self.assertEqual((group.launch_config_name, group.min_size, group.max_size, group.updates),
+                         ('new-lc', 2, 6, 1))
+        self.assertEqual(autoscale.created, [])
+
+    def test_leaves_an_unchanged_group(self):
+        existing = FakeGroup('web-asg', 'web-lc', '1', '4')
+        group = ensure_group(FakeAutoscale([existing]), 'web-asg', 'web-lc', ['us-west-2a'], [], 1, 4, 'web')
+        self.assertEqual(group.updates, 0)
+
+    def test_surplus_removes_old_launch_configurations_first(self):
+        group = FakeGroup('web-asg', 'new-lc', 1, 4, [
+            Obj(instance_id='i-1', launch_config_name='new-lc'), Obj(instance_id='i-2', launch_config_name='old-lc'),
+            Obj(instance_id='i-3', launch_config_name='new-lc'), Obj(instance_id='i-4', launch_config_name='old-lc')])
+        self.assertEqual(surplus(group, 3), ['i-2'])
+        self.assertEqual(sorted(surplus(group, 1)), ['i-1', 'i-2', 'i-4'])
+        self.assertEqual(surplus(group, 4), [])
+
+    def test_wait_for_capacity(self):
+        clock = Clock()
+        group = FakeGroup('web-asg', 'web-lc', 1, 4, [Obj(instance_id='i-1', lifecycle_state='InService')])
+        autoscale = FakeAutoscale([group])
+        # The group launches a second instance, which then comes into service
+        launches = [lambda: group.instances.append(Obj(instance_id='i-2', lifecycle_state='Pending')),
+                    lambda: setattr(group.instances[1], 'lifecycle_state', 'InService')]
+
+        def sleep(seconds):
+            clock.sleep(seconds)
+            launches.pop(0)()
+
+        self.assertEqual(wait_for_capacity(autoscale, 'web-asg', 2, 60, clock, sleep), ['i-1', 'i-2'])
+        self.assertEqual(len(clock.sleeps), 2)
+
+    def test_wait_for_an_empty_group(self):
+        autoscale = FakeAutoscale([FakeGroup('web-asg', 'web-lc', 0, 4)])
+        self.assertEqual(wait_for_capacity(autoscale, 'web-asg', 0, 60, Clock(), None), [])
+
+    def test_launch_configuration_name_follows_what_it_launches(self):
+        name = launch_configuration_name('web', 'ami-1', 'm3.large', 'key', ['web', 'ssh'])
+        self.assertEqual(name, launch_configuration_name('web', 'ami-1', 'm3.large', 'key', ['ssh', 'web']))
+        self.assertNotEqual(name, launch_configuration_name('web', 'ami-2', 'm3.large', 'key', ['web', 'ssh']))
+        self.assertTrue(name.startswith('web-'))
+
+
+if __name__ == '__main__':
+    unittest.main()
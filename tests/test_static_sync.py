@@ -0,0 +1,169 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+
+from static_sync import sync, etag, headers, hashed_names, MANIFEST
+
+
+class FakeKey(object):
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.etag = None
+
+    def set_contents_from_filename(self, path, headers=None, policy=None):
+        data = open(path, 'rb').read()
+        self.bucket.store(self.name, data, '"%s"' % hashlib.md5(data).hexdigest(), headers)
+
+
+class FakeMultipart(object):
+    def __init__(self, bucket, name, headers):
+        self.bucket = bucket
+        self.name = name
+        self.headers = headers
+        self.parts = []
+
+    def upload_part_from_file(self, f, part, size):
+        self.parts.append(f.read(size))
+
+    def complete_upload(self):
+        digest = hashlib.md5(''.join(hashlib.md5(part).digest() for part in self.parts)).hexdigest()
+        self.bucket.store(self.name, ''.join(self.parts), '"%s-%d"' % (digest, len(self.parts)), self.headers)
+
+    def cancel_upload(self):
+        self.bucket.cancelled.append(self.name)
+
+
+class FakeBucket(object):
+    """
+    Keeps objects in memory with the ETags S3 would give them
+    """
+    def __init__(self, broken=()):
+        self.objects = {}
+        self.uploads = []
+        self.cancelled = []
+        self.broken = broken
+        self.lock = threading.Lock()
+
+    def list(self, prefix):
+        return [self._key(name) for name in self.objects if name.startswith(prefix)]
+
+    def new_key(self, name):
+        return FakeKey(self, name)
+
+    def initiate_multipart_upload(self, name, headers=None, policy=None):
+        return FakeMultipart(self, name, headers)
+
+    def store(self, name, data, etag, headers):
+        if name in self.broken:
+            raise Exception("S3 said no")
+        with self.lock:
+            self.objects[name] = (data, etag, headers)
+            self.uploads.append(name)
+
+    def _key(self, name):
+        key = FakeKey(self, name)
+        key.etag = self.objects[name][1]
+        return key
+
+
+class SyncTest(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.bucket = FakeBucket()
+        self.write('css/site.css', 'body {}')
+        self.write('css/site.0123456789ab.css', 'body {}')
+        self.write(MANIFEST, json.dumps({'paths': {'css/site.css': 'css/site.0123456789ab.css'}}))
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, data):
+        path = os.path.join(self.root, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def sync(self, **kwargs):
+        return sync(lambda: self.bucket, self.root, 'static/', 3600, 60, workers=4, **kwargs)
+
+    def test_uploads_everything_the_first_time_with_the_manifest_last(self):
+        self.assertEqual(self.sync(), (3, 0, 14 + len(open(os.path.join(self.root, MANIFEST)).read())))
+        self.assertEqual(sorted(self.bucket.objects), ['static/css/site.0123456789ab.css', 'static/css/site.css',
+                                                       'static/' + MANIFEST])
+        self.assertEqual(self.bucket.uploads[-1], 'static/' + MANIFEST)
+
+    def test_skips_files_whose_etag_matches(self):
+        self.sync()
+        self.bucket.uploads = []
+        self.assertEqual(self.sync(), (0, 3, 0))
+        self.assertEqual(self.bucket.uploads, [])
+
+    def test_uploads_only_changed_files(self):
+        self.sync()
+        self.bucket.uploads = []
+        self.write('css/site.css', 'body { color: red }')
+        self.assertEqual(self.sync()[:2], (1, 2))
+        self.assertEqual(self.bucket.uploads, ['static/css/site.css'])
+
+    def test_large_files_go_up_in_parts_and_are_skipped_next_time(self):
+        self.write('video.bin', os.urandom(6 * 1024 * 1024))
+        self.sync(threshold=1024 * 1024, chunk_size=1)
+        self.assertTrue(self.bucket.objects['static/video.bin'][1].endswith('-2"'))
+        self.bucket.uploads = []
+        self.assertEqual(self.sync(threshold=1024 * 1024, chunk_size=1)[0], 0)
+
+    def test_hashed_files_are_cached_for_longer(self):
+        self.sync()
+        self.assertEqual(self.bucket.objects['static/css/site.0123456789ab.css'][2]['Cache-Control'],
+                         'public, max-age=3600, immutable')
+        self.assertEqual(self.bucket.objects['static/css/site.css'][2]['Cache-Control'], 'public, max-age=60')
+
+    def test_failures_are_listed_and_hold_back_the_manifest(self):
+        self.bucket.broken = ['static/css/site.css']
+        try:
+            self.sync()
+            self.fail("sync should have raised")
+        except Exception as e:
+            self.assertIn("1 of 3 static files did not upload", str(e))
+            self.assertIn("css/site.css: S3 said no", str(e))
+        self.assertNotIn('static/' + MANIFEST, self.bucket.objects)
+
+    def test_needs_a_manifest(self):
+        os.remove(os.path.join(self.root, MANIFEST))
+        self.assertRaises(Exception, hashed_names, self.root)
+
+
+class EtagTest(unittest.TestCase):
+    def setUp(self):
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.write('a' * 10)
+        f.close()
+        self.path = f.name
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_small_files_are_their_md5(self):
+        self.assertEqual(etag(self.path, 100, 4), hashlib.md5('a' * 10).hexdigest())
+
+    def test_large_files_are_the_md5_of_their_parts(self):
+        parts = [hashlib.md5('aaaa').digest(), hashlib.md5('aaaa').digest(), hashlib.md5('aa').digest()]
+        self.assertEqual(etag(self.path, 10, 4), '%s-3' % hashlib.md5(''.join(parts)).hexdigest())
+
+
+class HeadersTest(unittest.TestCase):
+    def test_text_gets_a_charset(self):
+        self.assertEqual(headers('site.css', False, 10, 1)['Content-Type'], 'text/css; charset=utf-8')
+        self.assertEqual(headers('logo.png', False, 10, 1)['Content-Type'], 'image/png')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import sys
+import unittest
+from StringIO import StringIO
+
+import hardware
+from nginx import lint
+from tuning import system_settings
+from hardware import instance_hardware
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fabfile', 'templates')
+
+
+def render(name, context):
+    f = open(os.path.join(TEMPLATES_DIR, name), 'rb')
+    try:
+        return f.read() % context
+    finally:
+        f.close()
+
+
+class SystemSettingsTest(unittest.TestCase):
+    def test_grows_with_the_hardware(self):
+        small, large = system_settings(1, 1024), system_settings(16, 65536)
+        for name in ['SOMAXCONN', 'NGINX_WORKER_CONNECTIONS', 'NETDEV_MAX_BACKLOG', 'FILE_MAX']:
+            self.assertTrue(small[name] < large[name], name)
+
+    def test_stays_within_the_kernel_limits(self):
+        settings = system_settings(128, 1048576)
+        self.assertEqual((settings['SOMAXCONN'], settings['TCP_MAX_SYN_BACKLOG']), (65535, 65535))
+        self.assertEqual(settings['NGINX_WORKER_CONNECTIONS'], 16384)
+
+    def test_overrides(self):
+        self.assertEqual(system_settings(2, 4096, {'SOMAXCONN': 8192})['SOMAXCONN'], 8192)
+
+    def test_nginx_has_a_file_for_each_connection_and_its_upstream(self):
+        settings = system_settings(2, 4096)
+        self.assertTrue(settings['NGINX_WORKER_RLIMIT_NOFILE'] >= settings['NGINX_WORKER_CONNECTIONS'] * 2)
+        self.assertTrue(settings['NOFILE_LIMIT'] >= settings['NGINX_WORKER_RLIMIT_NOFILE'])
+
+    def test_small_instances_get_swap(self):
+        self.assertEqual(system_settings(1, 1024)['SWAP_MB'], 1024)
+        self.assertEqual(system_settings(2, 4096)['SWAP_MB'], 0)
+
+
+class UnknownInstanceTypeTest(unittest.TestCase):
+    def setUp(self):
+        hardware._warned.clear()
+        self.stdout, sys.stdout = sys.stdout, StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+
+    def test_the_system_templates_render_for_an_unknown_type(self):
+        context = dict(system_settings(*instance_hardware('x9.huge')), INSTANCE_TYPE='x9.huge', SWAP_FILE='/swapfile')
+        self.assertEqual(context['SOMAXCONN'], 4096)
+        for name in ['sysctl.conf', 'limits.conf']:
+            self.assertFalse('%(' in render(name, context), name)
+        context.update(NGINX_LOG_BUFFER='32k', NGINX_LOG_FLUSH='5s')
+        self.assertEqual(lint(render('nginx.conf', context)), [])